@@ -0,0 +1,1462 @@
+'''
+Micro benchmarks for the raft runtime
+
+Usage: $ python benchmarks.py <benchmark name>
+       $ python benchmarks.py              (runs every benchmark)
+
+Benchmarks that start the raft threads of a node run in a child process, those threads never stop.
+'''
+import asyncio
+import filecmp
+import gc
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent import futures
+from queue import Queue, Empty
+from socket import socket, socketpair, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SO_SNDBUF, SO_RCVBUF
+
+import kvserverThreaded
+import message
+import raft_asyncio
+import wal
+
+import raft
+from raft import Servers, LogEntry, AppendEntriesRequest, RaftRunTime, WIRE_FORMAT_BINARY, WIRE_FORMAT_PICKLE
+
+
+def _timeit(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return time.perf_counter() - start
+
+
+def _make_append_entries_request(num_of_entries):
+    entries = [LogEntry(command=f'set key{i} {i * 7}', term=3, inserted_by=Servers.Server_0) for i in range(num_of_entries)]
+    return AppendEntriesRequest(3, Servers.Server_0, 1041, 3, entries, 1040,
+                                uuid=RaftRunTime().gen_uuid(), source=Servers.Server_0,
+                                destination=Servers.Server_1, ref_msg_uuid=None)
+
+
+def bench_codec():
+    print('wire codec: encode/decode throughput and frame size (binary vs pickle)')
+    print(f'{"payload":<22}{"format":<8}{"bytes":>9}{"encode/s":>12}{"decode/s":>12}')
+    for label, num_of_entries, iterations in [('heartbeat', 0, 20000), ('1k-entry AppendEntries', 1000, 50)]:
+        msg = _make_append_entries_request(num_of_entries)
+        for wire_format in [WIRE_FORMAT_PICKLE, WIRE_FORMAT_BINARY]:
+            runtime = RaftRunTime(wire_format=wire_format)
+            frame = runtime.object_to_string(msg)
+            encode_time = _timeit(lambda: runtime.object_to_string(msg), iterations)
+            decode_time = _timeit(lambda: runtime.string_to_object(frame), iterations)
+            print(f'{label:<22}{wire_format:<8}{len(frame):>9}{iterations / encode_time:>12.0f}{iterations / decode_time:>12.0f}')
+
+
+def _stream_frames(frame, count):
+    # writer side of a socket pair, frames are written back to back like a busy peer would
+    sender, receiver = socketpair()
+
+    def write():
+        batch = (b'%10d' % len(frame) + frame) * 16
+        for _ in range(count // 16):
+            sender.sendall(batch)
+        sender.close()
+    threading.Thread(target=write, daemon=True).start()
+    return receiver
+
+
+class _CountingSocket:
+    # counts the syscalls made through a socket
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.syscalls = 0
+
+    def recv(self, nbytes):
+        self.syscalls += 1
+        return self.sock.recv(nbytes)
+
+    def recv_into(self, buffer):
+        self.syscalls += 1
+        return self.sock.recv_into(buffer)
+
+
+class _CountingSendSocket:
+    # counts the send syscalls made through a socket
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.syscalls = 0
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def sendall(self, data):
+        self.syscalls += 1
+        return self.sock.sendall(data)
+
+    def sendmsg(self, buffers):
+        self.syscalls += 1
+        return self.sock.sendmsg(buffers)
+
+
+def _drain(sock, count):
+    def read():
+        reader = message.FrameReader(sock)
+        received = 0
+        while received < count:
+            received += len(reader.read_frames())
+    t = threading.Thread(target=read, daemon=True)
+    t.start()
+    return t
+
+
+def _send_two_sendalls(sock, frame):
+    # send path before scatter/gather - header and body in two separate sendall()
+    sock.sendall(b'%10d' % len(frame))
+    sock.sendall(frame)
+
+
+def bench_send():
+    print('send path: syscalls per message for AppendEntriesResponse frames')
+    print(f'{"sender":<36}{"msgs/s":>10}{"syscalls/msg":>14}')
+    count = 20000
+    response = raft.AppendEntriesResponse(3, True, 1041, uuid=RaftRunTime().gen_uuid(), source=Servers.Server_1,
+                                          destination=Servers.Server_0, ref_msg_uuid=RaftRunTime().gen_uuid())
+    frame = RaftRunTime().object_to_string(response)
+
+    for name, send in [('two sendall() per message', _send_two_sendalls), ('message.send_message (sendmsg)', message.send_message)]:
+        sender, receiver = socketpair()
+        sock = _CountingSendSocket(sender)
+        reader = _drain(receiver, count)
+        start = time.perf_counter()
+        for _ in range(count):
+            send(sock, frame)
+        reader.join()
+        elapsed = time.perf_counter() - start
+        print(f'{name:<36}{count / elapsed:>10.0f}{sock.syscalls / count:>14.3f}')
+
+    # queued frames drained by outgoing_queue_to_network into vectored writes
+    runtime = RaftRunTime()
+    runtime.outgoing_queue = raft.OutboundChannels(count, runtime)
+    server = raft.RaftServer(Servers.Server_1)
+    sender, receiver = socketpair()
+    sock = _CountingSendSocket(sender)
+    runtime.remote_server_conns[Servers.Server_0] = sock
+    for _ in range(count):
+        runtime.outgoing_queue.put_nowait(response)
+    reader = _drain(receiver, count)
+    start = time.perf_counter()
+    threading.Thread(target=raft.outgoing_queue_to_network, args=(runtime, server, Servers.Server_0,), daemon=True).start()
+    reader.join()
+    elapsed = time.perf_counter() - start
+    name = f'outgoing queue (max {runtime.SEND_BATCH_MAX_FRAMES} frames)'
+    print(f'{name:<36}{count / elapsed:>10.0f}{sock.syscalls / count:>14.3f}')
+
+
+def _recv_with_recv_message(sock, count):
+    for _ in range(count):
+        message.recv_message(sock)
+
+
+def _recv_with_frame_reader(sock, count):
+    reader = message.FrameReader(sock)
+    received = 0
+    while received < count:
+        received += len(reader.read_frames())
+
+
+def bench_recv():
+    print('framed receive path: recv_message (chunks + join) vs FrameReader (recv_into + memoryview)')
+    print(f'{"payload":<26}{"reader":<16}{"frames/s":>12}{"recv calls/frame":>18}')
+    for label, num_of_entries, count in [('10-entry AppendEntries', 10, 64000), ('1k-entry AppendEntries', 1000, 4000)]:
+        frame = RaftRunTime().object_to_string(_make_append_entries_request(num_of_entries))
+        for name, recv in [('recv_message', _recv_with_recv_message), ('FrameReader', _recv_with_frame_reader)]:
+            sock = _stream_frames(frame, count)
+            start = time.perf_counter()
+            recv(sock, count)
+            elapsed = time.perf_counter() - start
+            sock.close()
+
+            sock = _CountingSocket(_stream_frames(frame, count))
+            recv(sock, count)
+            sock.sock.close()
+            print(f'{label:<26}{name:<16}{count / elapsed:>12.0f}{sock.syscalls / count:>18.3f}')
+
+
+class _LoopbackRunTime(RaftRunTime):
+    # delivers AppendEntriesRequest straight to the follower's handler and its response straight back,
+    # counting the round trips and the entries shipped
+
+    def __init__(self, follower_runtime, follower):
+        super().__init__()
+        self.follower_runtime = follower_runtime
+        self.follower = follower
+        self.round_trips = 0
+        self.entries_sent = 0
+
+    def send_request(self, request):
+        self.round_trips += 1
+        self.entries_sent += len(request.entries_to_be_appended)
+        # through the wire codec, like a real transfer
+        request = self.follower_runtime.string_to_object(self.object_to_string(request))
+        raft.handle_append_entries(self.follower_runtime, self.follower, request)
+        response_future = futures.Future()
+        response_future.set_result(self.follower_runtime.outgoing_queue.lanes[raft.LANE_CONTROL][request.source].take(1)[0])
+        return response_future
+
+
+def _diverged_pair(common, divergent):
+    # leader: <common> entries of term 1 then <divergent> of term 3
+    # follower: the same <common> entries then <divergent> entries of term 2 that never got committed
+    leader, follower = raft.RaftServer(Servers.Server_0, current_term=3), raft.RaftServer(Servers.Server_1, current_term=2)
+    for server, tail_term in [(leader, 3), (follower, 2)]:
+        server.log.log_entries = [LogEntry(f'set key{i} {i}', 1, Servers.Server_0) for i in range(common)] + \
+                                 [LogEntry(f'set key{i} {i}', tail_term, Servers.Server_0) for i in range(divergent)]
+    _as_new_leader(leader)
+    return leader, follower
+
+
+def _as_new_leader(leader):
+    # the state make_leader() leaves behind, without queueing its no-op
+    leader.next_index = [len(leader.log.log_entries)] * raft.NUM_OF_SERVERS
+    leader.match_index = [raft.RaftServer.INIT_INDEX] * raft.NUM_OF_SERVERS
+    leader.follower_matched = [False] * raft.NUM_OF_SERVERS
+    leader.role = raft.RaftServerRole.LEADER
+
+
+def bench_catch_up():
+    print('catching up a follower with a divergent uncommitted tail (loopback transport)')
+    print(f'{"divergent entries":<20}{"round trips":>12}{"entries sent":>14}{"seconds":>10}')
+    for divergent in [1000, 10000]:
+        leader, follower = _diverged_pair(1000, divergent)
+        runtime = _LoopbackRunTime(RaftRunTime(), follower)
+        start = time.perf_counter()
+        raft.replicate_to_follower(runtime, leader, follower.id)
+        elapsed = time.perf_counter() - start
+        assert [e.term for e in follower.log.log_entries] == [e.term for e in leader.log.log_entries]
+        print(f'{divergent:<20}{runtime.round_trips:>12}{runtime.entries_sent:>14}{elapsed:>10.2f}')
+
+
+def _current_rss_kb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() // 1024
+
+
+def _child_catch_up_rss(max_entries_per_append, max_transient_mb):
+    # a follower with an empty log behind a leader with 1M committed entries. Fails unless the follower ends up
+    # with the leader's log and commit index, and (max_transient_mb > 0) the transfer stays within that much memory
+    RaftRunTime.MAX_ENTRIES_PER_APPEND = int(max_entries_per_append)
+    RaftRunTime.MAX_BYTES_PER_APPEND = 1 << 62 if int(max_entries_per_append) > 1024 else 256 * 1024
+    leader, follower = raft.RaftServer(Servers.Server_0, current_term=1), raft.RaftServer(Servers.Server_1)
+    leader.log.log_entries = [LogEntry(f'set key{i} {i}', 1, Servers.Server_0) for i in range(1000000)]
+    # the rest of the cluster holds the whole log
+    leader.log.last_committed_index = leader.log.last_index()
+    _as_new_leader(leader)
+    runtime = _LoopbackRunTime(RaftRunTime(), follower)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    raft.replicate_to_follower(runtime, leader, follower.id)
+    elapsed = time.perf_counter() - start
+    # the follower's own copy of the log is the expected growth, the transient part is what the transfer cost
+    peak_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    transient = max(0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - _current_rss_kb())
+    _report(f'{max_entries_per_append:<20}{runtime.round_trips:>12}{elapsed:>10.1f}{peak_growth / 1024:>20.0f}{transient / 1024:>16.0f}')
+    assert follower.log.length() == leader.log.length()
+    assert follower.log.term_at(follower.log.last_index()) == leader.log.term_at(leader.log.last_index())
+    # the follower compacts what it applied, the entries it still holds must be the leader's
+    kept = range(follower.log.base_index + 1, follower.log.length())
+    assert all(a.command == b.command and a.term == b.term
+               for a, b in zip(follower.log.entries(kept.start, kept.stop), leader.log.entries(kept.start, kept.stop)))
+    assert follower.log.last_committed_index == follower.last_applied_index == leader.log.last_committed_index
+    assert not int(max_transient_mb) or transient / 1024 <= int(max_transient_mb), \
+        f'catching up took {transient / 1024:.0f} MB on top of the logs, more than {max_transient_mb} MB'
+
+
+def bench_catch_up_rss():
+    print('catching up a 1M-entry lag (loopback transport through the wire codec)')
+    print(f'{"entries/append":<20}{"round trips":>12}{"seconds":>10}{"peak RSS growth MB":>20}{"transient MB":>16}')
+    # bounded appends must catch up within 32 MB on top of the logs, the single append of the whole lag is there
+    # to compare with
+    for max_entries_per_append, max_transient_mb in [(1024, 32), (10000000, 0)]:
+        _run_in_child('_catch_up_rss', max_entries_per_append, max_transient_mb)
+
+
+def _report(line):
+    # the raft threads print a lot, results of child benchmarks go straight to the real stdout
+    print(line, file=sys.__stdout__, flush=True)
+
+
+def _run_in_child(name, *args):
+    subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name] + [str(arg) for arg in args], check=True)
+
+
+def _peer_sockets(runtime, server, answer=None):
+    # every peer of the node is the other end of a socket pair per lane, whatever the node sends is read and
+    # optionally answered with answer(msg) (None -> no answer)
+    received = []
+    for peer_id, lane in itertools.product(server.fetch_peer_ids(), raft.LANES):
+        local, remote = socketpair()
+        runtime.register_connection(peer_id, local, lane=lane)
+        peer_runtime = RaftRunTime()
+
+        def serve(sock, peer_sock):
+            reader = message.FrameReader(sock)
+            try:
+                while True:
+                    for obj in peer_runtime.recv_from_reader(reader):
+                        received.append(obj)
+                        response = answer(obj) if answer else None
+                        # responses go straight to the request waiting for them, like from the network
+                        if response is not None and not runtime.complete_request(response):
+                            runtime.incoming_queue.put_nowait(response)
+            except IOError:
+                pass
+        threading.Thread(target=serve, args=(remote, local), daemon=True).start()
+    return received
+
+
+def _hold_elections(runtime):
+    # the node never reaches its election timeout. The benchmarks measure a leader and its followers, and the
+    # followers here have no leader they could hear from in time (a simulated one, or five nodes sharing a process)
+    runtime.ELECTION_TIMEOUT_MIN = runtime.ELECTION_TIMEOUT_MAX = 3600
+
+
+def _start_node(runtime, server, role):
+    _hold_elections(runtime)
+    if role == raft.RaftServerRole.LEADER:
+        runtime.make_leader(server)
+        server.current_term = 1
+    else:
+        runtime.make_follower(server)
+    runtime.fast_track = False
+    raft.kickoff_incoming_messages_event_loop(runtime, server)
+    raft.kickoff_outgoing_queue_to_network(runtime, server)
+    raft.kickoff_election_timeout_checker(runtime, server)
+    raft.kickoff_heart_beat_timer(runtime, server)
+
+
+def _blackhole(sock):
+    # swallow everything written to the other end of sock
+    def read():
+        try:
+            while sock.recv(65536):
+                pass
+        except IOError:
+            pass
+    threading.Thread(target=read, daemon=True).start()
+
+
+# the never read ends of the connections to stalled followers and the addresses of the unreachable ones
+_stalled_sockets = []
+
+
+def _start_local_cluster(base_port=24000, blackholed=(), log_dir=None, stalled=(), unreachable=()):
+    # all five nodes in this process over localhost, Server_0 is fast tracked to leader and stays the leader.
+    # The leader's connections to the blackholed followers lead nowhere (a partition that keeps TCP up), the ones
+    # to the stalled followers are never read (writes block once the socket buffers are full, and so do they on a
+    # connection dialed again) and the unreachable followers refuse connections.
+    # With a log_dir every node keeps its log on disk in a sub directory of it
+    nodes = {}
+    for i, server_id in raft._id_to_servers.items():
+        raft.SERVER_ADDRESSES[server_id] = ('127.0.0.1', base_port + i)
+    for server_id in Servers:
+        server_log_dir = os.path.join(log_dir, server_id.name) if log_dir else None
+        runtime, server = RaftRunTime(server_id=server_id), raft.RaftServer(server_id, log_dir=server_log_dir)
+        _hold_elections(runtime)
+        server_socket = socket(AF_INET, SOCK_STREAM)
+        server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, True)
+        server_socket.bind(raft.SERVER_ADDRESSES[server_id])
+        server_socket.listen()
+        runtime.local_server_conn = server_socket
+        nodes[server_id] = (runtime, server)
+    for server_id, (runtime, server) in nodes.items():
+        for peer_id in server.fetch_peer_ids():
+            if server_id == Servers.Server_0 and peer_id in blackholed:
+                for lane in raft.LANES:
+                    local, remote = socketpair()
+                    _blackhole(remote)
+                    runtime.register_connection(peer_id, local, lane=lane)
+                continue
+            if server_id == Servers.Server_0 and peer_id in stalled:
+                for lane in raft.LANES:
+                    local, remote = socketpair()
+                    local.setsockopt(SOL_SOCKET, SO_SNDBUF, 16 * 1024)
+                    remote.setsockopt(SOL_SOCKET, SO_RCVBUF, 16 * 1024)
+                    runtime.register_connection(peer_id, local, lane=lane)
+                    _stalled_sockets.append(remote)
+                # connections made again queue up on a listener that never accepts them
+                listener = socket(AF_INET, SOCK_STREAM)
+                listener.setsockopt(SOL_SOCKET, SO_RCVBUF, 16 * 1024)
+                listener.bind(('127.0.0.1', 0))
+                listener.listen()
+                _stalled_sockets.append(listener)
+                runtime.peer_addresses = {**runtime.peer_addresses, peer_id: listener.getsockname()}
+                continue
+            if server_id == Servers.Server_0 and peer_id in unreachable:
+                # bound but not listening, connecting to it is refused
+                closed = socket(AF_INET, SOCK_STREAM)
+                closed.bind(('127.0.0.1', 0))
+                _stalled_sockets.append(closed)
+                runtime.peer_addresses = {**runtime.peer_addresses, peer_id: closed.getsockname()}
+            # the other peers are dialed on the first message to them
+    for runtime, server in nodes.values():
+        raft.test_leader_election(runtime, server)
+    leader_runtime, leader = nodes[Servers.Server_0]
+    leader_runtime.wait_for_role(leader, {raft.RaftServerRole.LEADER})
+    return nodes
+
+
+def _commit_latencies(runtime, server, samples, timeout=None):
+    # propose one command at a time and time it until the leader has committed it. A command not committed within
+    # timeout counts as infinitely late and ends the run
+    latencies = []
+    for i in range(samples):
+        time.sleep(random.random() * 0.05)
+        index = server.log.length()
+        start = time.perf_counter()
+        runtime.incoming_queue.put_nowait(raft.ClientAppendRequest(command=f'set key{i} {i}', uuid=runtime.gen_uuid(),
+                                                                   source=server.id, destination=server.id))
+        while server.log.last_committed_index < index:
+            if timeout and time.perf_counter() - start > timeout:
+                return latencies + [float('inf')]
+            time.sleep(0.0002)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _print_latencies(label, latencies):
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    _report(f'{label:<36}{statistics.median(latencies) * 1000:>10.1f}{p99 * 1000:>10.1f}')
+
+
+def _cpu_while_sleeping(seconds):
+    start_cpu, start = time.process_time(), time.perf_counter()
+    time.sleep(seconds)
+    return (time.process_time() - start_cpu) / (time.perf_counter() - start)
+
+
+def _idle_cpu(role, server_id):
+    runtime = RaftRunTime(server_id=server_id)
+    server = raft.RaftServer(server_id)
+    _peer_sockets(runtime, server)
+    _start_node(runtime, server, role)
+    time.sleep(0.5)
+    _report(f'idle {role.name.lower()} node: {_cpu_while_sleeping(3) * 100:.1f}% CPU')
+
+
+def _child_idle_follower_cpu():
+    _idle_cpu(raft.RaftServerRole.FOLLOWER, Servers.Server_1)
+
+
+def _child_idle_leader_cpu():
+    _idle_cpu(raft.RaftServerRole.LEADER, Servers.Server_0)
+
+
+def _child_follower_throughput():
+    count = 5000
+    runtime = RaftRunTime(server_id=Servers.Server_1)
+    server = raft.RaftServer(Servers.Server_1)
+    received = _peer_sockets(runtime, server)
+    _start_node(runtime, server, raft.RaftServerRole.FOLLOWER)
+    leader = Servers.Server_0
+    start = time.perf_counter()
+    for i in range(count):
+        entry = LogEntry(command=f'set key{i} {i}', term=1, inserted_by=leader)
+        runtime.incoming_queue.put_nowait(AppendEntriesRequest(1, leader, i - 1, 1 if i else 0, [entry], i - 1,
+                                                               uuid=runtime.gen_uuid(), source=leader,
+                                                               destination=server.id, ref_msg_uuid=None))
+    while len(received) < count:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    _report(f'follower AppendEntries throughput: {count / elapsed:.0f} requests/s')
+
+
+def bench_idle():
+    print('event loops: CPU used by an idle node and AppendEntries throughput of a follower')
+    _run_in_child('_idle_follower_cpu')
+    _run_in_child('_idle_leader_cpu')
+    _run_in_child('_follower_throughput')
+
+
+def _child_election(down):
+    # a candidate whose peers are the other ends of socket pairs, all of them grant their vote but the first down
+    # ones never answer. Times the election against the round trip of a single vote request
+    count = 200
+    runtime = RaftRunTime(server_id=Servers.Server_0)
+    server = raft.RaftServer(Servers.Server_0)
+    down_peers = set(server.fetch_peer_ids()[:int(down)])
+
+    def answer(msg):
+        if type(msg) != raft.VoteRequest or msg.destination in down_peers:
+            return None
+        return raft.VoteResponse(vote_granted=True, peer_term=msg.candidate_term, uuid=runtime.gen_uuid(),
+                                 source=msg.destination, destination=msg.source, ref_msg_uuid=msg.uuid)
+    _peer_sockets(runtime, server, answer)
+    _start_node(runtime, server, raft.RaftServerRole.FOLLOWER)
+    rtts = []
+    for _ in range(count):
+        request = raft.make_vote_request(runtime, server, Servers.Server_4)
+        start = time.perf_counter()
+        runtime.wait_for_response(request, runtime.send_request(request), 5)
+        rtts.append(time.perf_counter() - start)
+    elections = []
+    for _ in range(count):
+        runtime.make_follower(server)
+        start = time.perf_counter()
+        raft.run_election(runtime, server)
+        elections.append(time.perf_counter() - start)
+        assert server.role == raft.RaftServerRole.LEADER
+    rtt, elections = statistics.median(rtts), sorted(elections)
+    _report(f'{down:>10}{rtt * 1000:>10.2f}{statistics.median(elections) * 1000:>10.2f}'
+            f'{elections[int(count * 0.99)] * 1000:>10.2f}{statistics.median(elections) / rtt:>10.1f}')
+
+
+def bench_election():
+    print('leader election: a candidate with 4 peers, some of them down (never answering), votes from the others')
+    print('time from standing for election to becoming the leader, and the same in round trips of one vote request')
+    print(f'{"peers down":>10}{"RTT ms":>10}{"p50 ms":>10}{"p99 ms":>10}{"RTTs":>10}')
+    for down in [0, 1, 2]:
+        _run_in_child('_election', down)
+
+
+def _child_commit_latency_healthy():
+    runtime, server = _start_local_cluster()[Servers.Server_0]
+    time.sleep(1)
+    _print_latencies('all followers healthy', _commit_latencies(runtime, server, 50))
+
+
+def _child_commit_latency_partitioned():
+    runtime, server = _start_local_cluster(blackholed={Servers.Server_1})[Servers.Server_0]
+    time.sleep(1)
+    _print_latencies('Server_1 partitioned', _commit_latencies(runtime, server, 50))
+
+
+def bench_commit_latency():
+    print('commit latency of a single proposal on a local 5-node cluster')
+    print(f'{"cluster":<36}{"p50 ms":>10}{"p99 ms":>10}')
+    _run_in_child('_commit_latency_healthy')
+    _run_in_child('_commit_latency_partitioned')
+
+
+def _child_peer_isolation(fault):
+    # commit latency of the rest of the cluster while the leader cannot get anything through to Server_1
+    faults = {'stalled': {'stalled': {Servers.Server_1}}, 'unreachable': {'unreachable': {Servers.Server_1}}}
+    runtime, server = _start_local_cluster(**faults.get(fault, {}))[Servers.Server_0]
+    time.sleep(1)
+    _print_latencies(f'Server_1 {fault}', _commit_latencies(runtime, server, 100, timeout=10))
+
+
+def bench_peer_isolation():
+    print('commit latency on a local 5-node cluster with one follower that cannot be sent to')
+    print(f'{"cluster":<36}{"p50 ms":>10}{"p99 ms":>10}')
+    for fault in ['healthy', 'stalled', 'unreachable']:
+        _run_in_child('_peer_isolation', fault)
+
+
+def _child_bytes_per_entry():
+    runtime, server = _start_local_cluster()[Servers.Server_0]
+    time.sleep(1)
+    bytes_sent = [0]
+    encode = runtime.object_to_string
+
+    def counting_encode(o):
+        _b = encode(o)
+        bytes_sent[0] += len(_b)
+        return _b
+    runtime.object_to_string = counting_encode
+
+    # proposals spread over several heartbeats, then a few idle heartbeats
+    first_index = server.log.length()
+    for i in range(200):
+        runtime.incoming_queue.put_nowait(raft.ClientAppendRequest(command=f'set key{i} {i}', uuid=runtime.gen_uuid(),
+                                                                   source=server.id, destination=server.id))
+        time.sleep(0.02)
+    time.sleep(3)
+    committed = server.log.last_committed_index - first_index + 1
+    _report(f'leader sent {bytes_sent[0]} bytes for {committed} committed entries = {bytes_sent[0] / committed:.0f} bytes/entry')
+
+
+def _child_pipeline_throughput(window):
+    RaftRunTime.REPLICATION_WINDOW = int(window)
+    runtime, server = _start_local_cluster()[Servers.Server_0]
+    time.sleep(1)
+    count = 400
+    start = time.perf_counter()
+    for i in range(count):
+        runtime.incoming_queue.put_nowait(raft.ClientAppendRequest(command=f'set key{i} {i}', uuid=runtime.gen_uuid(),
+                                                                   source=server.id, destination=server.id))
+        # proposals trickle in, as they would from clients
+        time.sleep(0.0005)
+    while server.log.last_committed_index < count:
+        time.sleep(0.0005)
+    elapsed = time.perf_counter() - start
+    _report(f'{window:<10}{count / elapsed:>14.0f}')
+
+
+def bench_pipeline():
+    print('replication throughput vs per-follower AppendEntries window on a local 5-node cluster')
+    print(f'{"window":<10}{"commits/s":>14}')
+    for window in [1, 2, 4, 8, 16]:
+        _run_in_child('_pipeline_throughput', window)
+
+
+def bench_bytes_per_entry():
+    print('replication traffic: bytes sent by the leader per committed entry on a local 5-node cluster')
+    _run_in_child('_bytes_per_entry')
+
+
+def _child_group_commit(proposers, max_batch, fsync_policy=None):
+    RaftRunTime.INGEST_MAX_BATCH = int(max_batch)
+    log_dir = None
+    if fsync_policy:
+        raft.RaftPersistentLog.FSYNC_POLICY = fsync_policy
+        log_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(__file__)))
+    runtime, server = _start_local_cluster(log_dir=log_dir)[Servers.Server_0]
+    time.sleep(1)
+    latencies = []
+    stop = time.perf_counter() + 3
+
+    def proposer(n):
+        # one outstanding proposal per proposer, the next one goes out once the previous one is committed
+        i = 0
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            request, response_future = runtime.propose(server, f'set key{n}_{i} {i}')
+            if runtime.wait_for_response(request, response_future, 5) is not None:
+                latencies.append(time.perf_counter() - start)
+            i += 1
+
+    threads = [threading.Thread(target=proposer, args=(n,)) for n in range(int(proposers))]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    if fsync_policy:
+        shutil.rmtree(log_dir)
+        _report(f'{fsync_policy:<12}{proposers:<12}{max_batch:<12}{len(latencies) / elapsed:>12.0f}{p99 * 1000:>10.1f}')
+    else:
+        _report(f'{proposers:<12}{max_batch:<12}{len(latencies) / elapsed:>12.0f}{p99 * 1000:>10.1f}')
+
+
+def bench_group_commit():
+    print('group commit: committed writes/s and p99 commit latency vs concurrent proposers on a local 5-node cluster')
+    print('(max batch 1 appends every client request on its own)')
+    print(f'{"proposers":<12}{"max batch":<12}{"writes/s":>12}{"p99 ms":>10}')
+    for proposers in [1, 10, 100]:
+        for max_batch in [1, RaftRunTime.INGEST_MAX_BATCH]:
+            _run_in_child('_group_commit', proposers, max_batch)
+
+
+def _wal_appends(fsync_policy, batch_size, count):
+    # appends/s into a fresh write-ahead log and the time it then takes to recover it
+    directory = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        records = [raft.wire_codec.encode(LogEntry(f'set key{i} {i}', 1, Servers.Server_0)) for i in range(count)]
+        log = wal.SegmentedLog(directory, fsync_policy=fsync_policy)
+        start = time.perf_counter()
+        for i in range(0, count, batch_size):
+            log.append(records[i:i + batch_size])
+        elapsed = time.perf_counter() - start
+        log.close()
+        start = time.perf_counter()
+        log = wal.SegmentedLog(directory)
+        recovery = time.perf_counter() - start
+        assert len(log) == count
+        log.close()
+    finally:
+        shutil.rmtree(directory)
+    return count / elapsed, recovery
+
+
+def bench_wal():
+    print('write-ahead log: appends/s per fsync policy and entries per append() call')
+    print(f'{"fsync":<12}{"batch":<8}{"appends/s":>12}{"recovery ms":>14}')
+    for fsync_policy in [wal.FSYNC_ENTRY, wal.FSYNC_BATCH, wal.FSYNC_INTERVAL]:
+        for batch_size in [1, 64]:
+            rate, recovery = _wal_appends(fsync_policy, batch_size, 5000)
+            print(f'{fsync_policy:<12}{batch_size:<8}{rate:>12.0f}{recovery * 1000:>14.1f}')
+    print('durable local 5-node cluster, committed writes/s and p99 commit latency (max batch 1 = no group commit)')
+    print(f'{"fsync":<12}{"proposers":<12}{"max batch":<12}{"writes/s":>12}{"p99 ms":>10}')
+    for fsync_policy in [wal.FSYNC_ENTRY, wal.FSYNC_BATCH, wal.FSYNC_INTERVAL]:
+        for proposers in [10, 100]:
+            for max_batch in [1, RaftRunTime.INGEST_MAX_BATCH]:
+                _run_in_child('_group_commit', proposers, max_batch, fsync_policy)
+
+
+def _child_restart(mode, log_dir):
+    # open a server on an existing log, eager decodes every entry up front (what restarting used to do)
+    rss_before = _current_rss_kb()
+    start = time.perf_counter()
+    server = raft.RaftServer(Servers.Server_0, log_dir=log_dir)
+    if mode == 'eager':
+        server.log.log_entries = list(server.log.log_entries)
+    elapsed = time.perf_counter() - start
+    rss = _current_rss_kb() - rss_before
+    count = len(server.log.log_entries)
+    indices = [random.randrange(count) for _ in range(10000)]
+    read_start = time.perf_counter()
+    for i in indices:
+        server.log.log_entries[i].term
+    read = (time.perf_counter() - read_start) / len(indices)
+    slice_start = time.perf_counter()
+    server.log.log_entries[count // 2:count // 2 + 1024]
+    read_slice = time.perf_counter() - slice_start
+    _report(f'{mode:<8}{count:>12}{elapsed:>12.2f}{rss / 1024:>10.0f}{read * 1e6:>16.1f}{read_slice * 1000:>15.2f}')
+
+
+def bench_restart():
+    count = 10000000
+    print(f'restarting a node on a {count}-entry write-ahead log')
+    log_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        log = wal.SegmentedLog(log_dir)
+        for i in range(0, count, 10000):
+            log.append([raft.wire_codec.encode(LogEntry(f'set key{j} {j}', 1, Servers.Server_0)) for j in range(i, i + 10000)])
+        log.close()
+        print(f'{"load":<8}{"entries":>12}{"restart s":>12}{"RSS MB":>10}{"random read us":>16}{"1024 slice ms":>15}')
+        for mode in ['eager', 'mmap']:
+            _run_in_child('_restart', mode, log_dir)
+    finally:
+        shutil.rmtree(log_dir)
+
+
+class _KeyValueStore:
+    # the state machine of kvserverThreaded, one per node (kvserverThreaded keeps its store in a module global)
+
+    def __init__(self):
+        self.data = {}
+
+    def execute_instruction(self, instruction):
+        if instruction[0].upper() == 'SET':
+            self.data[instruction[1]] = instruction[2]
+
+    def write_snapshot(self, write):
+        write(json.dumps(self.data).encode('utf-8'))
+
+    def restore(self, chunks):
+        self.data = dict(kvserverThreaded.snapshot_items(chunks))
+
+
+def _disk_usage_mb(directory):
+    # blocks actually allocated (segments are preallocated)
+    usage = 0
+    for root, _, files in os.walk(directory):
+        usage += sum(os.stat(os.path.join(root, name)).st_blocks * 512 for name in files)
+    return usage / (1024 * 1024)
+
+
+def _child_soak(snapshot_entries, seconds):
+    # a durable 5-node cluster under a steady write load on a bounded key space, SNAPSHOT_ENTRIES=0 never compacts
+    raft.RaftPersistentLog.SNAPSHOT_ENTRIES = int(snapshot_entries)
+    raft.RaftPersistentLog.SNAPSHOT_BYTES = 0
+    # small segments, only whole sealed segments are released from disk
+    raft.RaftPersistentLog.SEGMENT_SIZE = 1024 * 1024
+    log_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(__file__)))
+    nodes = _start_local_cluster(log_dir=log_dir)
+    for runtime, _ in nodes.values():
+        runtime.application = raft.RaftApplication(_KeyValueStore())
+    runtime, server = nodes[Servers.Server_0]
+    follower_dir = os.path.join(log_dir, Servers.Server_1.name)
+    stop = time.perf_counter() + float(seconds)
+
+    def proposer(n):
+        i = 0
+        while time.perf_counter() < stop:
+            request, response_future = runtime.propose(server, f'set key{(n * 1000 + i) % 10000} {i}')
+            runtime.wait_for_response(request, response_future, 5)
+            i += 1
+
+    threads = [threading.Thread(target=proposer, args=(n,)) for n in range(50)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    while time.perf_counter() < stop:
+        time.sleep(float(seconds) / 5)
+        _report(f'{snapshot_entries:<10}{time.perf_counter() - start:>8.0f}{server.log.last_committed_index + 1:>12}'
+                f'{server.log.length() - server.log.base_index - 1:>12}{_current_rss_kb() / 1024:>10.0f}'
+                f'{_disk_usage_mb(follower_dir):>12.1f}')
+    for t in threads:
+        t.join()
+
+    # restart a copy of a follower's log directory along with its state machine
+    copy_dir = os.path.join(log_dir, 'restart')
+    shutil.copytree(follower_dir, copy_dir)
+    restart_start = time.perf_counter()
+    restarted_runtime = RaftRunTime(raft.RaftApplication(_KeyValueStore()), server_id=Servers.Server_1)
+    restarted = raft.RaftServer(Servers.Server_1, log_dir=copy_dir)
+    restarted_runtime.restore_state(restarted)
+    # replaying what follows the snapshot is part of the restart
+    raft.update_state_machine(restarted_runtime, restarted, restarted.last_applied_index + 1,
+                              restarted.log.last_index())
+    elapsed = time.perf_counter() - restart_start
+    _report(f'{snapshot_entries:<10}{"restart":>8}{restarted.log.length():>12}'
+            f'{restarted.log.length() - restarted.log.base_index - 1:>12}{elapsed:>22.2f} s')
+    shutil.rmtree(log_dir)
+
+
+def bench_compaction():
+    seconds = 60
+    print(f'soak: durable local 5-node cluster, 50 proposers over 10000 keys for {seconds} s')
+    print('(snapshot every 0 = no compaction, disk = a follower\'s log directory, restart replays a copy of it)')
+    print(f'{"snapshot":<10}{"s":>8}{"committed":>12}{"in log":>12}{"RSS MB":>10}{"disk MB":>12}')
+    for snapshot_entries in [0, 20000]:
+        _run_in_child('_soak', snapshot_entries, seconds)
+
+
+def _child_install_snapshot(log_dir, last_included_index, chunk_size, window):
+    # Server_0 restarts on a log holding nothing but a snapshot, Server_1 comes up empty and gets it streamed.
+    # The other followers are blackholed, so they never take part
+    RaftRunTime.INSTALL_SNAPSHOT_CHUNK_SIZE = int(chunk_size)
+    RaftRunTime.INSTALL_SNAPSHOT_WINDOW = int(window)
+    last_included_index = int(last_included_index)
+    for name in os.listdir(log_dir):
+        if name != Servers.Server_0.name:
+            shutil.rmtree(os.path.join(log_dir, name))
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    nodes = _start_local_cluster(log_dir=log_dir, blackholed=(Servers.Server_2, Servers.Server_3, Servers.Server_4))
+    _, follower = nodes[Servers.Server_1]
+    while follower.last_applied_index < last_included_index:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    peak_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    snapshots = [os.path.join(log_dir, server_id.name, wal.SNAPSHOT_FILE) for server_id in (Servers.Server_0, Servers.Server_1)]
+    assert filecmp.cmp(*snapshots, shallow=False)
+    size = os.path.getsize(snapshots[0])
+    _report(f'{int(chunk_size) // 1024:<12}{window:<8}{elapsed:>10.1f}{size / elapsed / (1024 * 1024):>10.0f}'
+            f'{peak_growth / 1024:>20.0f}')
+
+
+def bench_install_snapshot():
+    size = 1024 * 1024 * 1024
+    last_included_index = 10000000
+    print(f'bringing up an empty node against a {size // (1024 * 1024)} MB snapshot on a local cluster '
+          f'(InstallSnapshot, chunked)')
+    log_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        # the leader's log: a snapshot and no entries after it
+        log = wal.SegmentedLog(os.path.join(log_dir, Servers.Server_0.name))
+        writer = log.snapshot_writer(last_included_index, 0, last_included_index, 0)
+        block = os.urandom(1024 * 1024)
+        for _ in range(size // len(block)):
+            writer.write(block)
+        writer.finish()
+        log.install_snapshot(writer)
+        log.reset(last_included_index + 1)
+        log.close()
+        print(f'{"chunk KB":<12}{"window":<8}{"seconds":>10}{"MB/s":>10}{"peak RSS growth MB":>20}')
+        for chunk_size, window in [(64 * 1024, 4), (1024 * 1024, 1), (1024 * 1024, 4), (4 * 1024 * 1024, 4)]:
+            _run_in_child('_install_snapshot', log_dir, last_included_index, chunk_size, window)
+    finally:
+        shutil.rmtree(log_dir)
+
+
+def _child_snapshot_apply(mode, keys, seconds):
+    # one node applies a batch of 10 committed entries every 5 ms (open loop, a late batch counts from when it was
+    # due) to kvserverThreaded while the store gets snapshotted. Each batch overwrites random keys
+    RaftRunTime.SNAPSHOT_MODE = mode
+    raft.RaftPersistentLog.SNAPSHOT_ENTRIES = 10000
+    raft.RaftPersistentLog.SNAPSHOT_BYTES = 0
+    raft.RaftPersistentLog.SNAPSHOT_TRAILING_ENTRIES = 100
+    raft.RaftPersistentLog.FSYNC_POLICY = wal.FSYNC_INTERVAL
+    keys = int(keys)
+    for i in range(keys):
+        kvserverThreaded.data[f'key{i}'] = f'{i:0200d}'
+    log_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        runtime = RaftRunTime(raft.RaftApplication(kvserverThreaded), server_id=Servers.Server_0)
+        server = raft.RaftServer(Servers.Server_0, log_dir=log_dir)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # (when the batch was due, latency) of every batch
+        latencies = []
+        started = finished = None
+        interval = 0.005
+        due = time.perf_counter()
+        stop = due + float(seconds)
+        # until every batch due before the first snapshot got saved has been applied
+        while due < stop and (finished is None or due <= finished):
+            time.sleep(max(0.0, due - time.perf_counter()))
+            start_index = server.log.length()
+            server.log.append(start_index, [LogEntry(f'set key{random.randrange(keys)} {start_index + j}', 1,
+                                                     Servers.Server_0) for j in range(10)])
+            server.log.last_committed_index = server.log.last_index()
+            raft.update_state_machine(runtime, server, start_index, server.log.last_index())
+            latencies.append((due, time.perf_counter() - due))
+            if started is None and (runtime.snapshot_job is not None or server.log.last_included_index != -1):
+                started = due
+            if finished is None and server.log.last_included_index != -1:
+                finished = time.perf_counter()
+            due += interval
+        assert finished is not None, 'the snapshot did not finish in time'
+
+        parent_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+        child_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        before = sorted(latency for due, latency in latencies if due < started)
+        during = sorted(latency for due, latency in latencies if started <= due <= finished)
+        _report(f'{mode:<13}{finished - started:>12.1f}{before[int(len(before) * 0.99)] * 1000:>14.2f}'
+                f'{during[len(during) // 2] * 1000:>10.2f}{during[int(len(during) * 0.99)] * 1000:>10.2f}'
+                f'{during[-1] * 1000:>10.0f}{parent_growth / 1024:>12.0f}{child_peak / 1024:>12.0f}')
+    finally:
+        shutil.rmtree(log_dir)
+
+
+def bench_snapshot_apply():
+    keys = 5000000
+    print(f'apply latency while snapshotting a kvserverThreaded store of {keys} keys (200 byte values, about 2 GB)')
+    print('(a batch of 10 entries due every 5 ms, latency counted from when the batch was due)')
+    print(f'{"mode":<13}{"snapshot s":>12}{"p99 before ms":>14}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}'
+          f'{"RSS +MB":>12}{"child MB":>12}')
+    for mode in [raft.SNAPSHOT_BLOCKING, raft.SNAPSHOT_INCREMENTAL, raft.SNAPSHOT_FORK]:
+        _run_in_child('_snapshot_apply', mode, keys, 90)
+
+
+def _child_log_storage(storage, count):
+    # in-memory log of count entries, a list of LogEntry objects or an EntryList
+    count = int(count)
+    entries = [] if storage == 'list' else raft.EntryList()
+    rss_before = _current_rss_kb()
+    start = time.perf_counter()
+    for i in range(0, count, 1024):
+        # fresh entries every batch, like entries decoded from an AppendEntriesRequest
+        entries.extend([LogEntry(f'set key{j} {j}', 1 + j // 1000000, Servers.Server_0) for j in range(i, i + 1024)])
+    append = time.perf_counter() - start
+    size = len(entries)
+    rss = _current_rss_kb() - rss_before
+    positions = [random.randrange(size - 1024) for _ in range(10000)]
+    start = time.perf_counter()
+    for k in positions:
+        for entry in entries[k:k + 1024]:
+            entry.term
+    read_slice = time.perf_counter() - start
+    start = time.perf_counter()
+    for k in positions:
+        entries[k].term
+    read = (time.perf_counter() - start) / len(positions)
+    _report(f'{storage:<10}{size:>12}{rss * 1024 / size:>14.0f}{size / append:>14.0f}'
+            f'{len(positions) * 1024 / read_slice:>18.0f}{read * 1e6:>14.2f}')
+
+
+def bench_log_storage():
+    count = 10000000
+    print(f'in-memory log storage of {count} entries (commands like "set key123 123")')
+    print('(appends in batches of 1024 fresh LogEntry, slices of 1024 entries read back as LogEntry)')
+    print(f'{"storage":<10}{"entries":>12}{"bytes/entry":>14}{"appends/s":>14}{"slice entries/s":>18}{"read us":>14}')
+    for storage in ['list', 'compact']:
+        _run_in_child('_log_storage', storage, count)
+
+
+def _retained_per_object(make, count):
+    # (bytes, allocated blocks, gc tracked objects) that stay allocated per object made by make(), measured with
+    # tracemalloc while count of them are kept alive (like messages sitting in a queue)
+    kept = [None] * count
+    gc.collect()
+    gc.disable()
+    tracemalloc.start()
+    try:
+        size, blocks = tracemalloc.get_traced_memory()[0], sys.getallocatedblocks()
+        tracked = gc.get_count()[0]
+        for i in range(count):
+            kept[i] = make()
+        tracked = gc.get_count()[0] - tracked
+        size, blocks = tracemalloc.get_traced_memory()[0] - size, sys.getallocatedblocks() - blocks
+    finally:
+        tracemalloc.stop()
+        gc.enable()
+    return size / count, blocks / count, tracked / count
+
+
+def bench_messages():
+    print('allocations per message (tracemalloc, 100000 kept alive) and time to build one')
+    print(f'{"message":<34}{"bytes":>8}{"blocks":>8}{"gc objects":>12}{"build ns":>10}')
+    runtime = RaftRunTime()
+    leader, follower = Servers.Server_0, Servers.Server_1
+    response = raft.AppendEntriesResponse(3, True, 1041, runtime.gen_uuid(), follower, leader, runtime.gen_uuid())
+    frame = runtime.object_to_string(response)
+    samples = [
+        ('request id', runtime.gen_uuid),
+        ('ClientAppendRequest', lambda: raft.ClientAppendRequest('set key1 1', runtime.gen_uuid(), leader, leader)),
+        ('AppendEntriesRequest (heartbeat)', lambda: AppendEntriesRequest(3, leader, 1041, 3, [], 1040,
+                                                                          runtime.gen_uuid(), leader, follower)),
+        ('AppendEntriesResponse', lambda: raft.AppendEntriesResponse(3, True, 1041, runtime.gen_uuid(), follower,
+                                                                     leader, runtime.gen_uuid())),
+        ('decoded AppendEntriesResponse', lambda: runtime.string_to_object(frame)),
+        ('LogEntry', lambda: LogEntry('set key1 1', 3, leader)),
+    ]
+    for label, make in samples:
+        size, blocks, tracked = _retained_per_object(make, 100000)
+        build = _timeit(make, 100000) / 100000
+        print(f'{label:<34}{size:>8.0f}{blocks:>8.1f}{tracked:>12.1f}{build * 1e9:>10.0f}')
+    print()
+    print('garbage collection on a local 5-node cluster committing proposals for 10 s (all nodes in one process)')
+    print(f'{"commits/s":>10}{"gen0":>8}{"gen1":>8}{"gen2":>8}{"GC ms/s":>10}{"p99 pause ms":>14}{"max pause ms":>14}')
+    _run_in_child('_leader_gc', 10)
+
+
+def _child_leader_gc(seconds):
+    runtime, server = _start_local_cluster()[Servers.Server_0]
+    time.sleep(1)
+    # time every collection of the process
+    pauses, collections, started = [], [0, 0, 0], [0.0]
+
+    def on_gc(phase, info):
+        if phase == 'start':
+            started[0] = time.perf_counter()
+        else:
+            pauses.append(time.perf_counter() - started[0])
+            collections[info['generation']] += 1
+    gc.collect()
+    gc.callbacks.append(on_gc)
+    first_index = server.log.length()
+    start = time.perf_counter()
+    stop = start + float(seconds)
+    i = 0
+    while time.perf_counter() < stop:
+        # bursts of proposals, the next one once the leader has committed the previous one
+        for _ in range(500):
+            runtime.incoming_queue.put_nowait(raft.ClientAppendRequest(command=f'set key{i} {i}', uuid=runtime.gen_uuid(),
+                                                                       source=server.id, destination=server.id))
+            i += 1
+        while server.log.last_committed_index < first_index + i - 1:
+            time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    gc.callbacks.remove(on_gc)
+    pauses.sort()
+    _report(f'{i / elapsed:>10.0f}{collections[0]:>8}{collections[1]:>8}{collections[2]:>8}'
+            f'{sum(pauses) * 1000 / elapsed:>10.1f}{pauses[int(len(pauses) * 0.99)] * 1000:>14.2f}{pauses[-1] * 1000:>14.2f}')
+
+
+def _process_status(pid):
+    # (threads, RSS MB) of a process
+    with open(f'/proc/{pid}/status') as f:
+        status = dict(line.split(':', 1) for line in f)
+    return int(status['Threads']), int(status['VmRSS'].split()[0]) / 1024
+
+
+async def _kv_set(reader, writer, request):
+    _b = request.encode('utf-8')
+    writer.writelines([message.frame_header(_b), _b])
+    return str(await raft_asyncio.read_frame(reader), 'utf-8')
+
+
+async def _kv_client(address, name, stop, latencies, value=None):
+    # sets keys one request at a time over a connection of its own
+    reader, writer = await asyncio.open_connection(*address)
+    i = 0
+    while time.perf_counter() < stop:
+        start = time.perf_counter()
+        response = await _kv_set(reader, writer, f'set {name}-{i} {value or i}')
+        assert response == message.OK, response
+        latencies.append(time.perf_counter() - start)
+        i += 1
+    writer.close()
+
+
+async def _kv_load(address, clients, seconds, pid, value=None):
+    # returns the latencies of every request and the (threads, RSS MB) of the node half way through
+    latencies = []
+    stop = time.perf_counter() + seconds
+    load = asyncio.gather(*[_kv_client(address, f'c{c}', stop, latencies, value) for c in range(clients)])
+    await asyncio.sleep(seconds / 2)
+    status = _process_status(pid)
+    await load
+    return latencies, status
+
+
+async def _wait_for_leader(address, timeout):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(*address)
+            response = await _kv_set(reader, writer, 'set warmup 1')
+            writer.close()
+            if response == message.OK:
+                return
+        except (OSError, EOFError):
+            pass
+        assert time.perf_counter() < deadline, 'no leader'
+        await asyncio.sleep(0.2)
+
+
+def bench_runtimes():
+    seconds = 5
+    print('threads vs asyncio runtime - a 5-node cluster of processes (python raft.py <n> [--asyncio]), kv clients')
+    print(f'setting keys on the leader for {seconds} s, each client one request at a time on its own connection')
+    print(f'{"runtime":<10}{"clients":>8}{"requests/s":>12}{"p50 ms":>10}{"p99 ms":>10}{"leader threads":>16}{"leader RSS MB":>15}')
+    raft_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'raft.py')
+    address = raft.KV_ADDRESSES[Servers.Server_0]
+    for runtime in [raft.RUNTIME_THREADS, raft.RUNTIME_ASYNCIO]:
+        flags = ['--asyncio'] if runtime == raft.RUNTIME_ASYNCIO else []
+        nodes = [subprocess.Popen([sys.executable, raft_py, str(i)] + flags, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL) for i in range(raft.NUM_OF_SERVERS)]
+        try:
+            asyncio.run(_wait_for_leader(address, 60))
+            for clients in [1, 16, 128]:
+                latencies, (threads, rss) = asyncio.run(_kv_load(address, clients, seconds, nodes[0].pid))
+                latencies.sort()
+                print(f'{runtime:<10}{clients:>8}{len(latencies) / seconds:>12.0f}'
+                      f'{latencies[len(latencies) // 2] * 1000:>10.2f}{latencies[int(len(latencies) * 0.99)] * 1000:>10.2f}'
+                      f'{threads:>16}{rss:>15.0f}')
+        finally:
+            for node in nodes:
+                node.kill()
+                node.wait()
+
+
+def _probe_control_lane(runtime, server, round_trips):
+    # while the node is the leader, times an empty AppendEntriesRequest (a heartbeat, on the control lane) to each
+    # follower in turn every HEARTBEAT_TIMER. A response not back within a second counts as a second
+    followers = [server_id for server_id in Servers if server_id != server.id]
+    while True:
+        for follower_id in followers:
+            time.sleep(runtime.HEARTBEAT_TIMER)
+            if server.role != raft.RaftServerRole.LEADER:
+                continue
+            request_msg = AppendEntriesRequest(server.current_term, server.id, server.log.INIT_INDEX, 0, [],
+                                               server.log.last_committed_index, uuid=runtime.gen_uuid(),
+                                               source=server.id, destination=follower_id, ref_msg_uuid=None)
+            start = time.perf_counter()
+            response_msg = runtime.wait_for_response(request_msg, runtime.send_request(request_msg), 1)
+            round_trips.append(time.perf_counter() - start if response_msg else 1)
+
+
+def _child_control_node(number, seconds, store_delay):
+    # a node of the cluster like python raft.py <number>, with a 250-500 ms election timeout and heartbeats every
+    # 50 ms, that takes store_delay seconds to store every batch of entries it is sent (a slow disk, waited for up to a
+    # second) - the appends the leader keeps sending back up on its data lane. Reports the term it ended up in, the longest it went without
+    # hearing from a leader while a follower and, while the leader, the p50, p99 and longest round trip of its
+    # control lane
+    RaftRunTime.HEARTBEAT_TIMER = 0.05
+    RaftRunTime.ELECTION_TIMEOUT_MIN = 0.25
+    RaftRunTime.ELECTION_TIMEOUT_MAX = 0.5
+    RaftRunTime.APPEND_ENTRIES_RESPONSE_TIMEOUT = 1
+    handle_append_entries = raft.handle_append_entries
+
+    def slow_handle_append_entries(runtime, server, msg):
+        if msg.entries_to_be_appended:
+            time.sleep(float(store_delay))
+        handle_append_entries(runtime, server, msg)
+    raft.handle_append_entries = slow_handle_append_entries
+    server = raft.RaftServer(raft._id_to_servers[int(number)])
+    runtime = RaftRunTime(raft.RaftApplication(kvserverThreaded), server_id=server.id)
+    runtime.setup_network_mesh(server)
+    raft.test_leader_election(runtime, server)
+    raft.kickoff_kv_listener(runtime, server)
+    round_trips = []
+    threading.Thread(target=_probe_control_lane, args=(runtime, server, round_trips), daemon=True).start()
+    silence, stop = 0, time.perf_counter() + float(seconds)
+    while time.perf_counter() < stop:
+        if server.role == raft.RaftServerRole.FOLLOWER and runtime.last_AppendEntriesRequest_leader is not None:
+            silence = max(silence, time.monotonic() - runtime.last_AppendEntriesRequest_time)
+        time.sleep(0.005)
+    round_trips = sorted(round_trips) or [0]
+    _report(f'{server.id.name} {server.current_term} {server.role.name} {silence * 1000:.0f} '
+            f'{round_trips[len(round_trips) // 2] * 1000:.0f} {round_trips[int(len(round_trips) * 0.99)] * 1000:.0f} '
+            f'{round_trips[-1] * 1000:.0f}')
+
+
+def bench_control_under_load():
+    # the p99 round trip of the leader's control lane must stay within max_round_trip_ms while the data lane is
+    # saturated. A heartbeat queued behind the appends the followers have yet to store would wait a whole
+    # REPLICATION_WINDOW of store delays (400 ms)
+    seconds, clients, value, store_delay, max_round_trip_ms = 10, 64, 'v' * 16384, 0.05, 200
+    print(f'elections while {clients} kv clients saturate replication with 16 KB values for {seconds} s - a 5-node cluster')
+    print(f'of processes with a 250-500 ms election timeout, the followers take {store_delay * 1000:.0f} ms to store every')
+    print('append. Server_0 starts as the leader in term 1')
+    nodes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', '_control_node', str(i),
+                               str(seconds + 3), str(store_delay)], stdout=subprocess.PIPE, text=True)
+             for i in range(raft.NUM_OF_SERVERS)]
+    try:
+        address = raft.KV_ADDRESSES[Servers.Server_0]
+        asyncio.run(_wait_for_leader(address, 10))
+        latencies, _ = asyncio.run(_kv_load(address, clients, seconds, nodes[0].pid, value))
+        terms = [node.communicate()[0].split() for node in nodes]
+    finally:
+        for node in nodes:
+            node.kill()
+            node.wait()
+    print(f'{len(latencies) / seconds:.0f} requests/s, {len(latencies) * len(value) / seconds / 1024 / 1024:.1f} MB/s of values')
+    print(f'new terms: {max(int(term) for _, term, _, _, _, _, _ in terms) - 1}')
+    print('longest follower silence: ' + ', '.join(f'{name} {silence} ms' for name, _, _, silence, _, _, _ in terms[1:]))
+    _, _, _, _, p50, p99, longest = terms[0]
+    print(f'leader control lane round trips: p50 {p50} ms, p99 {p99} ms, max {longest} ms')
+    assert latencies, 'no kv request got through, the data lane was never loaded'
+    assert int(p99) <= max_round_trip_ms, \
+        f'control lane p99 round trip {p99} ms under load, more than {max_round_trip_ms} ms'
+
+
+def _report_elections(runtime):
+    # the wall clock time and term are reported whenever the node stands for election and whenever it becomes the
+    # leader (the clock is the one the parent reads, e.g. when it kills a leader)
+    make_leader, to_candidate = runtime.make_leader, runtime.role_change_follower_to_candidate
+
+    def make_reported_leader(server):
+        make_leader(server)
+        _report(f'{time.time()} {server.current_term} leader')
+
+    def reported_to_candidate(server):
+        to_candidate(server)
+        _report(f'{time.time()} {server.current_term} candidate')
+    runtime.make_leader, runtime.role_change_follower_to_candidate = make_reported_leader, reported_to_candidate
+
+
+def _child_failover_node(number, fast_track):
+    # a node of the cluster like python raft.py <number>, reporting its elections
+    server = raft.RaftServer(raft._id_to_servers[int(number)])
+    runtime = RaftRunTime(server_id=server.id)
+    runtime.fast_track = fast_track == '1'
+    _report_elections(runtime)
+    runtime.setup_network_mesh(server)
+    raft.test_leader_election(runtime, server)
+    threading.Event().wait()
+
+
+def _start_reporting_node(child, number, leaders, candidacies, *args):
+    # leaders gets (time, term, number) for every leader the node becomes, candidacies the number of the node every
+    # time it stands for election
+    node = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', child, str(number)] +
+                            [str(arg) for arg in args], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    def read():
+        for line in node.stdout:
+            reported_at, term, role = line.split()
+            if role == 'leader':
+                leaders.put((float(reported_at), int(term), number))
+            else:
+                candidacies.append(number)
+    threading.Thread(target=read, daemon=True).start()
+    return node
+
+
+def bench_failover():
+    rounds, settle = 20, 2
+    print(f'failover: the leader of a 5-node cluster of processes is killed {rounds} times, time from the kill until')
+    print(f'another node becomes the leader. The killed node is restarted and the cluster left to settle for {settle} s')
+    print(f'before the next kill (election timeout {RaftRunTime.ELECTION_TIMEOUT_MIN * 1000:.0f}-'
+          f'{RaftRunTime.ELECTION_TIMEOUT_MAX * 1000:.0f} ms, heartbeats every {RaftRunTime.HEARTBEAT_TIMER * 1000:.0f} ms)')
+    leaders = Queue()
+    nodes = {number: _start_reporting_node('_failover_node', number, leaders, [], int(number == 0))
+             for number in range(raft.NUM_OF_SERVERS)}
+    failovers = []
+    try:
+        _, term, leader = leaders.get(timeout=10)
+        for _ in range(rounds):
+            time.sleep(settle)
+            # the latest leader, the restarted node may have caused an election meanwhile
+            try:
+                while True:
+                    _, new_term, new_leader = leaders.get_nowait()
+                    if new_term > term:
+                        term, leader = new_term, new_leader
+            except Empty:
+                pass
+            killed_at = time.time()
+            nodes[leader].kill()
+            nodes[leader].wait()
+            while True:
+                elected_at, new_term, new_leader = leaders.get(timeout=30)
+                if new_term > term and new_leader != leader:
+                    break
+            failovers.append(elected_at - killed_at)
+            nodes[leader] = _start_reporting_node('_failover_node', leader, leaders, [], 0)
+            term, leader = new_term, new_leader
+    finally:
+        for node in nodes.values():
+            node.kill()
+            node.wait()
+    failovers.sort()
+    print(f'{"min ms":>8}{"p50 ms":>8}{"p90 ms":>8}{"max ms":>8}{"mean ms":>9}')
+    print(f'{failovers[0] * 1000:>8.0f}{statistics.median(failovers) * 1000:>8.0f}'
+          f'{failovers[int(len(failovers) * 0.9)] * 1000:>8.0f}{failovers[-1] * 1000:>8.0f}'
+          f'{statistics.mean(failovers) * 1000:>9.0f}')
+
+
+def _cut_links(runtime, cut):
+    # nothing goes between this node and the peers in cut, the connections stay up (the messages on them are dropped)
+    incoming, outgoing = runtime.incoming_queue.put_nowait, runtime.outgoing_queue.put_nowait
+    complete_request, register_leader_last_contact = runtime.complete_request, raft.register_leader_last_contact
+    runtime.incoming_queue.put_nowait = lambda msg: None if msg.source in cut else incoming(msg)
+    runtime.outgoing_queue.put_nowait = lambda msg: None if msg.destination in cut else outgoing(msg)
+    runtime.complete_request = lambda msg: msg.source in cut or complete_request(msg)
+    raft.register_leader_last_contact = lambda runtime, server, obj: None if obj.source in cut \
+        else register_leader_last_contact(runtime, server, obj)
+
+
+def _child_flapping_node(number, pre_vote):
+    # a node of the cluster like python raft.py <number>, reporting its elections. Its link to a peer
+    # goes down on a 'down <peer number>' line on its stdin, and the links come back up on an 'up' line
+    RaftRunTime.PRE_VOTE = pre_vote == '1'
+    server = raft.RaftServer(raft._id_to_servers[int(number)])
+    runtime = RaftRunTime(raft.RaftApplication(kvserverThreaded), server_id=server.id)
+    _report_elections(runtime)
+    cut = set()
+    _cut_links(runtime, cut)
+
+    def flap():
+        for line in sys.stdin:
+            command = line.split()
+            cut.add(raft._id_to_servers[int(command[1])]) if command[0] == 'down' else cut.clear()
+    threading.Thread(target=flap, daemon=True).start()
+    runtime.setup_network_mesh(server)
+    raft.test_leader_election(runtime, server)
+    raft.kickoff_kv_listener(runtime, server)
+    threading.Event().wait()
+
+
+async def _flapping_cluster(nodes, leaders, seconds, down, up, interval):
+    # every down + up seconds the link between the latest leader and one of its followers flaps, while a client
+    # writes to the latest leader one write at a time -> (leader changes, writes committed, writes failed, longest
+    # time between two committed writes)
+    _, term, leader = leaders.get(timeout=10)
+    latest = {'term': term, 'leader': leader, 'changes': 0}
+    await _wait_for_leader(raft.KV_ADDRESSES[raft._id_to_servers[leader]], 10)
+
+    def refresh():
+        try:
+            while True:
+                _, term, leader = leaders.get_nowait()
+                if term > latest['term']:
+                    latest.update(term=term, leader=leader, changes=latest['changes'] + 1)
+        except Empty:
+            pass
+
+    def command(number, line):
+        nodes[number].stdin.write(line + '\n')
+        nodes[number].stdin.flush()
+
+    async def flap():
+        while True:
+            await asyncio.sleep(up)
+            refresh()
+            leader = latest['leader']
+            follower = Servers.Server_4.value if leader != Servers.Server_4.value else Servers.Server_3.value
+            command(follower, f'down {leader}')
+            await asyncio.sleep(down)
+            command(follower, 'up')
+
+    flapper = asyncio.create_task(flap())
+    ok, failed, connection, connected_to = [time.perf_counter()], 0, None, None
+    stop = time.perf_counter() + seconds
+    while time.perf_counter() < stop:
+        refresh()
+        try:
+            if connection is None or connected_to != latest['leader']:
+                connected_to = latest['leader']
+                connection = await asyncio.open_connection(*raft.KV_ADDRESSES[raft._id_to_servers[connected_to]])
+            response = await asyncio.wait_for(_kv_set(*connection, f'set probe {len(ok)}'), 1)
+            if response == message.OK:
+                ok.append(time.perf_counter())
+            else:
+                failed += 1
+        except (OSError, EOFError, asyncio.TimeoutError):
+            failed, connection = failed + 1, None
+        await asyncio.sleep(interval)
+    flapper.cancel()
+    ok.append(time.perf_counter())
+    return latest['changes'], len(ok) - 2, failed, max(b - a for a, b in zip(ok, ok[1:]))
+
+
+def bench_pre_vote():
+    seconds, down, up, interval = 30, 1.5, 1.5, 1
+    print(f'PreVote: in a 5-node cluster of processes the link between the leader and one follower flaps, down {down} s')
+    print(f'/ up {up} s for {seconds} s, while a client writes to the latest leader every {interval} s')
+    print(f'{"PreVote":<10}{"elections":>11}{"leader changes":>16}{"writes ok":>12}{"writes failed":>15}'
+          f'{"longest gap ms":>16}')
+    disruptions = {}
+    for pre_vote in [False, True]:
+        leaders, candidacies = Queue(), []
+        nodes = [_start_reporting_node('_flapping_node', number, leaders, candidacies, int(pre_vote))
+                 for number in range(raft.NUM_OF_SERVERS)]
+        try:
+            changes, ok, failed, gap = asyncio.run(_flapping_cluster(nodes, leaders, seconds, down, up, interval))
+        finally:
+            for node in nodes:
+                node.kill()
+                node.wait()
+        print(f'{"on" if pre_vote else "off":<10}{len(candidacies):>11}{changes:>16}{ok:>12}{failed:>15}'
+              f'{gap * 1000:>16.0f}')
+        disruptions[pre_vote] = len(candidacies), changes
+    # without PreVote the flapping follower must disrupt the cluster (else the scenario tests nothing), with PreVote
+    # nobody may stand for election and the leader must stay the same
+    assert disruptions[False] != (0, 0), 'the flapping link did not disrupt the cluster even without PreVote'
+    assert disruptions[True] == (0, 0), \
+        f'with PreVote {disruptions[True][0]} elections and {disruptions[True][1]} leader changes, expected none'
+
+
+CHILD_BENCHMARKS = {
+    '_leader_gc': _child_leader_gc,
+    '_log_storage': _child_log_storage,
+    '_snapshot_apply': _child_snapshot_apply,
+    '_install_snapshot': _child_install_snapshot,
+    '_soak': _child_soak,
+    '_restart': _child_restart,
+    '_group_commit': _child_group_commit,
+    '_catch_up_rss': _child_catch_up_rss,
+    '_bytes_per_entry': _child_bytes_per_entry,
+    '_control_node': _child_control_node,
+    '_failover_node': _child_failover_node,
+    '_flapping_node': _child_flapping_node,
+    '_peer_isolation': _child_peer_isolation,
+    '_pipeline_throughput': _child_pipeline_throughput,
+    '_commit_latency_healthy': _child_commit_latency_healthy,
+    '_commit_latency_partitioned': _child_commit_latency_partitioned,
+    '_idle_follower_cpu': _child_idle_follower_cpu,
+    '_idle_leader_cpu': _child_idle_leader_cpu,
+    '_follower_throughput': _child_follower_throughput,
+    '_election': _child_election,
+}
+
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'recv': bench_recv,
+    'send': bench_send,
+    'idle': bench_idle,
+    'commit_latency': bench_commit_latency,
+    'peer_isolation': bench_peer_isolation,
+    'control_under_load': bench_control_under_load,
+    'failover': bench_failover,
+    'election': bench_election,
+    'pre_vote': bench_pre_vote,
+    'pipeline': bench_pipeline,
+    'catch_up': bench_catch_up,
+    'bytes_per_entry': bench_bytes_per_entry,
+    'catch_up_rss': bench_catch_up_rss,
+    'group_commit': bench_group_commit,
+    'wal': bench_wal,
+    'restart': bench_restart,
+    'compaction': bench_compaction,
+    'install_snapshot': bench_install_snapshot,
+    'snapshot_apply': bench_snapshot_apply,
+    'log_storage': bench_log_storage,
+    'messages': bench_messages,
+    'runtimes': bench_runtimes,
+}
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        sys.stdout = open(os.devnull, 'w')
+        CHILD_BENCHMARKS[sys.argv[2]](*sys.argv[3:])
+        sys.stdout.flush()
+        os._exit(0)
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+        print()
@@ -0,0 +1,201 @@
+'''
+Compact binary wire codec for raft messages
+
+Every frame starts with a fixed struct header made of the wire version, the message type id and the
+fixed-width fields of that message type (server ids, flags). The variable part follows and uses
+varints for uuids, terms and indices, length-prefixed utf-8 payloads for commands and length-prefixed
+raw bytes for opaque data (snapshot chunks).
+Only classes registered with the codec can be decoded, so a frame from the network can never
+instantiate arbitrary objects (unlike pickle).
+'''
+import struct
+
+WIRE_VERSION = 1
+
+# field kinds
+UVARINT = 'uvarint'            # non-negative int
+SVARINT = 'svarint'            # signed int (zigzag encoded) e.g. indices which may be INIT_INDEX (-1)
+OPT_UVARINT = 'opt_uvarint'    # non-negative int or None
+STRING = 'string'              # length-prefixed utf-8
+BYTES = 'bytes'                # length-prefixed raw bytes
+BOOL = 'bool'                  # fixed width
+
+
+def enum_of(enum_cls):
+    # fixed width, the enum member is carried as a single byte holding its value
+    # (lookup tables instead of Enum.value / Enum(value) which are slow on the hot path)
+    return 'enum', {m: m.value for m in enum_cls}, {m.value: m for m in enum_cls}
+
+
+def list_of(cls):
+    # count followed by the registered encoding of each element (None is sent as an empty list)
+    return 'list', cls
+
+
+def put_uvarint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def get_uvarint(data, pos):
+    b = data[pos]
+    pos += 1
+    if b < 0x80:
+        return b, pos
+    result = b & 0x7f
+    shift = 7
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def put_svarint(buf, value):
+    put_uvarint(buf, value << 1 if value >= 0 else ((-value) << 1) - 1)
+
+
+def get_svarint(data, pos):
+    value, pos = get_uvarint(data, pos)
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1), pos
+
+
+def _read_opt_uvarint(data, pos):
+    value, pos = get_uvarint(data, pos)
+    return (None if value == 0 else value - 1), pos
+
+
+def _read_string(data, pos):
+    size, pos = get_uvarint(data, pos)
+    end = pos + size
+    if end > len(data):
+        raise IOError('Malformed frame / truncated string')
+    return str(data[pos:end], 'utf-8'), end
+
+
+def _read_bytes(data, pos):
+    size, pos = get_uvarint(data, pos)
+    end = pos + size
+    if end > len(data):
+        raise IOError('Malformed frame / truncated bytes')
+    return bytes(data[pos:end]), end
+
+
+def _write_opt_uvarint(buf, value):
+    put_uvarint(buf, 0 if value is None else value + 1)
+
+
+def _write_string(buf, value):
+    b = value.encode('utf-8')
+    put_uvarint(buf, len(b))
+    buf += b
+
+
+def _write_bytes(buf, value):
+    put_uvarint(buf, len(value))
+    buf += value
+
+
+_READERS = {UVARINT: get_uvarint, SVARINT: get_svarint, OPT_UVARINT: _read_opt_uvarint, STRING: _read_string,
+            BYTES: _read_bytes}
+_WRITERS = {UVARINT: put_uvarint, SVARINT: put_svarint, OPT_UVARINT: _write_opt_uvarint, STRING: _write_string,
+            BYTES: _write_bytes}
+
+
+class _Schema:
+
+    def __init__(self, codec, type_id, cls, fixed_fields, var_fields):
+        self.type_id = type_id
+        self.cls = cls
+        # message header = version + type id + fixed width fields of this message type
+        codes = ''.join('?' if kind == BOOL else 'B' for _, kind in fixed_fields)
+        self.header = struct.Struct('>BB' + codes)
+        self.fixed = struct.Struct('>' + codes)
+        # (attr, to wire value, from wire value) for the fixed fields
+        self.fixed_fields = [(attr, None, None) if kind == BOOL else (attr, kind[1], kind[2]) for attr, kind in fixed_fields]
+        # (attr, writer, reader) for the variable length fields
+        self.var_fields = [(attr, _WRITERS[kind], _READERS[kind]) if kind in _WRITERS else
+                           (attr, codec.list_writer(kind[1]), codec.list_reader(kind[1])) for attr, kind in var_fields]
+
+    def fixed_values(self, obj):
+        return [getattr(obj, attr) if to_wire is None else to_wire[getattr(obj, attr)] for attr, to_wire, _ in self.fixed_fields]
+
+    def write_body(self, buf, obj):
+        buf += self.fixed.pack(*self.fixed_values(obj))
+        for attr, write, _ in self.var_fields:
+            write(buf, getattr(obj, attr))
+
+    def read_body(self, data, pos):
+        obj = self.cls.__new__(self.cls)
+        if self.fixed_fields:
+            values = self.fixed.unpack_from(data, pos)
+            pos += self.fixed.size
+            for (attr, _, from_wire), value in zip(self.fixed_fields, values):
+                setattr(obj, attr, value if from_wire is None else from_wire[value])
+        for attr, _, read in self.var_fields:
+            value, pos = read(data, pos)
+            setattr(obj, attr, value)
+        return obj, pos
+
+
+class MessageCodec:
+
+    def __init__(self, version=WIRE_VERSION):
+        self.version = version
+        self._schemas_by_cls = {}
+        self._schemas_by_id = {}
+
+    def register(self, type_id, cls, fixed_fields=(), var_fields=()):
+        assert 0 < type_id < 256
+        assert type_id not in self._schemas_by_id, f'type id {type_id} already registered'
+        schema = _Schema(self, type_id, cls, tuple(fixed_fields), tuple(var_fields))
+        self._schemas_by_cls[cls] = schema
+        self._schemas_by_id[type_id] = schema
+
+    def list_writer(self, cls):
+        def write(buf, items):
+            items = items or ()
+            put_uvarint(buf, len(items))
+            schema = self._schemas_by_cls[cls]
+            for item in items:
+                schema.write_body(buf, item)
+        return write
+
+    def list_reader(self, cls):
+        def read(data, pos):
+            count, pos = get_uvarint(data, pos)
+            read_body = self._schemas_by_cls[cls].read_body
+            items = []
+            for _ in range(count):
+                item, pos = read_body(data, pos)
+                items.append(item)
+            return items, pos
+        return read
+
+    def encode(self, obj):
+        schema = self._schemas_by_cls.get(type(obj))
+        if schema is None:
+            raise IOError(f'{type(obj)} is not registered with the wire codec')
+        buf = bytearray(schema.header.pack(self.version, schema.type_id, *schema.fixed_values(obj)))
+        for attr, write, _ in schema.var_fields:
+            write(buf, getattr(obj, attr))
+        return bytes(buf)
+
+    def decode(self, data):
+        try:
+            version, type_id = data[0], data[1]
+            if version != self.version:
+                raise IOError(f'Unsupported wire version {version}')
+            schema = self._schemas_by_id.get(type_id)
+            if schema is None:
+                raise IOError(f'Unknown message type {type_id}')
+            obj, pos = schema.read_body(data, 2)
+        except (IndexError, KeyError, struct.error, UnicodeDecodeError, ValueError) as e:
+            raise IOError(f'Malformed frame / {e}')
+        if pos != len(data):
+            raise IOError(f'Malformed frame / {len(data) - pos} trailing bytes')
+        return obj
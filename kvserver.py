@@ -52,7 +52,8 @@ def send_message_to_client(client_socket, message_to_client):
 
 
 def receive_message_from_client(client_socket):
-    message_bytes = recv_message(client_socket)
+    # one request per connection - a small reusable buffer is enough
+    message_bytes = FrameReader(client_socket, KV_RECV_BUFFER_SIZE).read_frame()
     return decode_message_from_network(message_bytes)
 
 
@@ -8,6 +8,9 @@
 
 
 
+import codecs
+import json
+import re
 import threading
 from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
 from message import *
@@ -18,21 +21,139 @@ import instructions
 
 data = {}
 LOCALHOST_ADDR='localhost'
+# keys serialized per write when the store is snapshotted
+SNAPSHOT_CHUNK_KEYS = 10000
+
+# incremental snapshot in progress - keys of the store when it started, how many of them are written and
+# the value each key had when it started, saved before the first change to that key
+snapshot_keys = None
+snapshot_position = 0
+snapshot_preimage = {}
+_MISSING = object()
+_BLANK = re.compile(r'[ \t\n\r]*')
 
 
 def get(key):
     return data.get(key)
 
 
+def _save_preimage(key):
+    if snapshot_keys is not None and key not in snapshot_preimage:
+        snapshot_preimage[key] = data.get(key, _MISSING)
+
+
 def set(key, value):
+    _save_preimage(key)
     data[key]=value
 
 
 def delete(key):
     if key in data:
+        _save_preimage(key)
         del data[key]
 
 
+'''
+snapshots - the store is written as one json object, SNAPSHOT_CHUNK_KEYS keys at a time
+'''
+
+
+def _write_items(write, items, first):
+    # the members of a json object holding just these items
+    chunk = json.dumps(dict(items))[1:-1]
+    if chunk:
+        write((chunk if first else ',' + chunk).encode('utf-8'))
+
+
+def write_snapshot(write):
+    # the whole store in one go (meant for a process forked for the snapshot, where nothing changes the store)
+    write(b'{')
+    keys = iter(data)
+    first = True
+    while True:
+        chunk_keys = [key for _, key in zip(range(SNAPSHOT_CHUNK_KEYS), keys)]
+        if not chunk_keys:
+            break
+        _write_items(write, ((key, data[key]) for key in chunk_keys), first)
+        first = False
+    write(b'}')
+
+
+def begin_snapshot(write):
+    # starts a snapshot of the store as it is now, written a chunk at a time by continue_snapshot().
+    # Changes made meanwhile save the old value of the keys they touch until the snapshot is done
+    global snapshot_keys, snapshot_position, snapshot_preimage
+    snapshot_keys, snapshot_position, snapshot_preimage = list(data), 0, {}
+    write(b'{')
+
+
+def continue_snapshot(write, max_keys):
+    # writes the next max_keys keys of the snapshot, returns True once it is complete
+    global snapshot_keys, snapshot_position, snapshot_preimage
+    chunk_keys = snapshot_keys[snapshot_position:snapshot_position + max_keys]
+    _write_items(write, ((key, snapshot_preimage[key] if key in snapshot_preimage else data[key]) for key in chunk_keys),
+                 snapshot_position == 0)
+    snapshot_position += len(chunk_keys)
+    if snapshot_position < len(snapshot_keys):
+        return False
+    write(b'}')
+    snapshot_keys, snapshot_position, snapshot_preimage = None, 0, {}
+    return True
+
+
+def abort_snapshot():
+    global snapshot_keys, snapshot_position, snapshot_preimage
+    snapshot_keys, snapshot_position, snapshot_preimage = None, 0, {}
+
+
+def snapshot_items(chunks):
+    # (key, value) of the json object written by a snapshot, decoded as its chunks come in. A member that runs
+    # past the text read so far (a number cut at the end of a chunk looks complete) is decoded again with the
+    # next chunk
+    scan = json.JSONDecoder().scan_once
+    blank = _BLANK.match
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    text, start, opened, eof = '', 0, False, False
+    while True:
+        try:
+            if not opened:
+                pos = blank(text, 0).end()
+                if eof and pos == len(text):
+                    return
+                if text[pos] != '{':
+                    raise ValueError('Malformed snapshot')
+                pos = blank(text, pos + 1).end()
+                if text[pos] == '}':
+                    return
+                opened, start = True, pos
+            key, pos = scan(text, blank(text, start).end())
+            pos = blank(text, pos).end()
+            if text[pos] != ':':
+                raise ValueError('Malformed snapshot')
+            value, pos = scan(text, blank(text, pos + 1).end())
+            pos = blank(text, pos).end()
+            separator = text[pos]
+            if separator != ',' and separator != '}':
+                raise ValueError('Malformed snapshot')
+            yield key, value
+            if separator == '}':
+                return
+            start = pos + 1
+        except (ValueError, IndexError, StopIteration):
+            if eof:
+                raise ValueError('Malformed snapshot')
+            chunk = next(chunks, None)
+            eof = chunk is None
+            text, start = text[start:] + utf8.decode(chunk or b'', eof), 0
+
+
+def restore(chunks):
+    # one item at a time, the snapshot is never in memory as a whole
+    data.clear()
+    data.update(snapshot_items(chunks))
+
+
 def execute_instruction(instruction):
     if isinstance(instruction, list) and len(instruction) > 0:
         if instruction[0].upper() == instructions.SET_COMMAND:
@@ -69,7 +190,8 @@ def send_message_to_client(client_socket, message_to_client):
 
 
 def receive_message_from_client(client_socket):
-    message_bytes = recv_message(client_socket)
+    # one request per connection - a small reusable buffer is enough
+    message_bytes = FrameReader(client_socket, KV_RECV_BUFFER_SIZE).read_frame()
     return decode_message_from_network(message_bytes)
 
 
@@ -7,6 +7,9 @@ REQUEST_FORMAT_ERROR="Request format not supported"
 VALUE_TYPE_NOT_SUPPORTED="Value type not supported"
 REQUEST_COULD_NOT_BE_EXECUTED="Request could not be executed"
 UTF_8='utf-8'
+HEADER_SIZE = 10
+RECV_BUFFER_SIZE = 64 * 1024
+KV_RECV_BUFFER_SIZE = 4 * 1024
 
 
 def encode_message_for_network_transfer(message, char_set=UTF_8):
@@ -16,13 +19,56 @@ def encode_message_for_network_transfer(message, char_set=UTF_8):
 
 def decode_message_from_network(message_bytes, char_set=UTF_8):
     if message_bytes:
-        return message_bytes.decode(char_set).strip()
+        return str(message_bytes, char_set).strip()
+
+
+# upper bound on the buffers handed to a single sendmsg() (IOV_MAX is 1024 on linux)
+MAX_IOVECS = 512
+
+
+def frame_header(msg):
+    return b'%10d' % len(msg)    # Make a HEADER_SIZE (10-byte) length field
 
 
 def send_message(sock, msg):
-    size = b'%10d' % len(msg)    # Make a 10-byte length field
-    sock.sendall(size)
-    sock.sendall(msg)
+    # header and body go out in one vectored write
+    sendmsg_all(sock, [frame_header(msg), msg])
+
+
+def send_messages(sock, msgs):
+    # several frames for the same peer coalesced into as few vectored writes as possible
+    buffers = []
+    for msg in msgs:
+        buffers.append(frame_header(msg))
+        buffers.append(msg)
+    sendmsg_all(sock, buffers)
+
+
+def sendmsg_all(sock, buffers):
+    if not hasattr(sock, 'sendmsg'):
+        # no scatter/gather on this platform (e.g. windows), fall back to a single sendall of the joined buffers
+        sock.sendall(b''.join(buffers))
+        return
+    if len(buffers) <= MAX_IOVECS:
+        # common case, everything fits in the socket buffer in one go
+        sent = sock.sendmsg(buffers)
+        if sent == sum(map(len, buffers)):
+            return
+    else:
+        sent = 0
+    buffers = [memoryview(b) for b in buffers if len(b)]
+    while buffers:
+        # drop what went out completely and trim a partially sent buffer
+        i = 0
+        while i < len(buffers) and sent >= len(buffers[i]):
+            sent -= len(buffers[i])
+            i += 1
+        del buffers[:i]
+        if sent:
+            buffers[0] = buffers[0][sent:]
+            sent = 0
+        if buffers:
+            sent = sock.sendmsg(buffers[:MAX_IOVECS])
 
 
 def recv_exactly(sock, nbytes):
@@ -38,5 +84,70 @@ def recv_exactly(sock, nbytes):
 
 
 def recv_message(sock):
-    size = int(recv_exactly(sock, 10))
+    size = int(recv_exactly(sock, HEADER_SIZE))
     return recv_exactly(sock, size)
+
+
+class FrameReader:
+    '''
+    Buffered reader of length-prefixed frames. Reads from the socket into a reusable bytearray with
+    recv_into() and hands out memoryview slices of complete frames, so a frame is never copied on the
+    way in. Several frames arriving together are returned from a single syscall.
+    A returned frame is only valid until the next call to read_frames() / read_frame().
+    '''
+
+    def __init__(self, sock, buffer_size=RECV_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0              # first byte not handed out yet
+        self.end = 0                # end of the bytes received so far
+        self.needed = HEADER_SIZE   # size (header included) of the frame being assembled
+
+    def read_frames(self):
+        frames = self._complete_frames()
+        while not frames:
+            self._fill()
+            frames = self._complete_frames()
+        return frames
+
+    def read_frame(self):
+        # only for one request per connection, frames after the first one are dropped
+        return self.read_frames()[0]
+
+    def _complete_frames(self):
+        frames = []
+        while True:
+            available = self.end - self.start
+            if available < HEADER_SIZE:
+                self.needed = HEADER_SIZE
+                break
+            size = int(self.buffer[self.start:self.start + HEADER_SIZE])
+            self.needed = HEADER_SIZE + size
+            if available < self.needed:
+                break
+            body_start = self.start + HEADER_SIZE
+            frames.append(self.view[body_start:body_start + size])
+            self.start = body_start + size
+        return frames
+
+    def _fill(self):
+        pending = self.end - self.start
+        if self.needed > len(self.buffer) or (pending == 0 and len(self.buffer) > self.buffer_size):
+            # grow for a frame bigger than the buffer, or shrink back once the big frame is consumed
+            buffer = bytearray(max(self.needed, self.buffer_size))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+            self.start, self.end = 0, pending
+        elif self.start > 0 and len(self.buffer) - self.start < self.needed:
+            # move the partial frame to the front of the buffer
+            self.buffer[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        elif pending == 0:
+            self.start = self.end = 0
+        nbytes = self.sock.recv_into(self.view[self.end:])
+        if nbytes == 0:
+            raise IOError("Incomplete message")
+        self.end += nbytes
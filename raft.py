@@ -1,11 +1,21 @@
+import os
 import sys
+import tempfile
 import threading
 import time
 from enum import Enum
 from queue import Queue, Empty
-import uuid
+from array import array
+from collections import deque
+from itertools import accumulate, count, islice
+from concurrent import futures
 import pickle
-from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+from socket import socket, create_connection, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SO_KEEPALIVE, IPPROTO_TCP
+try:
+    from socket import TCP_KEEPIDLE, TCP_KEEPINTVL, TCP_KEEPCNT
+except ImportError:
+    # not available everywhere, keepalive probes then go with the system timings
+    TCP_KEEPIDLE = TCP_KEEPINTVL = TCP_KEEPCNT = None
 import time
 import instructions
 import random
@@ -13,12 +23,34 @@ from datetime import datetime
 
 
 import message
+import codec
+import wal
+
+# approximate wire size of a log entry besides its command (term, inserted_by, length prefix)
+LOG_ENTRY_WIRE_OVERHEAD = 8
 
 LOG_APPEND_FAILURE = -1
 LOG_APPEND_SUCCESS = 0
 
 NUM_OF_SERVERS = 5
 
+# request ids carry the server that made them in the bits above these (the ones below count microseconds, 2^56 of
+# them last for over 2000 years)
+REQUEST_ID_SERVER_SHIFT = 56
+
+WIRE_FORMAT_BINARY = 'binary'
+WIRE_FORMAT_PICKLE = 'pickle'
+
+# how the state machine gets written to a snapshot
+SNAPSHOT_FORK = 'fork'                  # by a forked child, off a copy-on-write image of the process
+SNAPSHOT_INCREMENTAL = 'incremental'    # a chunk after each batch of applied entries
+SNAPSHOT_BLOCKING = 'blocking'          # all at once, applying waits for it
+
+# priority lanes of the queues and peer connections, control messages always go first
+LANE_CONTROL = 'control'    # votes, heartbeats, responses, timer ticks
+LANE_DATA = 'data'          # log entries, snapshot chunks, client requests
+LANES = (LANE_CONTROL, LANE_DATA)
+
 
 class Servers(Enum):
     Server_0 = 0
@@ -44,6 +76,20 @@ SERVER_ADDRESSES = {
     Servers.Server_4: ('127.0.0.1', 18000),
 }
 
+# where each server takes requests from kv clients (see kvclient.py)
+KV_ADDRESSES = {
+    Servers.Server_0: ('127.0.0.1', 14001),
+    Servers.Server_1: ('127.0.0.1', 15001),
+    Servers.Server_2: ('127.0.0.1', 16001),
+    Servers.Server_3: ('127.0.0.1', 17001),
+    Servers.Server_4: ('127.0.0.1', 18001),
+}
+
+# how a node runs - a thread per loop, connection and request (RaftRunTime) or a single asyncio event loop
+# (raft_asyncio.AsyncRaftRunTime)
+RUNTIME_THREADS = 'threads'
+RUNTIME_ASYNCIO = 'asyncio'
+
 
 class RaftServerRole(Enum):
     LEADER = 0
@@ -55,14 +101,20 @@ class RaftServer:
 
     INIT_INDEX = -1
 
-    def __init__(self, id, current_term=0, role=RaftServerRole.FOLLOWER, leader=None):
+    def __init__(self, id, current_term=0, role=RaftServerRole.FOLLOWER, leader=None, log_dir=None):
         self.id = id
         self.current_term = current_term
         self.role = role
-        self.log = RaftPersistentLog(self)
+        self.log = RaftPersistentLog(self, log_dir)
+        if self.log.wal is not None:
+            # restarted from disk
+            self.current_term = self.log.wal.current_term
         self.next_index = []
         self.match_index = []
-        self.last_applied_index = self.INIT_INDEX
+        # whether the leader knows where each follower's log matches its own (i.e. no probing needed)
+        self.follower_matched = []
+        # everything in the snapshot of a log restarted from disk is applied once the snapshot is restored
+        self.last_applied_index = self.log.last_included_index
 
     def fetch_peer_ids(self):
         peers = []
@@ -81,6 +133,8 @@ class RaftServer:
 
 
 class LogEntry:
+    # slotted like the messages, there is one of these for every entry read from the log or off the wire
+    __slots__ = ('term', 'command', 'inserted_by')
 
     def __init__(self, command, term, inserted_by):
         self.term = term
@@ -92,21 +146,390 @@ class LogEntry:
         # return f'[term={self.term} | {self.command} | o={self.inserted_by} ]'
 
 
+class EntryList:
+    '''
+    Compact list of log entries - the terms in an array('q'), the servers that inserted them in an array('B')
+    and the utf-8 encoded commands back to back in one buffer, with the offset each of them starts at.
+    A LogEntry is only materialized when an item is read.
+
+    Supports len(), [i], [start:stop] (another EntryList), iteration, extend(), del [i:] and del [:i], like a list
+    '''
+
+    def __init__(self, entries=()):
+        self.terms = array('q')
+        self.inserted_by = array('B')
+        self.commands = bytearray()
+        # the command of item k is commands[offsets[k] - origin:offsets[k + 1] - origin]. Offsets are not rebased
+        # when items are deleted from the front, origin moves instead
+        self.offsets = array('q', [0])
+        self.origin = 0
+        self.extend(entries)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            assert step == 1
+            stop = max(start, stop)
+            items = EntryList()
+            items.terms = self.terms[start:stop]
+            items.inserted_by = self.inserted_by[start:stop]
+            items.commands = self.commands[self.offsets[start] - self.origin:self.offsets[stop] - self.origin]
+            items.offsets = self.offsets[start:stop + 1]
+            items.origin = self.offsets[start]
+            return items
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(f'item {key} is not in the list')
+        command = self.commands[self.offsets[key] - self.origin:self.offsets[key + 1] - self.origin]
+        return LogEntry(command.decode('utf-8'), self.terms[key], _id_to_servers[self.inserted_by[key]])
+
+    def term(self, key):
+        # term of an item without materializing it
+        return self.terms[key]
+
+    def size_bytes(self, start=0, stop=None):
+        # size of the items start..stop on the wire, from the offsets alone (nothing is copied or decoded)
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        return self.offsets[stop] - self.offsets[start] + (stop - start) * LOG_ENTRY_WIRE_OVERHEAD
+
+    def __iter__(self):
+        # (no memoryview of commands here, it would stop the buffer from growing while the iteration is going on)
+        commands, offsets, origin = self.commands, self.offsets, self.origin
+        for k, (term, inserted_by) in enumerate(zip(self.terms, self.inserted_by)):
+            yield LogEntry(commands[offsets[k] - origin:offsets[k + 1] - origin].decode('utf-8'), term,
+                           _id_to_servers[inserted_by])
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def extend(self, items):
+        end = self.offsets[-1]
+        if isinstance(items, EntryList):
+            self.terms.extend(items.terms)
+            self.inserted_by.extend(items.inserted_by)
+            self.commands += items.commands
+            self.offsets.extend(map((end - items.origin).__add__, islice(items.offsets, 1, None)))
+            return
+        items = list(items)
+        commands = [item.command.encode('utf-8') for item in items]
+        self.terms.extend(item.term for item in items)
+        self.inserted_by.extend(item.inserted_by.value for item in items)
+        self.commands += b''.join(commands)
+        self.offsets.extend(islice(accumulate(map(len, commands), initial=end), 1, None))
+
+    def __delitem__(self, key):
+        assert isinstance(key, slice) and key.step is None and (key.start is None or key.stop is None)
+        if key.stop is None:
+            # truncation of the end of the list
+            start = min(key.start or 0, len(self))
+            del self.commands[self.offsets[start] - self.origin:]
+            del self.terms[start:]
+            del self.inserted_by[start:]
+            del self.offsets[start + 1:]
+        else:
+            # removal of the first items (compaction)
+            stop = min(key.stop, len(self))
+            del self.commands[:self.offsets[stop] - self.origin]
+            self.origin = self.offsets[stop]
+            del self.terms[:stop]
+            del self.inserted_by[:stop]
+            del self.offsets[:stop]
+
+
 class RaftPersistentLog:
     INIT_INDEX = -1
-
-    def __init__(self, owner_server):
+    # write-ahead log settings, used when the log is given a directory
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    FSYNC_POLICY = wal.FSYNC_BATCH
+    FSYNC_INTERVAL = 0.01
+    # log compaction - a snapshot of the state machine is taken once the log holds more than SNAPSHOT_ENTRIES
+    # entries or SNAPSHOT_BYTES bytes (0 turns a trigger off). The last SNAPSHOT_TRAILING_ENTRIES applied entries
+    # stay in the log, so a follower that is only a little behind still catches up from the log
+    SNAPSHOT_ENTRIES = 100000
+    SNAPSHOT_BYTES = 64 * 1024 * 1024
+    SNAPSHOT_TRAILING_ENTRIES = 1000
+
+    def __init__(self, owner_server, log_dir=None):
         assert isinstance(owner_server, RaftServer)
-        self.log_entries = []
+        self.log_entries = EntryList()
         self.server = owner_server
         self.last_committed_index = self.INIT_INDEX
+        # log_entries[k] is the entry at index base_index + 1 + k, the entries up to base_index have been compacted.
+        # base_term is the term of the entry at base_index
+        self.base_index = self.INIT_INDEX
+        self.base_term = 0
+        # last entry covered by the snapshot of the state machine
+        self.last_included_index = self.INIT_INDEX
+        self.last_included_term = 0
+        # snapshot file of a log without a directory (a temporary file, None until the first snapshot)
+        self.snapshot_path = None
+        # approximate size of the entries in the log (in memory only, the write-ahead log knows its own size)
+        self.log_bytes = 0
+        # compaction moves base_index and log_entries together, readers must not see one without the other
+        self.lock = threading.RLock()
+        # snapshot being received from the leader (a wal.SnapshotWriter)
+        self.incoming_snapshot = None
+        # without a directory the log only lives in memory
+        self.wal = None
+        if log_dir:
+            self.wal = wal.SegmentedLog(log_dir, self.SEGMENT_SIZE, self.FSYNC_POLICY, self.FSYNC_INTERVAL)
+            self.last_included_index, self.last_included_term, self.base_index, self.base_term = self.wal.snapshot_info
+            # snapshots only ever cover committed entries
+            self.last_committed_index = self.last_included_index
+            if not self.wal.first_index() <= self.base_index + 1 <= len(self.wal):
+                # a crash while installing a snapshot from the leader, between saving it and resetting the log
+                self.wal.reset(self.base_index + 1)
+            # entries are read from the memory-mapped segments when needed instead of all being loaded up front
+            self.log_entries = wal.RecordList(self.wal, wire_codec.encode, wire_codec.decode, self.base_index + 1,
+                                              EntryList)
+
+    '''
+    offset-aware access, every index is a log index (compacted entries included)
+    '''
+
+    def length(self):
+        # index right after the last entry
+        with self.lock:
+            return self.base_index + 1 + len(self.log_entries)
+
+    def last_index(self):
+        return self.length() - 1
+
+    def entry(self, index):
+        with self.lock:
+            if index <= self.base_index:
+                raise IndexError(f'Entry {index} has been compacted into a snapshot')
+            return self.log_entries[index - self.base_index - 1]
+
+    def entries(self, start, stop):
+        # entries from index start up to stop
+        with self.lock:
+            if start <= self.base_index:
+                raise IndexError(f'Entry {start} has been compacted into a snapshot')
+            return self.log_entries[start - self.base_index - 1:stop - self.base_index - 1]
+
+    def term_at(self, index):
+        # term of the entry at index, also known for the entry right before the log (INIT_INDEX has term 0)
+        with self.lock:
+            if index == self.base_index:
+                return self.base_term
+            if index == self.last_included_index:
+                return self.last_included_term
+            if index <= self.base_index:
+                raise IndexError(f'Entry {index} has been compacted into a snapshot')
+            return self._term(index - self.base_index - 1)
+
+    def _term(self, position):
+        # term of log_entries[position], without materializing the entry when the storage allows it
+        if isinstance(self.log_entries, EntryList):
+            return self.log_entries.term(position)
+        return self.log_entries[position].term
+
+    def size_bytes(self):
+        if self.wal is not None:
+            return self.wal.bytes_between(self.base_index + 1, self.length())
+        return self.log_bytes
+
+    def append(self, start_index, entries):
+        # entries[k] goes to index start_index + k. Entries the log already holds at those indices are kept
+        # (the caller has checked that they match). With a write-ahead log they are on disk before they become visible
+        with self.lock:
+            assert self.base_index < start_index <= self.length()
+            new_entries = entries[self.length() - start_index:]
+            if new_entries:
+                self.log_entries.extend(new_entries)
+                if self.wal is None:
+                    self.log_bytes += entries_size_bytes(self.log_entries, -len(new_entries))
+
+    def truncate(self, index):
+        # drops the entries from index onwards
+        with self.lock:
+            assert index > self.base_index
+            if self.wal is None:
+                self.log_bytes -= entries_size_bytes(self.log_entries, index - self.base_index - 1)
+            del self.log_entries[index - self.base_index - 1:]
+
+    def compact(self, last_included_index, snapshot, base_index):
+        # saves the snapshot of the state machine covering the entries up to last_included_index,
+        # then drops the entries up to base_index (<= last_included_index) from the log
+        writer = self.begin_compaction(last_included_index, base_index)
+        writer.write(snapshot)
+        writer.finish()
+        self.finish_compaction(writer)
+
+    def begin_compaction(self, last_included_index, base_index):
+        # writer for the snapshot of the state machine covering the entries up to last_included_index.
+        # Once the state machine is written to it (and finished), finish_compaction() saves it and drops the entries
+        # up to base_index. The log keeps going meanwhile
+        with self.lock:
+            assert self.base_index <= base_index <= last_included_index <= self.last_index()
+            info = (last_included_index, self.term_at(last_included_index), base_index, self.term_at(base_index))
+            if self.wal is not None:
+                return self.wal.snapshot_writer(*info, suffix='.compacting')
+            fd, path = tempfile.mkstemp(prefix='raft-snapshot-')
+            os.close(fd)
+            return wal.SnapshotWriter(path, *info)
+
+    def finish_compaction(self, writer):
+        with self.lock:
+            last_included_index, last_included_term, base_index, base_term = writer.info
+            if last_included_index <= self.last_included_index or base_index < self.base_index:
+                # a newer snapshot came from the leader meanwhile
+                self.discard_snapshot_writer(writer)
+                return
+            # the snapshot is saved before the entries it replaces are gone
+            self._publish_snapshot(writer)
+            if self.wal is None:
+                self.log_bytes -= entries_size_bytes(self.log_entries, 0, base_index - self.base_index)
+            del self.log_entries[:base_index - self.base_index]
+            self.base_index, self.base_term = base_index, base_term
+            self.last_included_index, self.last_included_term = last_included_index, last_included_term
+
+    def discard_snapshot_writer(self, writer):
+        writer.abort()
+        if self.wal is None:
+            os.remove(writer.path)
+
+    def _publish_snapshot(self, writer):
+        # a finished snapshot becomes the saved snapshot, a log without a directory keeps it in its temporary file
+        # (readers of the one it replaces keep it open until they are done)
+        if self.wal is not None:
+            self.wal.install_snapshot(writer)
+            return
+        writer.publish()
+        if self.snapshot_path is not None:
+            os.remove(self.snapshot_path)
+        self.snapshot_path = writer.path
+
+    def snapshot_reader(self):
+        # reads the current snapshot in chunks, unaffected by a later compaction. None if there is no snapshot
+        with self.lock:
+            if self.wal is not None:
+                return self.wal.snapshot_reader()
+            return wal.SnapshotReader(self.snapshot_path) if self.snapshot_path is not None else None
+
+    def snapshot_chunks(self):
+        # the state machine of the current snapshot a chunk at a time (nothing if there is none), the snapshot is
+        # never in memory as a whole
+        reader = self.snapshot_reader()
+        if reader is None:
+            return
+        try:
+            yield from reader.chunks()
+        finally:
+            reader.close()
+
+    def receive_snapshot_chunk(self, last_included_index, last_included_term, offset, data):
+        # stores a chunk of the snapshot streamed by the leader straight to disk and returns how many bytes of that
+        # snapshot are stored. A chunk at offset 0 starts over, a chunk that does not continue what is stored is dropped
+        with self.lock:
+            if offset == 0:
+                self.abort_received_snapshot()
+                self.incoming_snapshot = self._snapshot_writer(last_included_index, last_included_term)
+            writer = self.incoming_snapshot
+            if writer is None or writer.info[:2] != (last_included_index, last_included_term):
+                return 0
+            if offset == writer.size:
+                writer.write(data)
+            return writer.size
+
+    def _snapshot_writer(self, last_included_index, last_included_term):
+        # the log continues right after a snapshot received from the leader
+        if self.wal is not None:
+            return self.wal.snapshot_writer(last_included_index, last_included_term, last_included_index,
+                                            last_included_term)
+        fd, path = tempfile.mkstemp(prefix='raft-snapshot-')
+        os.close(fd)
+        return wal.SnapshotWriter(path, last_included_index, last_included_term, last_included_index, last_included_term)
+
+    def abort_received_snapshot(self):
+        with self.lock:
+            if self.incoming_snapshot is not None:
+                self.discard_snapshot_writer(self.incoming_snapshot)
+                self.incoming_snapshot = None
+
+    def install_received_snapshot(self):
+        # the snapshot received from the leader replaces the log up to its last included entry. The entries after
+        # it are kept if the log holds that same entry, otherwise the whole log goes
+        with self.lock:
+            writer, self.incoming_snapshot = self.incoming_snapshot, None
+            last_included_index, last_included_term = writer.info[:2]
+            keep = self.base_index < last_included_index < self.length() and \
+                self.term_at(last_included_index) == last_included_term
+            writer.finish()
+            self._publish_snapshot(writer)
+            if keep:
+                if self.wal is None:
+                    self.log_bytes -= entries_size_bytes(self.log_entries, 0, last_included_index - self.base_index)
+                del self.log_entries[:last_included_index - self.base_index]
+            elif self.wal is not None:
+                self.wal.reset(last_included_index + 1)
+                self.log_entries = wal.RecordList(self.wal, wire_codec.encode, wire_codec.decode, last_included_index + 1,
+                                                  EntryList)
+            else:
+                self.log_entries = EntryList()
+                self.log_bytes = 0
+            self.base_index, self.base_term = last_included_index, last_included_term
+            self.last_included_index, self.last_included_term = last_included_index, last_included_term
+            self.last_committed_index = max(self.last_committed_index, last_included_index)
+
+    def save_state(self, current_term, voted_for):
+        # current term and the latest vote (voted_for maps a term to the candidate voted for)
+        if self.wal is not None:
+            vote_term = max(voted_for, default=self.INIT_INDEX)
+            candidate = voted_for[vote_term].value if vote_term in voted_for else self.INIT_INDEX
+            self.wal.save_metadata(current_term, vote_term, candidate)
+
+    def first_index_of_term(self, term):
+        # terms never decrease along the log, so every term occupies one contiguous run found by binary search
+        # (within the entries that have not been compacted)
+        with self.lock:
+            lo, hi = 0, len(self.log_entries)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._term(mid) < term:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < len(self.log_entries) and self._term(lo) == term:
+                return self.base_index + 1 + lo
+            return self.INIT_INDEX
+
+    def last_index_of_term(self, term):
+        with self.lock:
+            lo, hi = 0, len(self.log_entries)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._term(mid) <= term:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo > 0 and self._term(lo - 1) == term:
+                return self.base_index + lo
+            return self.INIT_INDEX
 
     def dump(self):
-        print(f'{log.server.id} - {log.server.role}')
-        print(f'        log [{len(self.log_entries)} items] => {self.log_entries}')
+        print(f'{self.server.id} - {self.server.role}')
+        print(f'        log [{self.length()} items, {self.base_index + 1} compacted] => {self.log_entries}')
+
+
+def entries_size_bytes(entries, start=0, stop=None):
+    # size of entries[start:stop] on the wire. An EntryList counts it from its offsets, without copying the items
+    # (this runs under the log lock, for a compaction that can be most of the log)
+    if isinstance(entries, EntryList):
+        return entries.size_bytes(start, stop)
+    return sum(len(entry.command.encode('utf-8')) + LOG_ENTRY_WIRE_OVERHEAD for entry in entries[start:stop])
 
 
 class RaftMessage:
+    # messages are created and dropped by the thousand per second on a busy leader - no instance dict,
+    # every subclass declares the slots of its own fields
+    __slots__ = ('uuid', 'source', 'destination', 'ref_msg_uuid')
 
     def __init__(self, uuid, source, destination, ref_msg_uuid=None):
         self.uuid = uuid
@@ -119,6 +542,8 @@ class RaftMessage:
 
 
 class ClientAppendRequest(RaftMessage):
+    __slots__ = ('command',)
+
     def __init__(self, command, uuid, source, destination, ref_msg_uuid=None):
         super().__init__(uuid, source, destination, ref_msg_uuid)
         self.command = command
@@ -128,6 +553,8 @@ class ClientAppendRequest(RaftMessage):
 
 
 class ClientAppendResponse(RaftMessage):
+    __slots__ = ()
+
     def __init__(self, uuid, source, destination, ref_msg_uuid=None):
         super().__init__(uuid, source, destination, ref_msg_uuid)
 
@@ -136,6 +563,7 @@ class ClientAppendResponse(RaftMessage):
 
 
 class TriggerCommit(RaftMessage):
+    __slots__ = ()
 
     def __init__(self, uuid, source, destination):
         super().__init__(uuid, source, destination)
@@ -145,6 +573,7 @@ class TriggerCommit(RaftMessage):
 
 
 class ElectionTimeout(RaftMessage):
+    __slots__ = ()
 
     def __init__(self, uuid, source, destination):
         super().__init__(uuid, source, destination)
@@ -154,6 +583,7 @@ class ElectionTimeout(RaftMessage):
 
 
 class HeartBeatTick(RaftMessage):
+    __slots__ = ()
 
     def __init__(self, uuid, source, destination):
         super().__init__(uuid, source, destination)
@@ -163,6 +593,9 @@ class HeartBeatTick(RaftMessage):
 
 
 class AppendEntriesRequest(RaftMessage):
+    __slots__ = ('leader_term', 'leader_id', 'leader_prev_log_index', 'leader_prev_log_term',
+                 'entries_to_be_appended', 'leader_last_commit_index')
+
     def __init__(self, leader_term, leader_id, leader_prev_log_index, leader_prev_log_term, entries_to_be_appended,
                  leader_last_commit_index, uuid, source, destination, ref_msg_uuid=None):
         super().__init__(uuid, source, destination, ref_msg_uuid)
@@ -178,24 +611,100 @@ class AppendEntriesRequest(RaftMessage):
 
 
 class AppendEntriesResponse(RaftMessage):
-    def __init__(self, follower_current_term, success, match_index, uuid, source, destination, ref_msg_uuid=None):
+    __slots__ = ('follower_current_term', 'success', 'match_index', 'conflict_term', 'conflict_index')
+
+    def __init__(self, follower_current_term, success, match_index, uuid, source, destination, ref_msg_uuid=None,
+                 conflict_term=-1, conflict_index=-1):
         super().__init__(uuid, source, destination, ref_msg_uuid)
         self.success = success
         self.follower_current_term = follower_current_term
         self.match_index = match_index
+        # on a rejection - the term of the follower's entry at leader_prev_log_index and the first index of that
+        # term in the follower's log (conflict_term=-1 means the follower's log is shorter, conflict_index=its length)
+        self.conflict_term = conflict_term
+        self.conflict_index = conflict_index
 
     def __repr__(self):
-        return f'AppendEntriesResponse -> follower_term={self.follower_current_term} / success = {self.success} / ref={self.ref_msg_uuid}'
+        return f'AppendEntriesResponse -> follower_term={self.follower_current_term} / success = {self.success} / ref={self.ref_msg_uuid} / conflict_term={self.conflict_term} / conflict_index={self.conflict_index}'
+
+
+class InstallSnapshotRequest(RaftMessage):
+    __slots__ = ('leader_term', 'leader_id', 'last_included_index', 'last_included_term', 'offset', 'data',
+                 'done')
+
+    def __init__(self, leader_term, leader_id, last_included_index, last_included_term, offset, data, done,
+                 uuid, source, destination, ref_msg_uuid=None):
+        super().__init__(uuid, source, destination, ref_msg_uuid)
+        self.leader_term = leader_term
+        self.leader_id = leader_id
+        self.last_included_index = last_included_index
+        self.last_included_term = last_included_term
+        # a chunk of the snapshot - data goes at offset, done marks the last chunk
+        self.offset = offset
+        self.data = data
+        self.done = done
+
+    def __repr__(self):
+        return f'InstallSnapshotRequest -> {super().__repr__()} / {self.leader_id} / last_included_index={self.last_included_index} / offset={self.offset} / {len(self.data)} bytes / done={self.done}'
+
+
+class InstallSnapshotResponse(RaftMessage):
+    __slots__ = ('follower_current_term', 'offset', 'installed')
+
+    def __init__(self, follower_current_term, offset, installed, uuid, source, destination, ref_msg_uuid=None):
+        super().__init__(uuid, source, destination, ref_msg_uuid)
+        self.follower_current_term = follower_current_term
+        # bytes of the snapshot the follower has stored, the leader continues from there
+        self.offset = offset
+        # the follower has installed the snapshot (or already had all of it)
+        self.installed = installed
+
+    def __repr__(self):
+        return f'InstallSnapshotResponse -> follower_term={self.follower_current_term} / offset={self.offset} / installed={self.installed} / ref={self.ref_msg_uuid}'
 
 
 def register_leader_last_contact(runtime, server, obj):
-    assert isinstance(obj, AppendEntriesRequest)
+    assert isinstance(obj, (AppendEntriesRequest, InstallSnapshotRequest))
 
-    runtime.last_AppendEntriesRequest_time = time.time()
+    # a deposed leader does not hold off an election
+    if obj.leader_term < server.current_term:
+        return
+    runtime.last_AppendEntriesRequest_time = time.monotonic()
+    reset_election_timer(runtime)
     runtime.last_AppendEntriesRequest_leader = obj.leader_id
     runtime.last_AppendEntriesRequest_leader_term = obj.leader_term
 
 
+def step_down_for_later_term(runtime, server, msg):
+    # a message from a later term ends the term of this server - it takes that term and becomes a follower, so a
+    # deposed leader stops replicating and answering reads. A candidate also gives up once it hears from the leader
+    # of its own term. Run by the network readers on every message from a peer, before it is handled.
+    # A VoteRequest only ends the term of a leader or a candidate (a follower keeps the term of its leader until the
+    # next one is heard from, the votes it grants compare the candidate's log with that term), a PreVoteRequest is
+    # for a term nobody is in yet
+    from_leader = False
+    if isinstance(msg, (AppendEntriesRequest, InstallSnapshotRequest)):
+        term, from_leader = msg.leader_term, True
+    elif isinstance(msg, (AppendEntriesResponse, InstallSnapshotResponse)):
+        term = msg.follower_current_term
+    elif isinstance(msg, VoteResponse):
+        term = msg.peer_term
+    elif type(msg) == VoteRequest and server.role != RaftServerRole.FOLLOWER:
+        term = msg.candidate_term
+    else:
+        return
+
+    with runtime.role_changed:
+        if term > server.current_term:
+            server.current_term = term
+            runtime.persist_state(server)
+        elif not (from_leader and term == server.current_term and server.role == RaftServerRole.CANDIDATE):
+            return
+        if server.role != RaftServerRole.FOLLOWER:
+            print(f'{server.id} stepped down to a follower in term {term}')
+            runtime.make_follower(server)
+
+
 '''
 election timeout process
 '''
@@ -214,115 +723,164 @@ def election_timeout_checker(runtime, server):
     assert isinstance(runtime, RaftRunTime)
     assert isinstance(server, RaftServer)
 
+    if fast_track_to_leader(runtime, server):
+        return
+
+    while True:
+
+        # Enter only if you are a follower - a leader sleeps here until it steps down
+        runtime.wait_for_role(server, {RaftServerRole.FOLLOWER, RaftServerRole.CANDIDATE})
+
+        # sleep until the election timeout, and on for as long as the leader pushed it back meanwhile
+        wait_period = election_wait_period(runtime)
+        while wait_period > 0:
+            time.sleep(wait_period)
+            wait_period = election_wait_period(runtime)
+
+        # Election timeout has occurred
+        # print(f'{server.id} detected an election_timeout')
+        run_election(runtime, server)
+
+
+def run_election(runtime, server):
+    # a new election timeout, the election is started over if it runs out
+    reset_election_timer(runtime)
+
+    # with PreVote the server first asks if it could win, and stays a follower in its term if not
+    if runtime.PRE_VOTE and not won_votes(collect_votes(runtime, server, pre_vote=True)):
+        return
+
+    # transition to a candidate
+    runtime.role_change_follower_to_candidate(server)
+    conclude_election(runtime, server, collect_votes(runtime, server))
+
+
+def collect_votes(runtime, server, pre_vote=False):
+    # request for votes from peers parallely, the votes are counted as they come in
+    pending = send_vote_requests(runtime, server, pre_vote)
+    peer_responses = {server.id: True}
+    try:
+        while pending:
+            done, _ = futures.wait(pending, max(0, election_wait_period(runtime)), futures.FIRST_COMPLETED)
+            if not done or tally_votes(server, peer_responses, pending, done):
+                break
+    finally:
+        cancel_vote_requests(runtime, peer_responses, pending)
+    return peer_responses
+
+
+def fast_track_to_leader(runtime, server):
     # TODO: this is a testing artifact and should be removed
     if runtime.fast_track and server.id == Servers.Server_0:
         runtime.fast_track = False
         runtime.make_leader(server)
         server.current_term += 1
-        return
+        runtime.persist_state(server)
+        return True
+    return False
 
-    while True:
 
-        # Enter only if you are a follower
-        if server.role == RaftServerRole.LEADER:
-            continue
+def reset_election_timer(runtime):
+    # the election timeout is drawn again on every reset, so the followers of a failed leader time out one at a
+    # time rather than all together and split the votes
+    runtime.election_deadline = time.monotonic() + random.uniform(runtime.ELECTION_TIMEOUT_MIN,
+                                                                  runtime.ELECTION_TIMEOUT_MAX)
 
-        # DO NOT ASK ME WHY - TODO need to think about distributed randomness
-        rz_term = [0, 2, 4, 8, 16][random.randint(0, 4)]
-        wait_period = runtime.ELECTION_CHECK_FREQUENCY + rz_term * runtime.ELECTION_CHECK_FREQUENCY
-        # print(f'{server.id}-{server.role} waiting for {wait_period} secs before checking for election timeout')
-        time.sleep(wait_period)
 
-        # assume no election timeout and then proceed to check if election timeout occurred
-        election_timeout_occurred = False
-        election_timeout_duration = time.time() - runtime.last_AppendEntriesRequest_time
+def election_wait_period(runtime):
+    # time left before the election timeout
+    return runtime.election_deadline - time.monotonic()
 
-        # print(f'duration -> {election_timeout_duration}, threshold -> {runtime.LEADER_CHECKIN_MAX_WAIT}')
-        if election_timeout_duration > runtime.LEADER_CHECKIN_MAX_WAIT:
-            election_timeout_occurred = True
 
-        # Election timeout has occurred
-        if not election_timeout_occurred:
-            pass
+def won_votes(peer_responses):
+    # a majority of the servers granted their vote (peer -> vote granted)
+    return list(peer_responses.values()).count(True) > (NUM_OF_SERVERS // 2)
 
-        else:
-            # print(f'{server.id} detected an election_timeout')
-
-            # transition to a candidate
-            runtime.role_change_follower_to_candidate(server)
-
-            # fetch candidate's peers
-            # request for votes from peers parallely
-            peer_ids = server.fetch_peer_ids()
-            peer_responses = {server.id:True}
-            pts = []
-            for peer_id in peer_ids:
-                # for each peer, request vote
-                t = threading.Thread(target=request_for_vote, args=(runtime, server, peer_id, peer_responses,))
-                pts.append(t)
-                t.start()
-            # wait for responses from all threads
-            for pt in pts:
-                pt.join()
-
-            vote_count = list(peer_responses.values()).count(True)
-            print(f'{server.id} got a total of {vote_count} votes -> {peer_responses}')
-
-            # check the response status
-            if vote_count > (NUM_OF_SERVERS // 2):
-
-                # make a new leader
-                runtime.make_leader(server)
-
-                # TODO - want to introduce this code <safety net>, but right now going aggressive with LEADER transition
-                '''
-                # received required responses, but want to double-check if election timeout is ON before becoming a leader
-                if time.time() - runtime.last_AppendEntriesRequest_time > runtime.LEADER_CHECKIN_MAX_WAIT:
-
-                    # becoming a leader
-                    runtime.make_leader(server)
 
-                else:
+def conclude_election(runtime, server, peer_responses):
+    # the candidate got all the votes it is going to get for this term (peer -> vote granted)
+    if server.role != RaftServerRole.CANDIDATE:
+        # it heard from a leader of this or a later term meanwhile, and is a follower already
+        return
+    vote_count = list(peer_responses.values()).count(True)
+    print(f'{server.id} got a total of {vote_count} votes -> {peer_responses}')
 
-                    # a new leader got appointed in between -> become a follower and check for election timeout again
-                    runtime.role_change_candidate_to_follower(server)
-                '''
+    # check the response status
+    if won_votes(peer_responses):
 
-            else:
+        # make a new leader
+        runtime.make_leader(server)
 
-                # did not receive enough votes -> become a follower and check for election timeout again
-                runtime.role_change_candidate_to_follower(server)
+        # TODO - want to introduce this code <safety net>, but right now going aggressive with LEADER transition
+        '''
+        # received required responses, but want to double-check if election timeout is ON before becoming a leader
+        if election_wait_period(runtime) <= 0:
 
+            # becoming a leader
+            runtime.make_leader(server)
 
-def request_for_vote(runtime, candidate, peer_id, peer_responses):
-    assert isinstance(runtime, RaftRunTime)
-    assert isinstance(candidate, RaftServer)
+        else:
+
+            # a new leader got appointed in between -> become a follower and check for election timeout again
+            runtime.role_change_candidate_to_follower(server)
+        '''
 
-    if len(candidate.log.log_entries) == 0:
-        candidate_last_log_term = 0
     else:
-        candidate_last_log_term = candidate.log.log_entries[len(candidate.log.log_entries)-1].term
 
-    # package VoteRequest to be sent to the peer
-    request_msg = VoteRequest(candidate_id=candidate.id,
-                              candidate_term=candidate.current_term,
-                              candidate_last_log_index=len(candidate.log.log_entries)-1,
-                              candidate_last_log_term=candidate_last_log_term,
-                              candidate_log_len=len(candidate.log.log_entries),
-                              uuid=runtime.gen_uuid(),
-                              source=candidate.id,
-                              destination=peer_id,
-                              ref_msg_uuid=None)
+        # did not receive enough votes -> become a follower and check for election timeout again
+        runtime.role_change_candidate_to_follower(server)
+
+
+def send_vote_requests(runtime, candidate, pre_vote=False):
+    # VoteRequest (or PreVoteRequest) to every peer at once -> {response future: (peer, request)}
+    pending = {}
+    for peer_id in candidate.fetch_peer_ids():
+        request_msg = make_vote_request(runtime, candidate, peer_id, pre_vote)
+        pending[runtime.send_request(request_msg)] = (peer_id, request_msg)
+    return pending
+
+
+def tally_votes(candidate, peer_responses, pending, done):
+    # records the responses of the done futures (taken out of pending) and returns True once the election is
+    # settled - a majority granted its vote, too few peers are left to make one or a peer is in a later term
+    later_term = False
+    for response_future in done:
+        peer_id, _ = pending.pop(response_future)
+        response_msg = response_future.result()
+        record_vote(peer_responses, peer_id, response_msg)
+        later_term = later_term or (response_msg is not None and response_msg.peer_term > candidate.current_term)
+    vote_count = list(peer_responses.values()).count(True)
+    return later_term or vote_count > NUM_OF_SERVERS // 2 or vote_count + len(pending) <= NUM_OF_SERVERS // 2
 
-    # send VoteRequest to the peer
-    runtime.outgoing_queue.put_nowait(request_msg)
 
-    time.sleep(1)
+def cancel_vote_requests(runtime, peer_responses, pending):
+    # the peers that have not answered by the time the election is settled count as not voting, their requests
+    # are not sent any more and their responses are dropped
+    for peer_id, request_msg in pending.values():
+        runtime.cancel_request(request_msg)
+        record_vote(peer_responses, peer_id, None)
 
-    # wait for VoteResponse back from the peer
-    response_msg = runtime.return_message_from_incoming_queue_with_ref_uuid(message_type=VoteResponse, uuid_to_check=request_msg.uuid)
 
-    # update responses dictionary with response from the specific peer
+def make_vote_request(runtime, candidate, peer_id, pre_vote=False):
+    if candidate.log.length() == 0:
+        candidate_last_log_term = 0
+    else:
+        candidate_last_log_term = candidate.log.term_at(candidate.log.length()-1)
+
+    # package VoteRequest to be sent to the peer - a PreVoteRequest is for the term the candidate would stand in
+    request_cls = PreVoteRequest if pre_vote else VoteRequest
+    return request_cls(candidate_id=candidate.id,
+                       candidate_term=candidate.current_term + 1 if pre_vote else candidate.current_term,
+                       candidate_last_log_index=candidate.log.length()-1,
+                       candidate_last_log_term=candidate_last_log_term,
+                       candidate_log_len=candidate.log.length(),
+                       uuid=runtime.gen_uuid(),
+                       source=candidate.id,
+                       destination=peer_id,
+                       ref_msg_uuid=None)
+
+
+def record_vote(peer_responses, peer_id, response_msg):
     if response_msg:
         assert isinstance(response_msg, VoteResponse)
         # TODO - what about the term in the VoteResponse
@@ -375,7 +933,7 @@ def grant_vote(runtime, server, msg):
         if msg.candidate_last_log_term == server.current_term:
 
             # I will vote for the candidate, since candidate has a longer log
-            if msg.candidate_log_len >= len(server.log.log_entries):  # TODO ***************** > or >= think about it
+            if msg.candidate_log_len >= server.log.length():  # TODO ***************** > or >= think about it
                 runtime.voted_for[msg.candidate_term] = msg.candidate_id
                 response_msg = VoteResponse(vote_granted=True, peer_term=server.current_term, uuid=runtime.gen_uuid(), source=server.id, destination=msg.candidate_id, ref_msg_uuid=msg.uuid)
                 # print(f'............................. Stage 4 - VOTE {response_msg}')
@@ -385,9 +943,36 @@ def grant_vote(runtime, server, msg):
                 response_msg = VoteResponse(vote_granted=False, peer_term=server.current_term, uuid=runtime.gen_uuid(), source=server.id, destination=msg.candidate_id, ref_msg_uuid=msg.uuid)
                 # print(f'............................. Stage 5 - NO VOTE')
 
+    # the vote has to be on disk before the candidate hears about it. Granting it gives the candidate a full election
+    # timeout to win before this server stands itself
+    if response_msg.vote_granted:
+        runtime.persist_state(server)
+        reset_election_timer(runtime)
+
     runtime.outgoing_queue.put_nowait(response_msg)
 
 
+def grant_pre_vote(runtime, server, msg):
+    assert isinstance(runtime, RaftRunTime)
+    assert isinstance(server, RaftServer)
+    assert isinstance(msg, PreVoteRequest)
+
+    # nothing changes on this server - no term, no vote recorded, no election timer reset. The pre-vote is granted
+    # if this server has not heard from a leader for the minimum election timeout (it is not the leader itself)
+    # and the candidate's log is at least as up-to-date as its own
+    heard_from_leader = server.role == RaftServerRole.LEADER or \
+        time.monotonic() - runtime.last_AppendEntriesRequest_time < runtime.ELECTION_TIMEOUT_MIN
+    if server.log.length() == 0:
+        last_log_term = 0
+    else:
+        last_log_term = server.log.term_at(server.log.length() - 1)
+    log_up_to_date = (msg.candidate_last_log_term, msg.candidate_log_len) >= (last_log_term, server.log.length())
+    vote_granted = not heard_from_leader and msg.candidate_term > server.current_term and log_up_to_date
+    runtime.outgoing_queue.put_nowait(PreVoteResponse(vote_granted=vote_granted, peer_term=server.current_term,
+                                                      uuid=runtime.gen_uuid(), source=server.id,
+                                                      destination=msg.candidate_id, ref_msg_uuid=msg.uuid))
+
+
 '''
 follower appending entries
 '''
@@ -420,6 +1005,9 @@ def handle_append_entries(runtime, server, msg):
     _s, _t, _i = append_entries(runtime, server, msg.leader_prev_log_index, msg.leader_prev_log_term,
                                 msg.entries_to_be_appended)
 
+    # on a rejection, tell the leader where the conflict is so that it can skip back a whole term at once
+    conflict_term, conflict_index = (-1, -1) if _s else find_conflict(server, msg.leader_prev_log_index)
+
     # put a successful AppendEntriesResponse to the queue
     response_msg = AppendEntriesResponse(follower_current_term=_t,
                                          success=_s,
@@ -427,21 +1015,25 @@ def handle_append_entries(runtime, server, msg):
                                          uuid=runtime.gen_uuid(),
                                          source=server.id,
                                          destination=msg.source,
-                                         ref_msg_uuid=msg.uuid)
+                                         ref_msg_uuid=msg.uuid,
+                                         conflict_term=conflict_term,
+                                         conflict_index=conflict_index)
     runtime.outgoing_queue.put_nowait(response_msg)
 
     # additionally, the follower takes the leader's last_committed_index from the AppendEntriesRequest and updates its commit index
     if _s:
 
         # update the latest term the follower has seen and accepted (in terms of AppendEntriesRequest) from the leader
-        server.current_term = msg.leader_term
+        if server.current_term != msg.leader_term:
+            server.current_term = msg.leader_term
+            runtime.persist_state(server)
 
         # update follower's last_commit_index
         old_commit_index = server.log.last_committed_index
 
         # the new commit index of the follower = leader's last_committed_index as long as
-        # it is within follower' valid log index range. Hence, the min()
-        new_commit_index = min(msg.leader_last_commit_index, len(server.log.log_entries) - 1)
+        # it is within the part of the log this request has just verified. Hence, the min()
+        new_commit_index = min(msg.leader_last_commit_index, msg.leader_prev_log_index + len(msg.entries_to_be_appended))
 
         # commit index always move forward
         if new_commit_index > server.log.last_committed_index:
@@ -451,6 +1043,75 @@ def handle_append_entries(runtime, server, msg):
             update_state_machine(runtime, server, old_commit_index + 1, new_commit_index)
 
 
+def find_conflict(server, leader_prev_index):
+    # follower's log is too short - the leader has to go back to the end of it
+    if leader_prev_index >= server.log.length():
+        return -1, server.log.length()
+
+    # the compacted part of the log always matches
+    leader_prev_index = max(leader_prev_index, server.log.base_index)
+
+    # the entry at leader_prev_index is from another term - the leader can skip that whole term
+    conflict_term = server.log.term_at(leader_prev_index)
+    return conflict_term, server.log.first_index_of_term(conflict_term)
+
+
+def handle_install_snapshot(runtime, server, msg):
+    assert isinstance(runtime, RaftRunTime)
+    assert isinstance(server, RaftServer)
+    assert isinstance(msg, InstallSnapshotRequest)
+
+    installed, offset = False, 0
+    # chunks from a stale leader are dropped, the response tells it about the newer term
+    if msg.leader_term >= server.current_term:
+        if server.current_term != msg.leader_term:
+            server.current_term = msg.leader_term
+            runtime.persist_state(server)
+
+        if msg.last_included_index <= server.last_applied_index:
+            # everything in that snapshot is applied here already
+            installed, offset = True, msg.offset + len(msg.data)
+        else:
+            offset = server.log.receive_snapshot_chunk(msg.last_included_index, msg.last_included_term, msg.offset,
+                                                       msg.data)
+            if msg.done and offset == msg.offset + len(msg.data):
+                install_snapshot(runtime, server)
+                installed = True
+
+    response_msg = InstallSnapshotResponse(follower_current_term=server.current_term,
+                                           offset=offset,
+                                           installed=installed,
+                                           uuid=runtime.gen_uuid(),
+                                           source=server.id,
+                                           destination=msg.source,
+                                           ref_msg_uuid=msg.uuid)
+    runtime.outgoing_queue.put_nowait(response_msg)
+
+
+def install_snapshot(runtime, server):
+    # the snapshot fully received from the leader replaces the log and the state machine
+    cancel_incremental_snapshot(runtime, server)
+    server.log.install_received_snapshot()
+    if runtime.application:
+        runtime.application.restore_snapshot(server.log.snapshot_chunks())
+    server.last_applied_index = server.log.last_included_index
+    print(f'{server.id} installed a snapshot up to {server.log.last_included_index} from the leader')
+
+
+def next_index_after_conflict(server, response_msg):
+    # the leader's next_index for a follower that rejected an AppendEntriesRequest with conflict hints
+    if response_msg.conflict_term == -1:
+        return response_msg.conflict_index
+
+    # the leader has entries from the conflict term - resume right after its last one
+    last_index = server.log.last_index_of_term(response_msg.conflict_term)
+    if last_index != server.log.INIT_INDEX:
+        return last_index + 1
+
+    # the leader never had that term - the follower's whole run of it has to go
+    return response_msg.conflict_index
+
+
 '''
 After a commit, update the state machine of the server (applicable to both leader and follower)
 For this method, you need the index of the first command yet to be applied i.e. the start_commit_index
@@ -465,7 +1126,7 @@ def update_state_machine(runtime, server, start_commit_index, end_commit_index):
     # iterate through each command to be applied to the state machine
     # +1 since range() does an implicit -1 on the second term
     for i in range(start_commit_index, end_commit_index + 1):
-        log_entry = server.log.log_entries[i]
+        log_entry = server.log.entry(i)
         assert isinstance(log_entry, LogEntry)
         if runtime.application:
             runtime.application.apply_to_state_machine(log_entry.command)
@@ -474,7 +1135,103 @@ def update_state_machine(runtime, server, start_commit_index, end_commit_index):
             # print(f' [ERROR] RaftRuntime has no reference to an application. The application needs to be set ..... ')
         # set the server's last_applied_index
         server.last_applied_index = i
-    pass
+
+    # take a snapshot and compact the log once it grew past the configured size
+    if server.last_applied_index >= start_commit_index:
+        compact_log_if_needed(runtime, server)
+
+
+'''
+log compaction
+'''
+
+
+def compact_log_if_needed(runtime, server):
+    assert isinstance(runtime, RaftRunTime)
+    assert isinstance(server, RaftServer)
+
+    if runtime.snapshot_job is not None:
+        # one snapshot at a time, an incremental one moves on by a chunk between batches of applied entries
+        if runtime.snapshot_job[0] == SNAPSHOT_INCREMENTAL:
+            continue_incremental_snapshot(runtime, server)
+        return
+
+    log = server.log
+    # the applied entries the log would keep anyway
+    base_index = server.last_applied_index - log.SNAPSHOT_TRAILING_ENTRIES
+    if base_index <= log.base_index:
+        return
+    if (log.SNAPSHOT_ENTRIES and log.length() - log.base_index - 1 > log.SNAPSHOT_ENTRIES) or \
+            (log.SNAPSHOT_BYTES and log.size_bytes() > log.SNAPSHOT_BYTES):
+        take_snapshot(runtime, server, base_index)
+
+
+def take_snapshot(runtime, server, base_index):
+    # the state machine has applied everything up to last_applied_index, the snapshot covers exactly that.
+    # Called from the apply path, so the state machine does not change while the snapshot starts
+    writer = server.log.begin_compaction(server.last_applied_index, base_index)
+    application = runtime.application
+    mode = runtime.SNAPSHOT_MODE
+    if mode == SNAPSHOT_FORK and not hasattr(os, 'fork'):
+        mode = SNAPSHOT_INCREMENTAL
+
+    if application is None:
+        writer.finish()
+        server.log.finish_compaction(writer)
+
+    elif mode == SNAPSHOT_FORK:
+        pid = os.fork()
+        if pid == 0:
+            # the child writes its point-in-time image of the state machine and leaves, without running anything
+            # else of the process (the other threads do not exist in the child)
+            status = 1
+            try:
+                application.write_snapshot(writer.write)
+                writer.finish()
+                status = 0
+            finally:
+                os._exit(status)
+        writer.close()
+        runtime.snapshot_job = (mode, writer)
+        t = threading.Thread(target=wait_for_snapshot_process, args=(runtime, server, pid, writer,), daemon=True)
+        t.start()
+
+    elif mode == SNAPSHOT_INCREMENTAL:
+        application.begin_snapshot(writer.write)
+        runtime.snapshot_job = (mode, writer)
+        continue_incremental_snapshot(runtime, server)
+
+    else:
+        application.write_snapshot(writer.write)
+        writer.finish()
+        server.log.finish_compaction(writer)
+
+
+def wait_for_snapshot_process(runtime, server, pid, writer):
+    _, status = os.waitpid(pid, 0)
+    if status == 0:
+        server.log.finish_compaction(writer)
+    else:
+        print(f'{server.id} snapshot process {pid} failed with status {status}')
+        server.log.discard_snapshot_writer(writer)
+    runtime.snapshot_job = None
+
+
+def continue_incremental_snapshot(runtime, server):
+    _, writer = runtime.snapshot_job
+    if runtime.application.continue_snapshot(writer.write, runtime.SNAPSHOT_INCREMENT_KEYS):
+        writer.finish()
+        server.log.finish_compaction(writer)
+        runtime.snapshot_job = None
+
+
+def cancel_incremental_snapshot(runtime, server):
+    # the state machine is about to be replaced, a snapshot of it half way is of no use
+    if runtime.snapshot_job is not None and runtime.snapshot_job[0] == SNAPSHOT_INCREMENTAL:
+        _, writer = runtime.snapshot_job
+        runtime.application.abort_snapshot()
+        server.log.discard_snapshot_writer(writer)
+        runtime.snapshot_job = None
 
 
 '''
@@ -487,6 +1244,16 @@ def handle_leader_commit_entries(runtime, server, match_index):
     assert isinstance(server, RaftServer)
     assert isinstance(match_index, list)
 
+    # replication workers of different followers commit concurrently
+    with runtime.commit_lock:
+        _handle_leader_commit_entries(runtime, server, match_index)
+
+
+def _handle_leader_commit_entries(runtime, server, match_index):
+    # the leader always matches its own log
+    match_index = list(match_index)
+    match_index[server.id.value] = server.log.last_index()
+
     # temporarily save the leader' current commit index
     old_commit_index = server.log.last_committed_index
 
@@ -508,11 +1275,15 @@ def handle_leader_commit_entries(runtime, server, match_index):
 
     new_commit_index = sorted(match_index)[NUM_OF_SERVERS//2 + 1 - 1]
     # +1 to select the mid-point and then -1 to adjust for python 0-based indexing
-    if new_commit_index > server.log.last_committed_index:
+    # only an entry of the leader's own term is committed by counting replicas, the entries before it are committed
+    # with it. An entry of an earlier term can be on a majority and still be overwritten (figure 8 of the Raft paper)
+    if new_commit_index > server.log.last_committed_index and \
+            server.log.term_at(new_commit_index) == server.current_term:
         server.log.last_committed_index = new_commit_index
 
-    # apply the to-be-applied commands and update the state machine of the follower
-    update_state_machine(runtime, server, old_commit_index + 1, new_commit_index)
+        # apply the to-be-applied commands and update the state machine of the leader
+        update_state_machine(runtime, server, old_commit_index + 1, new_commit_index)
+        acknowledge_client_requests(runtime, server, old_commit_index + 1, new_commit_index)
 
 
 '''
@@ -525,16 +1296,25 @@ def append_entries(runtime, server, leader_prev_index, leader_prev_term, entries
     assert isinstance(server, RaftServer)
     assert isinstance(server.log, RaftPersistentLog)
 
-    # print(f'      leader_prev_index={leader_prev_index}, leader_prev_term={leader_prev_term}, log_len={len(server.log.log_entries)}')
+    # print(f'      leader_prev_index={leader_prev_index}, leader_prev_term={leader_prev_term}, log_len={server.log.length()}')
     # print("       Entries to be appended => \n   ", entries_to_be_appended)
 
+    # entries up to base_index are compacted into this server's snapshot. They are committed, so they match the
+    # leader's entries at the same indices - skip the part of the request they cover
+    if leader_prev_index < server.log.base_index:
+        entries_to_be_appended = (entries_to_be_appended or [])[server.log.base_index - leader_prev_index:]
+        leader_prev_index, leader_prev_term = server.log.base_index, server.log.base_term
+
     # accommodate the initial state when the log is empty and leader_prev_index is at INIT_INDEX(i.e. -1)
 
     # existing code
     if entries_to_be_appended is None or len(entries_to_be_appended) == 0:
-        if leader_prev_index >= len(server.log.log_entries):
+        # an empty log always matches an empty log
+        if leader_prev_index == server.log.INIT_INDEX:
+            return True, server.current_term, server.log.INIT_INDEX
+        if leader_prev_index >= server.log.length():
             return False, server.log.INIT_INDEX, server.log.INIT_INDEX
-        if server.log.log_entries[leader_prev_index].term != leader_prev_term:
+        if server.log.term_at(leader_prev_index) != leader_prev_term:
             return False, server.log.INIT_INDEX, server.log.INIT_INDEX
         else:
             return True, server.current_term, server.log.INIT_INDEX
@@ -551,13 +1331,13 @@ def append_entries(runtime, server, leader_prev_index, leader_prev_term, entries
 
         # gap situation which must be avoided i.e. leader sending entries to be
         # appended at indices which do not even exist in the log
-        if leader_prev_index >= len(server.log.log_entries):
+        if leader_prev_index >= server.log.length():
             return False, server.log.INIT_INDEX, server.log.INIT_INDEX
 
         # print('#########################     Stage 1.2')
 
         # reject the request to append entries, else the continuity is broken
-        if server.log.log_entries[leader_prev_index].term != leader_prev_term:
+        if server.log.term_at(leader_prev_index) != leader_prev_term:
             return False, server.log.INIT_INDEX, server.log.INIT_INDEX
 
     # if server.role == RaftServerRole.LEADER: print('#########################     Stage 2')
@@ -570,25 +1350,27 @@ def append_entries(runtime, server, leader_prev_index, leader_prev_term, entries
         assert isinstance(entry, LogEntry)
 
         # sentinel position - reached the end of the log
-        if log_entries_index >= len(server.log.log_entries):
+        if log_entries_index >= server.log.length():
             break
 
         # no match between entries results in clear the logs (python delete)
-        if server.log.log_entries[log_entries_index].term != entry.term:
+        if server.log.term_at(log_entries_index) != entry.term:
             # this is for pruning the persistent_log off of entries from non-matching election term
-            del server.log.log_entries[log_entries_index:]
+            server.log.truncate(log_entries_index)
             break
 
+        log_entries_index += 1
+
     # if server.role == RaftServerRole.LEADER: print('#########################     Stage 3')
 
-    # overwrite every entry to be appended to the log from the position = leader_prev_index + 1
-    server.log.log_entries[
-    leader_prev_index + 1: leader_prev_index + 1 + len(entries_to_be_appended)] = entries_to_be_appended
+    # every entry to be appended goes to the log from the position = leader_prev_index + 1
+    # (entries already there matched above and are kept)
+    server.log.append(leader_prev_index + 1, entries_to_be_appended)
 
     # if server.role == RaftServerRole.LEADER: print(f'#########################     Stage 4 - Core append process successful on {server.id}')
 
     # return status
-    return True, server.current_term, len(server.log.log_entries) - 1
+    return True, server.current_term, server.log.last_index()
 
 
 '''
@@ -610,61 +1392,100 @@ def incoming_messages_event_loop(runtime, server):
     assert isinstance(server, RaftServer)
 
     while True:
-        try:
-            msg = runtime.incoming_queue.get_nowait()
-        except Empty:
-            # print(f'    Nothing in the incoming queue of {server.id}')
-            continue
-        assert isinstance(msg, RaftMessage)
+        # block until there is something to handle
+        msg = runtime.incoming_queue.get()
+        handle_incoming_message(runtime, server, msg)
 
-        if isinstance(msg, HeartBeatTick):
-            if server.role == RaftServerRole.LEADER:
-                handle_heartbeat_tick(runtime, server, msg)
 
-        elif isinstance(msg, ClientAppendRequest):
-            if server.role == RaftServerRole.LEADER:
-                handle_leader_append_entries(runtime, server, msg)
-            else:
-                # do not want to lose any client request on the follower or candidate
-                # but not sure what to do with this
-                # TODO:
-                runtime.incoming_queue.put_nowait(msg)
-
-        elif isinstance(msg, AppendEntriesRequest):
-            if server.role in {RaftServerRole.FOLLOWER, RaftServerRole.CANDIDATE}:
-                # print(f'    Dequed message being processed by {server.id} / {msg.uuid}')
-
-                # Respond to any empty heart beat
-                if msg.entries_to_be_appended is None or len(msg.entries_to_be_appended) == 0:
-                    # print('Handling empty heart beats at the follower')
-                    response_msg = AppendEntriesResponse(follower_current_term=server.current_term,success=True, match_index=server.log.INIT_INDEX,uuid=runtime.gen_uuid(),source=server.id, destination=msg.source,ref_msg_uuid=msg.uuid)
-                    runtime.outgoing_queue.put_nowait(response_msg)
-                else:
-                    handle_append_entries(runtime, server, msg)
-
-        # Want the AppendEntriesResponse to be kind of treated as a synchronous response in the
-        # handle_heartbeat_tick() handler. Hence, placing this back in the queue so that leader
-        # can call runtime.return_message_from_incoming_queue_with_ref_uuid() and get response
-        elif isinstance(msg, AppendEntriesResponse):
-            if server.role == RaftServerRole.LEADER:
-                runtime.incoming_queue.put_nowait(msg)
-                # print(f'     Dequeued {msg} by {server.id}, but placed back on the queue')
-
-        elif isinstance(msg, VoteRequest):
-            if server.role == RaftServerRole.FOLLOWER:
-                # print(f'    Dequed message being processed by {server.id}')
-                grant_vote(runtime, server, msg)
-
-        # Want the VoteResponse to be kind of treated as a synchronous response in the handler
-        # Hence, placing this back in the queue so that ,candidate can call
-        # runtime.return_message_from_incoming_queue_with_ref_uuid() and get response
-        elif isinstance(msg, VoteResponse):
-            if server.role == RaftServerRole.CANDIDATE:
-                runtime.incoming_queue.put_nowait(msg)
-                # print(f'     Dequeued {msg} by {server.id}, but placed back on the queue')
+def message_lane(msg):
+    if type(msg) == AppendEntriesRequest:
+        # an empty one is a heartbeat or a probe
+        return LANE_DATA if msg.entries_to_be_appended else LANE_CONTROL
+    if type(msg) == InstallSnapshotRequest or type(msg) == ClientAppendRequest:
+        return LANE_DATA
+    return LANE_CONTROL
+
 
+class LaneQueue:
+    # the incoming queue - control messages are handed out before data ones, each lane in the order it was filled
+
+    def __init__(self):
+        self.lanes = {lane: deque() for lane in LANES}
+        self.not_empty = threading.Condition()
+
+    def put_nowait(self, msg):
+        with self.not_empty:
+            self.lanes[message_lane(msg)].append(msg)
+            self.not_empty.notify()
+
+    def get(self):
+        with self.not_empty:
+            self.not_empty.wait_for(self.qsize)
+            return self.get_nowait()
+
+    def get_nowait(self):
+        for lane in LANES:
+            if self.lanes[lane]:
+                return self.lanes[lane].popleft()
+        raise Empty
+
+    def qsize(self):
+        return sum(len(messages) for messages in self.lanes.values())
+
+
+def handle_incoming_message(runtime, server, msg):
+    # a message off the incoming queue (or handed over by the asyncio runtime) goes to its handler
+    assert isinstance(msg, RaftMessage)
+
+    if isinstance(msg, HeartBeatTick):
+        if server.role == RaftServerRole.LEADER:
+            handle_heartbeat_tick(runtime, server, msg)
+
+    elif isinstance(msg, ClientAppendRequest):
+        if server.role == RaftServerRole.LEADER:
+            # handed to the group commit stage, which appends and replicates client requests in batches
+            runtime.client_requests.put_nowait((time.monotonic(), msg))
         else:
-            pass
+            # do not want to lose any client request on the follower or candidate
+            # but not sure what to do with this. Park it until this server becomes the leader
+            # (putting it straight back on the queue would spin the event loop)
+            # TODO:
+            runtime.deferred_client_requests.append(msg)
+
+    elif isinstance(msg, AppendEntriesRequest):
+        if server.role in {RaftServerRole.FOLLOWER, RaftServerRole.CANDIDATE}:
+            # print(f'    Dequed message being processed by {server.id} / {msg.uuid}')
+
+            # empty heart beats go through the same consistency check, they also carry the leader's commit index
+            handle_append_entries(runtime, server, msg)
+
+    # AppendEntriesResponse and VoteResponse are handed by the network reader straight to the request
+    # waiting for them (see RaftRunTime.complete_request). Only responses that arrived after their
+    # request timed out end up here, and they are dropped
+    elif isinstance(msg, AppendEntriesResponse):
+        pass
+
+    elif isinstance(msg, InstallSnapshotRequest):
+        if server.role in {RaftServerRole.FOLLOWER, RaftServerRole.CANDIDATE}:
+            handle_install_snapshot(runtime, server, msg)
+
+    elif isinstance(msg, InstallSnapshotResponse):
+        pass
+
+    elif isinstance(msg, PreVoteRequest):
+        # answered whatever the role, a leader refuses
+        grant_pre_vote(runtime, server, msg)
+
+    elif isinstance(msg, VoteRequest):
+        if server.role == RaftServerRole.FOLLOWER:
+            # print(f'    Dequed message being processed by {server.id}')
+            grant_vote(runtime, server, msg)
+
+    elif isinstance(msg, VoteResponse):
+        pass
+
+    else:
+        pass
 
 
 def kickoff_network_to_incoming_queue_hydrator(runtime, server):
@@ -678,6 +1499,7 @@ def network_to_incoming_queue_hydrator_wrapper(runtime, server):
     try:
         while True:
             client_socket, client_address = runtime.local_server_conn.accept()
+            configure_peer_socket(runtime, client_socket)
             t = threading.Thread(target=network_to_incoming_queue_hydrator, args=(runtime, server, client_socket,))
             t.start()
     except IOError:
@@ -685,50 +1507,190 @@ def network_to_incoming_queue_hydrator_wrapper(runtime, server):
             client_socket.close()
 
 
-def network_to_incoming_queue_hydrator(runtime, server, client_socket):
+def network_to_incoming_queue_hydrator(runtime, server, client_socket, peer_id=None, lane=LANE_CONTROL):
+    # reads a connection to a peer - dialed by this node (peer_id known) or accepted, in which case its first
+    # message tells who is at the other end and which lane it is. An accepted control connection is taken to send
+    # to the peer as well, nothing is ever sent back on a data one
     assert isinstance(runtime, RaftRunTime)
     assert isinstance(server, RaftServer)
     assert isinstance(client_socket, socket)
 
+    # one buffered reader per connection, several frames can come out of a single recv
+    reader = message.FrameReader(client_socket)
     while True:
         try:
-            obj = runtime.recv_from_socket(client_socket, runtime.BROADCAST_TIMEOUT)
-            if obj:
+            for obj in runtime.recv_from_reader(reader):
+                if peer_id is None and obj.source in server.fetch_peer_ids():
+                    peer_id, lane = obj.source, message_lane(obj)
+                    if lane == LANE_CONTROL:
+                        runtime.register_connection(peer_id, client_socket, replace=False)
+                step_down_for_later_term(runtime, server, obj)
+                # responses go straight to the request waiting for them
+                if runtime.complete_request(obj):
+                    continue
                 runtime.incoming_queue.put_nowait(obj)
-                print
-                if type(obj) == AppendEntriesRequest:
+                if type(obj) == AppendEntriesRequest or type(obj) == InstallSnapshotRequest:
                     register_leader_last_contact(runtime, server, obj)
                     # print(f'Queue - {runtime.incoming_queue.qsize()} / Resetting the AppendEntries timer on the follower .......... {runtime.last_AppendEntriesRequest_time}')
                 # print(f'Received a new message from {obj.source} of type -> {type(obj)}')
+        except TimeoutError:
+            # the timeout of the sends on this connection, nothing came in meanwhile
+            continue
         except Exception as e:
-            if client_socket:
-                client_socket.close()
+            # the next message to the peer dials it again
+            runtime.drop_connection(peer_id, client_socket, lane)
             print(f'{e} while reading from the network and putting on the input queue')
+            return
 
 
-def kickoff_outgoing_queue_to_network(runtime, server):
-    t = threading.Thread(target=outgoing_queue_to_network, args=(runtime, server,))
+def configure_peer_socket(runtime, sock):
+    # keepalive probes find a connection to a peer that went away without closing it
+    sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, True)
+    if TCP_KEEPIDLE is not None:
+        sock.setsockopt(IPPROTO_TCP, TCP_KEEPIDLE, runtime.KEEPALIVE_IDLE)
+        sock.setsockopt(IPPROTO_TCP, TCP_KEEPINTVL, runtime.KEEPALIVE_INTERVAL)
+        sock.setsockopt(IPPROTO_TCP, TCP_KEEPCNT, runtime.KEEPALIVE_COUNT)
+
+
+def connect_to_peer(runtime, server, peer_id, lane=LANE_CONTROL):
+    # the connection the messages of a lane to peer_id are sent on, dialed on first use. None if the peer cannot
+    # be reached
+    sock = runtime.lane_conns(lane).get(peer_id)
+    if sock is not None:
+        return sock
+    try:
+        sock = create_connection(runtime.peer_addresses[peer_id], timeout=runtime.CONNECT_TIMEOUT)
+    except IOError:
+        return None
+    configure_peer_socket(runtime, sock)
+    print(f'Remote {lane} connection established to {peer_id} {runtime.peer_addresses[peer_id]}')
+    runtime.register_connection(peer_id, sock, lane=lane)
+    # the peer answers on a control connection, on both it is read to tell when the connection is gone
+    t = threading.Thread(target=network_to_incoming_queue_hydrator, args=(runtime, server, sock, peer_id, lane,))
     t.start()
-    print(f'{server.id} -> started Outgoing Queue -> Network loop')
+    return sock
+
+
+def next_retry_interval(runtime, retry_interval):
+    # exponential backoff from SEND_RETRY_INTERVAL up to SEND_RETRY_MAX_INTERVAL
+    return min(max(retry_interval * 2, runtime.SEND_RETRY_INTERVAL), runtime.SEND_RETRY_MAX_INTERVAL)
+
+
+def jittered(interval):
+    # somewhere in the second half of interval, so the nodes do not all come back to a restarted peer at once
+    return interval * random.uniform(0.5, 1)
+
+
+class PeerChannel:
+    # bounded queue of the messages of one lane to one peer. When it is full the oldest message is dropped (lost like on the
+    # network) - a request waiting for its response fails right away, so its sender can try again. An empty
+    # AppendEntriesRequest nobody waits for (a heartbeat of heartbeat_while_pipelining) still waiting to go out is
+    # replaced by the next AppendEntriesRequest, which carries at least as much. Probes and ReadIndex heartbeats
+    # are waited for, they are always sent
+
+    def __init__(self, capacity, runtime):
+        self.capacity = capacity
+        self.runtime = runtime
+        self.messages = deque()
+        self.not_empty = threading.Condition()
+        self.heartbeat = None
+        self.dropped = 0
+
+    def put(self, msg):
+        overflow = None
+        with self.not_empty:
+            if type(msg) == AppendEntriesRequest:
+                if self.heartbeat is not None:
+                    try:
+                        self.messages.remove(self.heartbeat)
+                        self.dropped += 1
+                    except ValueError:
+                        pass   # already sent
+                self.heartbeat = msg if not msg.entries_to_be_appended and self.runtime.abandoned(msg) else None
+            if len(self.messages) >= self.capacity:
+                overflow = self.messages.popleft()
+                self.dropped += 1
+            self.messages.append(msg)
+            self.not_empty.notify()
+        if overflow is not None:
+            self.runtime.fail_request(overflow)
+
+    def take(self, max_messages):
+        # blocks until there is something to send
+        with self.not_empty:
+            self.not_empty.wait_for(lambda: self.messages)
+            return [self.messages.popleft() for _ in range(min(max_messages, len(self.messages)))]
+
+    def put_back(self, msgs):
+        # messages that could not be sent go back to the front, the oldest of them are dropped if there is no room
+        overflow = []
+        with self.not_empty:
+            room = max(self.capacity - len(self.messages), 0)
+            if len(msgs) > room:
+                self.dropped += len(msgs) - room
+                overflow, msgs = msgs[:len(msgs) - room], msgs[len(msgs) - room:]
+            self.messages.extendleft(reversed(msgs))
+            if msgs:
+                self.not_empty.notify()
+        for msg in overflow:
+            self.runtime.fail_request(msg)
+
+    def qsize(self):
+        return len(self.messages)
+
+
+class OutboundChannels:
+    # the outgoing queue of the runtime - a message goes to the channel of its lane and destination. Every channel
+    # has its own sender thread and connection, so a peer that is slow or cannot be reached only holds up what is
+    # sent to itself, and heartbeats and votes never wait behind log entries
+
+    def __init__(self, capacity, runtime):
+        self.lanes = {lane: {server_id: PeerChannel(capacity, runtime) for server_id in Servers} for lane in LANES}
+
+    def put_nowait(self, msg):
+        assert isinstance(msg, RaftMessage)
+        self.lanes[message_lane(msg)][msg.destination].put(msg)
+
+    def qsize(self):
+        return sum(channel.qsize() for channels in self.lanes.values() for channel in channels.values())
 
 
-def outgoing_queue_to_network(runtime, server):
+def kickoff_outgoing_queue_to_network(runtime, server):
     assert isinstance(runtime, RaftRunTime)
     assert isinstance(server, RaftServer)
 
+    for peer_id in server.fetch_peer_ids():
+        for lane in LANES:
+            t = threading.Thread(target=outgoing_queue_to_network, args=(runtime, server, peer_id, lane,))
+            t.start()
+    print(f'{server.id} -> started Outgoing Queue -> Network loops')
+
+
+def outgoing_queue_to_network(runtime, server, peer_id, lane=LANE_CONTROL):
+    assert isinstance(runtime, RaftRunTime)
+    assert isinstance(server, RaftServer)
+
+    channel = runtime.outgoing_queue.lanes[lane][peer_id]
+    retry_interval = 0
     while True:
-        obj = None
-        try:
-            obj = runtime.outgoing_queue.get_nowait()
-            assert isinstance(obj, RaftMessage)
-        except Empty:
+        # whatever is queued for the peer (up to SEND_BATCH_MAX_FRAMES) goes out in a single vectored write
+        objs = channel.take(runtime.SEND_BATCH_MAX_FRAMES)
+        if retry_interval:
+            # requests that timed out while the peer could not be reached are not worth sending any more
+            objs = [obj for obj in objs if not runtime.abandoned(obj)]
+            if not objs:
+                continue
+        sent = 0
+        if connect_to_peer(runtime, server, peer_id, lane):
+            sent = runtime.send_many(objs, peer_id, runtime.BROADCAST_TIMEOUT, lane)
+        if sent == len(objs):
+            retry_interval = 0
             continue
-        if obj:
-            assert isinstance(obj, RaftMessage)
-            sent_status = runtime.send(obj, obj.destination, runtime.BROADCAST_TIMEOUT)
-            # print(f'{obj} wire transfer success status = {sent_status}')
-            if not sent_status:
-                runtime.outgoing_queue.put_nowait(obj)
+        # only what did not go out is sent again, a ClientAppendRequest sent twice would be appended twice
+        channel.put_back(objs[sent:])
+        # back off from a peer that cannot be reached, doubling the pause after every failed attempt
+        retry_interval = next_retry_interval(runtime, retry_interval)
+        time.sleep(jittered(retry_interval))
 
 
 '''
@@ -736,22 +1698,120 @@ leader appending entries
 '''
 
 
-def handle_leader_append_entries(runtime, server, msg):
+def handle_leader_append_entries(runtime, server, msgs):
     assert isinstance(runtime, RaftRunTime)
     assert isinstance(server, RaftServer)
     assert isinstance(server.log, RaftPersistentLog)
-    assert isinstance(msg, ClientAppendRequest)
 
-    if len(server.log.log_entries)==0:
-        _s, _t, _i = append_entries(runtime, server, leader_prev_index=len(server.log.log_entries) - 1, leader_prev_term=0, entries_to_be_appended=[LogEntry(msg.command, server.current_term, inserted_by=server.id)])
+    # the whole batch of client requests goes into the log with a single append
+    entries = []
+    for msg in msgs:
+        assert isinstance(msg, ClientAppendRequest)
+        entries.append(LogEntry(msg.command, server.current_term, inserted_by=server.id))
+
+    leader_prev_index = server.log.length() - 1
+    # remember which client request each new entry came from, it is acknowledged once the entry is committed
+    # (recorded before the append, a replication worker may get the entries committed right after it)
+    for index, msg in enumerate(msgs, leader_prev_index + 1):
+        runtime.proposed_indices[index] = (msg.uuid, msg.source)
+
+    if server.log.length()==0:
+        _s, _t, _i = append_entries(runtime, server, leader_prev_index=leader_prev_index, leader_prev_term=0, entries_to_be_appended=entries)
     else:
-        leader_prev_term = server.log.log_entries[len(server.log.log_entries) - 1].term
-        _s, _t, _i = append_entries(runtime, server, leader_prev_index=len(server.log.log_entries) - 1, leader_prev_term=leader_prev_term, entries_to_be_appended=[LogEntry(msg.command, server.current_term, inserted_by=server.id)])
+        leader_prev_term = server.log.term_at(leader_prev_index)
+        _s, _t, _i = append_entries(runtime, server, leader_prev_index=leader_prev_index, leader_prev_term=leader_prev_term, entries_to_be_appended=entries)
 
     if _s:
-        server.log.dump()
+        # followers replicate the new entries right away instead of waiting for the next heartbeat
+        trigger_replication(runtime, server)
     else:
-        raise RuntimeError(f'Leader {log.server.id} could not append to its own log')
+        raise RuntimeError(f'Leader {server.id} could not append to its own log')
+
+
+def acknowledge_client_requests(runtime, server, start_commit_index, end_commit_index):
+    assert isinstance(runtime, RaftRunTime)
+    assert isinstance(server, RaftServer)
+
+    for i in range(start_commit_index, end_commit_index + 1):
+        proposal = runtime.proposed_indices.pop(i, None)
+        if proposal is None:
+            continue
+        request_uuid, client = proposal
+        response = ClientAppendResponse(uuid=runtime.gen_uuid(), source=server.id, destination=client, ref_msg_uuid=request_uuid)
+        # local proposals are waiting on a future, remote ones get the response over the network (the request id of
+        # a remote client says nothing about the requests pending on this server)
+        if client == server.id:
+            runtime.complete_request(response)
+        else:
+            runtime.outgoing_queue.put_nowait(response)
+
+
+'''
+group commit of client requests on the leader
+'''
+
+
+def kickoff_client_request_ingestion(runtime, server):
+    assert isinstance(runtime, RaftRunTime)
+    assert isinstance(server, RaftServer)
+
+    t = threading.Thread(target=client_request_ingestion_loop, args=(runtime, server,))
+    t.start()
+    print(f'{server.id} -> started Client Requests -> Log loop')
+
+
+def client_request_ingestion_loop(runtime, server):
+    assert isinstance(runtime, RaftRunTime)
+    assert isinstance(server, RaftServer)
+
+    while True:
+        # block until a client request comes in
+        received_at, msg = runtime.client_requests.get()
+        batch = [msg]
+
+        # take everything already queued, then linger up to the batching window for more
+        lingered = 0
+        deadline = time.monotonic() + runtime.ingest_window
+        while len(batch) < runtime.INGEST_MAX_BATCH:
+            try:
+                batch.append(runtime.client_requests.get_nowait()[1])
+                continue
+            except Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(runtime.client_requests.get(timeout=remaining)[1])
+                lingered += 1
+            except Empty:
+                break
+
+        append_client_requests(runtime, server, batch, lingered, received_at)
+
+
+def append_client_requests(runtime, server, batch, lingered, received_at):
+    if server.role != RaftServerRole.LEADER:
+        # lost the leadership while batching, park the requests like the event loop does
+        runtime.deferred_client_requests.extend(batch)
+        return
+
+    handle_leader_append_entries(runtime, server, batch)
+    adapt_ingest_window(runtime, len(batch), lingered, time.monotonic() - received_at)
+
+
+def adapt_ingest_window(runtime, batch_size, lingered, queueing_delay):
+    assert isinstance(runtime, RaftRunTime)
+
+    # multiplicative decrease when the oldest request waited longer than the latency target or when lingering
+    # did not gather a single request, additive increase while requests keep arriving together
+    if queueing_delay > runtime.INGEST_LATENCY_TARGET or (runtime.ingest_window > 0 and lingered == 0):
+        runtime.ingest_window = runtime.ingest_window / 2
+        if runtime.ingest_window < runtime.INGEST_LATENCY_TARGET / 100:
+            runtime.ingest_window = 0
+    elif batch_size > 1:
+        runtime.ingest_window = min(runtime.ingest_window + runtime.INGEST_LATENCY_TARGET / 20,
+                                    runtime.INGEST_LATENCY_TARGET / 2)
 
 
 '''
@@ -772,11 +1832,13 @@ def heart_beat_timer_loop(runtime, server):
     assert isinstance(runtime, RaftRunTime)
     assert isinstance(server, RaftServer)
 
+    # the tick carries nothing but its type, the same one is queued every interval
+    msg = HeartBeatTick(runtime.gen_uuid(), server.id, server.id)
     while True:
-        if server.role == RaftServerRole.LEADER:
-            time.sleep(runtime.HEARTBEAT_TIMER)
-            msg = HeartBeatTick(runtime.gen_uuid(), server.id, server.id)
-            runtime.incoming_queue.put_nowait(msg)
+        # only a leader generates heartbeats - sleep here until this server becomes one
+        runtime.wait_for_role(server, {RaftServerRole.LEADER})
+        time.sleep(runtime.HEARTBEAT_TIMER)
+        runtime.incoming_queue.put_nowait(msg)
 
 
 '''
@@ -787,122 +1849,407 @@ handle heartbeat timer
 def handle_heartbeat_tick(runtime, server, msg):
     assert isinstance(runtime, RaftRunTime)
     assert isinstance(server, RaftServer)
-    assert isinstance(server.log, RaftPersistentLog)
     assert isinstance(msg, HeartBeatTick)
 
-    # create response_array to track responses from each follower (including self)
-    response_array = [False for _ in range(NUM_OF_SERVERS)]
-    # leader makes its response to True as it was able to append to its local log (a few steps earlier)
-    response_array[server.id.value] = True
+    # every follower has its own replication worker, wake them all up
+    trigger_replication(runtime, server)
+
+
+def trigger_replication(runtime, server):
+    for follower_id in server.fetch_peer_ids():
+        runtime.replication_triggers[follower_id].set()
+
+
+'''
+per-follower replication workers
+'''
+
+
+def kickoff_follower_replication(runtime, server):
+    assert isinstance(runtime, RaftRunTime)
+    assert isinstance(server, RaftServer)
+
+    for follower_id in server.fetch_peer_ids():
+        t = threading.Thread(target=follower_replication_loop, args=(runtime, server, follower_id,))
+        t.start()
+    print(f'{server.id} -> started Follower replication workers')
+
+
+def follower_replication_loop(runtime, server, follower_id):
+    assert isinstance(runtime, RaftRunTime)
+    assert isinstance(server, RaftServer)
+
+    trigger = runtime.replication_triggers[follower_id]
+    while True:
+        # only a leader replicates - sleep here until this server becomes one
+        runtime.wait_for_role(server, {RaftServerRole.LEADER})
+
+        # wait for a heartbeat tick or for new entries in the leader's log
+        trigger.wait()
+        trigger.clear()
+
+        if server.role == RaftServerRole.LEADER:
+            replicate_to_follower(runtime, server, follower_id)
+
+
+def replicate_to_follower(runtime, server, follower_id):
+    assert isinstance(runtime, RaftRunTime)
+    assert isinstance(server, RaftServer)
+    assert isinstance(server.log, RaftPersistentLog)
+
+    # replication progress of a follower is kept across rounds (it is only reset in make_leader)
+    i = follower_id.value
+
+    if server.next_index[i] <= server.log.base_index:
+        # the entries the follower needs next were compacted, it catches up from the snapshot first
+        if not install_snapshot_on_follower(runtime, server, follower_id):
+            return
+
+    if not server.follower_matched[i]:
+        # find the point where the follower's log matches the leader's (the probe doubles as the heartbeat)
+        if not probe_follower(runtime, server, follower_id):
+            return
+    elif server.next_index[i] >= server.log.length():
+        # nothing new - an empty heartbeat
+        send_heartbeat(runtime, server, follower_id)
+        return
+
+    # stream the entries the follower has not acknowledged yet
+    pipeline_to_follower(runtime, server, follower_id)
+
+
+def send_heartbeat(runtime, server, follower_id):
+    i = follower_id.value
+    request_msg = make_append_entries_request(runtime, server, follower_id, server.next_index[i])
+    if request_msg is None:
+        runtime.replication_triggers[follower_id].set()
+        return
+    response_future = runtime.send_request(request_msg)
+    response_msg = runtime.wait_for_response(request_msg, response_future, runtime.APPEND_ENTRIES_RESPONSE_TIMEOUT)
+    handle_heartbeat_response(runtime, server, follower_id, response_msg)
+
+
+def handle_heartbeat_response(runtime, server, follower_id, response_msg):
+    i = follower_id.value
+    if response_msg and not response_msg.success:
+        # the follower lost track of the leader's log (e.g. it restarted) - probe it again next round
+        server.follower_matched[i] = False
+        runtime.replication_triggers[follower_id].set()
 
-    # TODO need to move these two statements to the become_leader code
-    server.next_index = [len(server.log.log_entries) for _ in range(NUM_OF_SERVERS)]
-    server.match_index = [server.log.INIT_INDEX for _ in range(NUM_OF_SERVERS)]
 
-    # print('response_array initialized -> ', response_array, not all(response_array))
-    # print('next_index [] = ', server.next_index)
-    # print('match_index [] = ', server.match_index)
+def make_append_entries_request(runtime, server, follower_id, next_index):
+    # None once the log is compacted past next_index - 1 (the follower needs the snapshot, the next round sends it).
+    # A compaction can run on another thread, the log lock keeps it from dropping the entries between the check
+    # and the reads
+    with server.log.lock:
+        if next_index <= server.log.base_index:
+            return None
+
+        # from the next_index, calculate the dependent variables like leader' prev_log_index, leader' prev_log_term
+        prev_log_index = next_index - 1
+
+        if prev_log_index > server.log.INIT_INDEX:
+            prev_log_term = server.log.term_at(prev_log_index)
+        else:
+            prev_log_term = 0
+
+        # determine the entries to be sent to the follower - a bounded batch, a follower far behind is caught up
+        # by a sequence of them
+        entries_to_be_appended = server.log.entries(next_index,
+                                                    next_index + append_batch_size(runtime, server, next_index))
+
+    # package AppendEntriesRequest to be sent to the follower
+    return AppendEntriesRequest(server.current_term, server.id, prev_log_index, prev_log_term,
+                                entries_to_be_appended, server.log.last_committed_index,
+                                uuid=runtime.gen_uuid(), source=server.id,
+                                destination=follower_id, ref_msg_uuid=None)
 
-    # loop through each not caught up response from followers
-    # i = index for each follower in the various arrays and also acts as the key to the _id_to_servers dictionary
-    for i, caught_up in enumerate(response_array):
 
-        # In the first run, the server will always be a Leader
-        # But upon receiving AppendEntriesResponse from a Follower which is at a term higher than
+def append_batch_size(runtime, server, next_index):
+    # number of entries from next_index that fit in MAX_ENTRIES_PER_APPEND and MAX_BYTES_PER_APPEND
+    # (at least one entry, whatever its size)
+    end_index = min(server.log.length(), next_index + runtime.MAX_ENTRIES_PER_APPEND)
+    batch_bytes = 0
+    for index in range(next_index, end_index):
+        batch_bytes += len(server.log.entry(index).command) + LOG_ENTRY_WIRE_OVERHEAD
+        if batch_bytes > runtime.MAX_BYTES_PER_APPEND and index > next_index:
+            return index - next_index
+    return end_index - next_index
+
+
+def probe_follower(runtime, server, follower_id):
+    # returns True once the follower accepted an AppendEntriesRequest, with next_index / match_index set accordingly
+
+    # i = index for the follower in the various arrays and also acts as the key to the _id_to_servers dictionary
+    i = follower_id.value
+
+    # start the back track process for the follower from the current next_index (len(log) after make_leader,
+    # so the first probe is an empty AppendEntriesRequest checking the leader's last entry)
+    while True:
+
+        # upon receiving AppendEntriesResponse from a Follower which is at a term higher than
         # my own current term, I would have become a Follower
         if server.role != RaftServerRole.LEADER:
-            break
+            return False
 
-        # no log replication required for local server
-        if _id_to_servers[i] == server.id:
-            continue
+        # the log may have been compacted past next_index since the last round
+        server.next_index[i] = max(server.next_index[i], server.log.base_index + 1)
 
-        # TODO need to make the code multi-threaded so all followers can be called in parallel
+        # print(f'Attempting backtracked log replication ... from {server.id} to {follower_id}')
 
-        # for each follower that is not caught up
-        if not caught_up:
+        request_msg = make_append_entries_request(runtime, server, follower_id, server.next_index[i])
+        if request_msg is None:
+            runtime.replication_triggers[follower_id].set()
+            return False
 
-            # start the back track process for the follower
-            while True:
+        # print(f'    leader -> {server.id} / follower -> {follower_id} / to_be_appended -> {request_msg.entries_to_be_appended}')
 
-                # check if there is anything to backtrack for the follower. If not then break and move to the next follower
-                if server.next_index[i] == server.log.INIT_INDEX:
-                    break
+        # send entries to be appended to the follower
+        response_future = runtime.send_request(request_msg)
 
-                # print(f'Attempting backtracked log replication ... from {server.id} to {_id_to_servers[i]} because caught_up_flag = {response_array[i]}')
+        # wait for response back from the follower
+        response_msg = runtime.wait_for_response(request_msg, response_future, runtime.APPEND_ENTRIES_RESPONSE_TIMEOUT)
 
-                server.next_index[i] -= 1
+        # print(f'    **** **** fetched response -> {response_msg}')
 
-                # from the new next_index, calculate the dependent variables like leader' prev_log_index, leader' prev_log_term
-                prev_log_index = server.next_index[i] - 1
+        matched = handle_probe_response(runtime, server, follower_id, response_msg)
+        if matched is not None:
+            return matched
 
-                if prev_log_index > server.log.INIT_INDEX:
-                    prev_log_term = server.log.log_entries[prev_log_index].term
-                else:
-                    prev_log_term = 0
 
-                # determine the entries to be sent to the follower
-                entries_to_be_appended = server.log.log_entries[server.next_index[i]:]
+def handle_probe_response(runtime, server, follower_id, response_msg):
+    # True once the follower accepted the probe, False to give up for this round, None to probe again
+    # from the next_index it backtracked to
+    i = follower_id.value
 
-                # print(f'    leader -> {server.id} / follower -> {_id_to_servers[i]} / to_be_appended -> {entries_to_be_appended}')
-                # print(f'    follower prev response={response_array[i]} / next_index={server.next_index[i]} / prev_index = {prev_log_index} / prev_term = {prev_log_term}')
+    # got no response for the specific follower
+    if not response_msg:
+        return False
 
-                # package AppendEntriesRequest to be sent to the follower
-                request_msg = AppendEntriesRequest(server.current_term, server.id, prev_log_index, prev_log_term,
-                                                   entries_to_be_appended, server.log.last_committed_index,
-                                                   uuid=runtime.gen_uuid(), source=server.id,
-                                                   destination=_id_to_servers[i], ref_msg_uuid=None)
+    assert isinstance(response_msg, AppendEntriesResponse)
 
-                # print(f'    log -> {server.log.log_entries}')
-                # print(f'    Entries to be appended -> {entries_to_be_appended}')
+    # response was successful for that follower
+    if response_msg.success:
+        # update match index response from the follower and commit whatever a quorum now holds
+        server.match_index[i] = response_msg.match_index
+        server.next_index[i] = response_msg.match_index + 1
+        server.follower_matched[i] = True
+        handle_leader_commit_entries(runtime, server, server.match_index)
 
-                # send entries to be appended to the follower
-                runtime.outgoing_queue.put_nowait(request_msg)
+        # no more a need to backtrack
+        return True
 
-                time.sleep(0.1)
+    if response_msg.follower_current_term > server.current_term or server.role != RaftServerRole.LEADER:
+        # the follower is in a later term - this server is not the leader any more (see step_down_for_later_term)
+        return False
 
-                # wait for response back from the follower
-                response_msg = runtime.return_message_from_incoming_queue_with_ref_uuid(message_type=AppendEntriesResponse, uuid_to_check=request_msg.uuid)
+    if server.next_index[i] <= server.log.base_index + 1:
+        # the follower is missing entries the leader has already compacted, the next round sends it the snapshot
+        server.next_index[i] = server.log.base_index
+        runtime.replication_triggers[follower_id].set()
+        return False
 
-                # print(f'    **** **** fetched response from incoming queue -> {response_msg}')
+    # backtrack the next_index for the follower - a whole term at a time using the conflict hints,
+    # but always at least one entry so the probe terminates (and never into the compacted part of the log)
+    server.next_index[i] = max(server.log.base_index + 1,
+                               min(next_index_after_conflict(server, response_msg), server.next_index[i] - 1))
+    return None
 
-                # response was successful for that follower
-                if response_msg:
-                    assert isinstance(response_msg, AppendEntriesResponse)
-                    if response_msg.success:
-                        # update follower' response
-                        response_array[i] = True
 
-                        # update match index response from the follower
-                        server.match_index[i] = response_msg.match_index
+def install_snapshot_on_follower(runtime, server, follower_id):
+    # streams the leader's snapshot to a follower that needs entries the leader has compacted, in chunks of
+    # INSTALL_SNAPSHOT_CHUNK_SIZE with up to INSTALL_SNAPSHOT_WINDOW of them in flight. Returns True once the
+    # follower installed it, with next_index / match_index right after / at the last entry it covers.
+    # A transfer cut short resumes from what the follower has stored in a later round
 
-                        # break the loop for the follower as there is no more a need to backtrack
-                        break
+    trigger = runtime.replication_triggers[follower_id]
+    transfer = SnapshotTransfer(runtime, server, follower_id)
+    try:
+        while server.role == RaftServerRole.LEADER:
+            transfer.send_chunks(runtime, server)
+
+            trigger.wait(runtime.INSTALL_SNAPSHOT_RESPONSE_TIMEOUT)
+            trigger.clear()
+
+            installed = transfer.handle_responses(runtime, server)
+            if installed is not None:
+                return installed
+    finally:
+        transfer.close()
+    return False
+
+
+class SnapshotTransfer:
+    # a snapshot being streamed to a follower - the chunks in flight and how far the follower got
+
+    def __init__(self, runtime, server, follower_id):
+        self.follower_id = follower_id
+        self.reader = server.log.snapshot_reader()
+        self.last_included_index, self.last_included_term = self.reader.info[:2]
+        transfer_index, self.offset = runtime.snapshot_transfers.get(follower_id, (None, 0))
+        if transfer_index != self.last_included_index:
+            self.offset = 0
+        print(f'{server.id} sending a snapshot up to {self.last_included_index} ({self.reader.size} bytes) to {follower_id} from {self.offset}')
+
+        self.in_flight = deque()     # (request_msg, response_future, sent_at) in the order requests were sent
+        self.send_offset, self.sent_all = self.offset, False
+
+    def send_chunks(self, runtime, server):
+        # fill the window
+        trigger = runtime.replication_triggers[self.follower_id]
+        while len(self.in_flight) < runtime.INSTALL_SNAPSHOT_WINDOW and not self.sent_all:
+            data = self.reader.read(self.send_offset, runtime.INSTALL_SNAPSHOT_CHUNK_SIZE)
+            self.sent_all = self.send_offset + len(data) >= self.reader.size
+            request_msg = InstallSnapshotRequest(server.current_term, server.id, self.last_included_index,
+                                                 self.last_included_term, self.send_offset, data, self.sent_all,
+                                                 uuid=runtime.gen_uuid(), source=server.id,
+                                                 destination=self.follower_id)
+            response_future = runtime.send_request(request_msg)
+            response_future.add_done_callback(lambda _: trigger.set())
+            self.in_flight.append((request_msg, response_future, time.monotonic()))
+            self.send_offset += len(data)
+
+    def handle_responses(self, runtime, server):
+        # True once the follower installed the snapshot, False if the transfer stopped, None while it goes on
+        i = self.follower_id.value
+
+        # responses are handled in the order the chunks were sent
+        while self.in_flight:
+            request_msg, response_msg = pop_response(runtime, self.in_flight, runtime.INSTALL_SNAPSHOT_RESPONSE_TIMEOUT)
+            if request_msg is None:
+                break
 
-                    if not response_msg.success and response_msg.follower_current_term > server.current_term:
-                        pass
-                        # TODO - I should become a follower because my current term as a leader is lower than follower's
-                        #become_follower()
-                        #break
-                else:
-                    # got no response for the specific follower
-                    break
+            if response_msg is None or response_msg.follower_current_term > server.current_term:
+                # lost or refused - remember how far the transfer got
+                cancel_in_flight(runtime, self.in_flight)
+                runtime.snapshot_transfers[self.follower_id] = (self.last_included_index, self.offset)
+                return False
+
+            if response_msg.installed:
+                server.match_index[i] = max(server.match_index[i], self.last_included_index)
+                server.next_index[i] = self.last_included_index + 1
+                server.follower_matched[i] = True
+                runtime.snapshot_transfers.pop(self.follower_id, None)
+                handle_leader_commit_entries(runtime, server, server.match_index)
+                return True
 
-                # backtrack the next_index for the follower
-                server.next_index[i] -= 1
+            self.offset = response_msg.offset
+            if self.offset != request_msg.offset + len(request_msg.data):
+                # the follower missed a chunk (or started over) - everything after it is void
+                cancel_in_flight(runtime, self.in_flight)
+                self.send_offset, self.sent_all = self.offset, False
+        return None
 
-    # check if consensus reached
-    if response_array.count(True) > (NUM_OF_SERVERS // 2):
-        # print(f'    Consensus reached and ready to commit ...')
-        handle_leader_commit_entries(runtime, server, server.match_index)
+    def close(self):
+        self.reader.close()
+
+
+def pop_response(runtime, in_flight, timeout):
+    # (request, response) of the oldest request in flight once it got its response (None after timeout),
+    # (None, None) while it is still waiting for it
+    request_msg, response_future, sent_at = in_flight[0]
+    if not response_future.done():
+        if time.monotonic() - sent_at < timeout:
+            return None, None
+        response_msg = None
     else:
-        pass
-        # print(f'    No consensus reached yet')
+        response_msg = response_future.result()
+    in_flight.popleft()
+    runtime.cancel_request(request_msg)
+    return request_msg, response_msg
+
+
+def cancel_in_flight(runtime, in_flight):
+    for request_msg, _, _ in in_flight:
+        runtime.cancel_request(request_msg)
+    in_flight.clear()
+
+
+def pipeline_to_follower(runtime, server, follower_id):
+    # keeps up to REPLICATION_WINDOW AppendEntriesRequest in flight to a follower that is known to match the
+    # leader's log. next_index moves forward optimistically as requests go out and is rolled back to
+    # match_index + 1 on a rejection or a lost response. Returns once everything sent got acknowledged
+
+    trigger = runtime.replication_triggers[follower_id]
+    in_flight = deque()     # (request_msg, response_future, sent_at) in the order requests were sent
+    last_heartbeat = 0
+
+    while server.role == RaftServerRole.LEADER:
+
+        fill_replication_window(runtime, server, follower_id, in_flight)
+        if not in_flight:
+            return
+        last_heartbeat = heartbeat_while_pipelining(runtime, server, follower_id, in_flight, last_heartbeat)
 
-    # print(f"The leader {server.id} and all LIVE followers are caught up on the appends")
+        trigger.wait(runtime.APPEND_ENTRIES_RESPONSE_TIMEOUT)
+        trigger.clear()
+
+        if not handle_replication_responses(runtime, server, follower_id, in_flight):
+            return
+
+
+def fill_replication_window(runtime, server, follower_id, in_flight):
+    # whatever the leader appended since the last request goes out, as long as the window has room
+    i = follower_id.value
+    trigger = runtime.replication_triggers[follower_id]
+    while len(in_flight) < runtime.REPLICATION_WINDOW and \
+            server.log.base_index < server.next_index[i] < server.log.length():
+        request_msg = make_append_entries_request(runtime, server, follower_id, server.next_index[i])
+        if request_msg is None:
+            # compacted meanwhile, the next round sends the snapshot
+            trigger.set()
+            break
+        response_future = runtime.send_request(request_msg)
+        # a response wakes the worker up just like new entries or a heartbeat do
+        response_future.add_done_callback(lambda _: trigger.set())
+        in_flight.append((request_msg, response_future, time.monotonic()))
+        server.next_index[i] += len(request_msg.entries_to_be_appended)
+
+
+def heartbeat_while_pipelining(runtime, server, follower_id, in_flight, last_heartbeat):
+    # nothing goes to a follower whose window is full until its responses come back - an empty AppendEntriesRequest
+    # on the control lane every HEARTBEAT_TIMER keeps it from starting an election meanwhile. It claims no previous
+    # entry, so it matches whatever is in flight. Returns when the last heartbeat went out
+    now = time.monotonic()
+    if now - max(last_heartbeat, in_flight[-1][2]) < runtime.HEARTBEAT_TIMER:
+        return last_heartbeat
+    # nobody waits for the response, it is dropped when it comes in
+    runtime.outgoing_queue.put_nowait(AppendEntriesRequest(server.current_term, server.id, server.log.INIT_INDEX, 0, [],
+                                                           server.log.last_committed_index, uuid=runtime.gen_uuid(),
+                                                           source=server.id, destination=follower_id,
+                                                           ref_msg_uuid=None))
+    return now
+
+
+def handle_replication_responses(runtime, server, follower_id, in_flight):
+    # returns False once the pipeline was rolled back (a rejection or a lost response)
+    i = follower_id.value
+
+    # responses are handled in the order the requests were sent
+    while in_flight:
+        request_msg, response_msg = pop_response(runtime, in_flight, runtime.APPEND_ENTRIES_RESPONSE_TIMEOUT)
+        if request_msg is None:
+            break
+
+        if response_msg and response_msg.success:
+            server.match_index[i] = max(server.match_index[i], response_msg.match_index)
+            handle_leader_commit_entries(runtime, server, server.match_index)
+            continue
+
+        # rejected or lost - everything after it is void, roll back to what the follower acknowledged
+        cancel_in_flight(runtime, in_flight)
+        server.next_index[i] = server.match_index[i] + 1
+        if response_msg:
+            # a rejection means the follower's log no longer matches - the next round probes it again
+            server.follower_matched[i] = False
+        runtime.replication_triggers[follower_id].set()
+        return False
+    return True
 
 
 class VoteRequest(RaftMessage):
+    __slots__ = ('candidate_id', 'candidate_term', 'candidate_last_log_index', 'candidate_last_log_term',
+                 'candidate_log_len')
 
     def __init__(self, candidate_id, candidate_term, candidate_last_log_index, candidate_last_log_term, candidate_log_len, uuid, source, destination, ref_msg_uuid=None):
         super().__init__(uuid, source, destination, ref_msg_uuid)
@@ -917,6 +2264,7 @@ class VoteRequest(RaftMessage):
         return f'VoteRequest -> {self.candidate_id} -> {self.destination}  / candidate_term={self.candidate_term} / candidate_last_log_index={self.candidate_last_log_index} / candidate_last_log_term={self.candidate_last_log_term}'
 
 class VoteResponse(RaftMessage):
+    __slots__ = ('vote_granted', 'peer_term')
 
     def __init__(self, vote_granted, peer_term, uuid, source, destination, ref_msg_uuid=None):
         super().__init__(uuid, source, destination, ref_msg_uuid)
@@ -927,98 +2275,341 @@ class VoteResponse(RaftMessage):
         return f'VoteResponse -> vote_granted={self.vote_granted} by {self.source} for {self.destination}/ peer_term={self.peer_term}'
 
 
+class PreVoteRequest(VoteRequest):
+    # would the peer vote for the candidate in candidate_term? Asked before the candidate moves to that term
+    __slots__ = ()
+
+    def __repr__(self):
+        return f'PreVoteRequest -> {self.candidate_id} -> {self.destination}  / candidate_term={self.candidate_term} / candidate_last_log_index={self.candidate_last_log_index} / candidate_last_log_term={self.candidate_last_log_term}'
+
+
+class PreVoteResponse(VoteResponse):
+    __slots__ = ()
+
+    def __repr__(self):
+        return f'PreVoteResponse -> vote_granted={self.vote_granted} by {self.source} for {self.destination}/ peer_term={self.peer_term}'
+
+
+'''
+wire codec schemas - type ids are part of the wire format and must never be re-used
+'''
+
+_RAFT_MESSAGE_FIXED_FIELDS = [('source', codec.enum_of(Servers)), ('destination', codec.enum_of(Servers))]
+_RAFT_MESSAGE_VAR_FIELDS = [('uuid', codec.UVARINT), ('ref_msg_uuid', codec.OPT_UVARINT)]
+
+wire_codec = codec.MessageCodec()
+wire_codec.register(1, LogEntry,
+                    fixed_fields=[('inserted_by', codec.enum_of(Servers))],
+                    var_fields=[('term', codec.SVARINT), ('command', codec.STRING)])
+wire_codec.register(2, ClientAppendRequest, _RAFT_MESSAGE_FIXED_FIELDS,
+                    _RAFT_MESSAGE_VAR_FIELDS + [('command', codec.STRING)])
+wire_codec.register(3, ClientAppendResponse, _RAFT_MESSAGE_FIXED_FIELDS, _RAFT_MESSAGE_VAR_FIELDS)
+wire_codec.register(4, TriggerCommit, _RAFT_MESSAGE_FIXED_FIELDS, _RAFT_MESSAGE_VAR_FIELDS)
+wire_codec.register(5, ElectionTimeout, _RAFT_MESSAGE_FIXED_FIELDS, _RAFT_MESSAGE_VAR_FIELDS)
+wire_codec.register(6, HeartBeatTick, _RAFT_MESSAGE_FIXED_FIELDS, _RAFT_MESSAGE_VAR_FIELDS)
+wire_codec.register(7, AppendEntriesRequest,
+                    _RAFT_MESSAGE_FIXED_FIELDS + [('leader_id', codec.enum_of(Servers))],
+                    _RAFT_MESSAGE_VAR_FIELDS + [('leader_term', codec.UVARINT),
+                                                ('leader_prev_log_index', codec.SVARINT),
+                                                ('leader_prev_log_term', codec.SVARINT),
+                                                ('leader_last_commit_index', codec.SVARINT),
+                                                ('entries_to_be_appended', codec.list_of(LogEntry))])
+wire_codec.register(8, AppendEntriesResponse,
+                    _RAFT_MESSAGE_FIXED_FIELDS + [('success', codec.BOOL)],
+                    _RAFT_MESSAGE_VAR_FIELDS + [('follower_current_term', codec.SVARINT),
+                                                ('match_index', codec.SVARINT),
+                                                ('conflict_term', codec.SVARINT),
+                                                ('conflict_index', codec.SVARINT)])
+for _type_id, _cls in [(9, VoteRequest), (13, PreVoteRequest)]:
+    wire_codec.register(_type_id, _cls,
+                        _RAFT_MESSAGE_FIXED_FIELDS + [('candidate_id', codec.enum_of(Servers))],
+                        _RAFT_MESSAGE_VAR_FIELDS + [('candidate_term', codec.UVARINT),
+                                                    ('candidate_last_log_index', codec.SVARINT),
+                                                    ('candidate_last_log_term', codec.SVARINT),
+                                                    ('candidate_log_len', codec.UVARINT)])
+for _type_id, _cls in [(10, VoteResponse), (14, PreVoteResponse)]:
+    wire_codec.register(_type_id, _cls,
+                        _RAFT_MESSAGE_FIXED_FIELDS + [('vote_granted', codec.BOOL)],
+                        _RAFT_MESSAGE_VAR_FIELDS + [('peer_term', codec.UVARINT)])
+wire_codec.register(11, InstallSnapshotRequest,
+                    _RAFT_MESSAGE_FIXED_FIELDS + [('leader_id', codec.enum_of(Servers)), ('done', codec.BOOL)],
+                    _RAFT_MESSAGE_VAR_FIELDS + [('leader_term', codec.UVARINT),
+                                                ('last_included_index', codec.SVARINT),
+                                                ('last_included_term', codec.SVARINT),
+                                                ('offset', codec.UVARINT),
+                                                ('data', codec.BYTES)])
+wire_codec.register(12, InstallSnapshotResponse,
+                    _RAFT_MESSAGE_FIXED_FIELDS + [('installed', codec.BOOL)],
+                    _RAFT_MESSAGE_VAR_FIELDS + [('follower_current_term', codec.SVARINT),
+                                                ('offset', codec.UVARINT)])
+
+
 class RaftApplication:
     def __init__(self, state_machine):
         self.state_machine = state_machine
 
     def apply_to_state_machine(self, command):
-        self.state_machine.execute_instruction([command])
+        # the state machine takes an instruction split in words, like a request from a kv client
+        self.state_machine.execute_instruction(command.split())
 
+    # snapshots - the state machine is written through write(bytes), all at once or a chunk at a time
 
-class RaftRunTime:
+    def write_snapshot(self, write):
+        self.state_machine.write_snapshot(write)
 
-    BROADCAST_TIMEOUT = 0.5
-    HEARTBEAT_TIMER = 1
-    ELECTION_CHECK_FREQUENCY = 5
-    LEADER_CHECKIN_MAX_WAIT = 30
+    def begin_snapshot(self, write):
+        self.state_machine.begin_snapshot(write)
 
+    def continue_snapshot(self, write, max_keys):
+        # True once the snapshot is complete
+        return self.state_machine.continue_snapshot(write, max_keys)
 
-    def __init__(self, application=None):
-        self.incoming_queue = Queue()
-        self.outgoing_queue = Queue()
+    def abort_snapshot(self):
+        self.state_machine.abort_snapshot()
+
+    def restore_snapshot(self, chunks):
+        # read back from the chunks of bytes of the snapshot, in order
+        self.state_machine.restore(chunks)
+
+    def read(self, instruction):
+        # a request that does not change the state machine, answered without going through the log
+        return self.state_machine.execute_instruction(instruction)
+
+
+class RaftRunTime:
+
+    BROADCAST_TIMEOUT = 0.5
+    HEARTBEAT_TIMER = 0.1
+    # a follower stands for election when it hears nothing from a leader for a timeout drawn at random from this
+    # range (seconds, several heartbeats long)
+    ELECTION_TIMEOUT_MIN = 0.5
+    ELECTION_TIMEOUT_MAX = 1
+    # PreVote - a server only moves to a new term to stand for election once a majority says it would vote for it
+    # there (a server cut off from a healthy leader does not depose it)
+    PRE_VOTE = False
+    # pickle is kept only as a fallback, it is slower, bulkier and unsafe to accept from the network
+    WIRE_FORMAT = WIRE_FORMAT_BINARY
+    # limits for coalescing queued frames to the same peer into one vectored write
+    SEND_BATCH_MAX_FRAMES = 64
+    SEND_BATCH_MAX_BYTES = 256 * 1024
+    # how long a request waits for its response (a candidate waits for votes until its election timeout)
+    APPEND_ENTRIES_RESPONSE_TIMEOUT = 0.1
+    # max AppendEntriesRequest in flight per follower (1 = wait for each response before sending more)
+    REPLICATION_WINDOW = 8
+    # bounds of a single AppendEntriesRequest
+    MAX_ENTRIES_PER_APPEND = 1024
+    MAX_BYTES_PER_APPEND = 256 * 1024
+    # messages queued per peer, and the pause of its sender after a failed send or dial (doubled on every failure up
+    # to the max)
+    PEER_QUEUE_CAPACITY = 4096
+    SEND_RETRY_INTERVAL = 0.05
+    SEND_RETRY_MAX_INTERVAL = 2
+    # dialing a peer, and the keepalive probes of the connections to peers (idle seconds before the first probe,
+    # seconds between probes, probes unanswered before the connection is dropped)
+    CONNECT_TIMEOUT = 0.5
+    KEEPALIVE_IDLE = 5
+    KEEPALIVE_INTERVAL = 1
+    KEEPALIVE_COUNT = 3
+    # group commit - max client requests appended together and the queueing delay the batching window aims for
+    INGEST_MAX_BATCH = 1024
+    INGEST_LATENCY_TARGET = 0.005
+    # snapshots go to followers in chunks, with a bounded number of chunks in flight per follower
+    INSTALL_SNAPSHOT_CHUNK_SIZE = 1024 * 1024
+    INSTALL_SNAPSHOT_WINDOW = 4
+    INSTALL_SNAPSHOT_RESPONSE_TIMEOUT = 2
+    # how snapshots of the state machine are taken (forking is not available everywhere) and the keys an
+    # incremental snapshot writes after each batch of applied entries
+    SNAPSHOT_MODE = SNAPSHOT_FORK if hasattr(os, 'fork') else SNAPSHOT_INCREMENTAL
+    SNAPSHOT_INCREMENT_KEYS = 1000
+    # how long a kv client request waits for its command to be committed, and a read for a majority to confirm
+    # the leader
+    KV_REQUEST_TIMEOUT = 5
+    READ_INDEX_TIMEOUT = 0.5
+
+
+    def __init__(self, application=None, wire_format=None, server_id=None):
+        self.incoming_queue = LaneQueue()
+        self.outgoing_queue = OutboundChannels(self.PEER_QUEUE_CAPACITY, self)
         if application:
             assert isinstance(application, RaftApplication)
         self.application = application
         self.local_server_conn = None
+        # peer -> connection the control / data messages to it are sent on (None until dialed, or once it dropped)
         self.remote_server_conns = {}
-        # Election timeout related attributes
-        self.last_AppendEntriesRequest_time = time.time()
+        self.remote_server_data_conns = {}
+        self.peer_addresses = SERVER_ADDRESSES
+        self.connections_lock = threading.Lock()
+        # Election timeout related attributes (on the monotonic clock)
+        self.last_AppendEntriesRequest_time = time.monotonic()
+        self.election_deadline = time.monotonic() + self.ELECTION_TIMEOUT_MAX
         self.last_AppendEntriesRequest_leader = None
         self.last_AppendEntriesRequest_leader_term = None
         self.voted_for={}
         self.fast_track=True
+        # wakes up the replication worker of each follower
+        self.replication_triggers = {server_id: threading.Event() for server_id in Servers}
+        self.commit_lock = threading.Lock()
+        # role changes are signalled so the loops can sleep until the role they act on
+        self.role_changed = threading.Condition()
+        # requests waiting for their response, keyed by request uuid
+        self.pending_requests = {}
+        self.pending_requests_lock = threading.Lock()
+        # client requests received while not the leader
+        self.deferred_client_requests = []
+        # client requests waiting for the group commit stage, as (time received, request)
+        self.client_requests = Queue()
+        # how long the group commit stage lingers for more requests, adapted to the load
+        self.ingest_window = 0
+        # log index -> (request uuid, client) of the client requests appended by this leader, until committed
+        self.proposed_indices = {}
+        # follower -> (last included index, bytes acknowledged) of a snapshot transfer cut short
+        self.snapshot_transfers = {}
+        # (mode, wal.SnapshotWriter) of the snapshot of the state machine being taken
+        self.snapshot_job = None
+        # ids of the requests made by this node - the server above REQUEST_ID_SERVER_SHIFT bits, so no two nodes
+        # make the same id, and below them increasing from the microseconds since the epoch at start up, so a
+        # response to a request made before a restart does not match a new one (unless more than a million requests
+        # a second were made)
+        server_bits = 0 if server_id is None else (server_id.value + 1) << REQUEST_ID_SERVER_SHIFT
+        self.request_ids = count(server_bits | time.time_ns() // 1000)
+        if wire_format:
+            assert wire_format in {WIRE_FORMAT_BINARY, WIRE_FORMAT_PICKLE}
+            self.WIRE_FORMAT = wire_format
+
+    def set_role(self, server, role):
+        with self.role_changed:
+            server.role = role
+            if role != RaftServerRole.LEADER:
+                # entries of a deposed leader may still be overwritten, they are never acknowledged by this server
+                self.proposed_indices.clear()
+            self.role_changed.notify_all()
+
+    def wait_for_role(self, server, roles):
+        with self.role_changed:
+            self.role_changed.wait_for(lambda: server.role in roles)
 
     def make_follower(self, server):
-        assert isinstance(runtime, RaftRunTime)
+        assert isinstance(self, RaftRunTime)
         assert isinstance(server, RaftServer)
-        server.role = RaftServerRole.FOLLOWER
+        self.set_role(server, RaftServerRole.FOLLOWER)
+        reset_election_timer(self)
         # print(f'{server.id} became a follower')
 
     def make_leader(self, server):
-        assert isinstance(runtime, RaftRunTime)
+        assert isinstance(self, RaftRunTime)
         assert isinstance(server, RaftServer)
-        server.role = RaftServerRole.LEADER
+        self.set_role(server, RaftServerRole.LEADER)
         print(f'{server.id} became the *** NEW LEADER ***')
 
-        server.next_index = [len(server.log.log_entries) for _ in range(NUM_OF_SERVERS)]
+        # replication progress of the followers is only reset here, when this server becomes the leader
+        server.next_index = [server.log.length() for _ in range(NUM_OF_SERVERS)]
         server.match_index = [server.log.INIT_INDEX for _ in range(NUM_OF_SERVERS)]
+        server.follower_matched = [False for _ in range(NUM_OF_SERVERS)]
 
         # Generate a no-op ClientAppendRequest. This has the effect of forcing the Leader to do a local commit and
         # issue AppendEntriesRequest -> causing backtracking, validations and handle_append_entries
 
-        request_msg = ClientAppendRequest(command=instructions.NO_OP_COMMAND, uuid=runtime.gen_uuid(), source=server.id,
+        request_msg = ClientAppendRequest(command=instructions.NO_OP_COMMAND, uuid=self.gen_uuid(), source=server.id,
                                       destination=server.id, ref_msg_uuid=None)
 
-        runtime.incoming_queue.put_nowait(request_msg)
+        self.incoming_queue.put_nowait(request_msg)
+
+        # client requests parked while this server was not the leader
+        deferred_client_requests, self.deferred_client_requests = self.deferred_client_requests, []
+        for msg in deferred_client_requests:
+            self.incoming_queue.put_nowait(msg)
 
     def role_change_follower_to_candidate(self, server):
-        assert isinstance(runtime, RaftRunTime)
+        assert isinstance(self, RaftRunTime)
         assert isinstance(server, RaftServer)
-        server.role = RaftServerRole.CANDIDATE  # promote self to candidate
+        self.set_role(server, RaftServerRole.CANDIDATE)  # promote self to candidate
         server.current_term += 1  # start a new term
-        runtime.voted_for[server.current_term] = server.id  # voted for myself for the term
+        self.voted_for[server.current_term] = server.id  # voted for myself for the term
+        self.persist_state(server)
         print(f'{server.id} transitioned to candidate to compete for term={server.current_term} and {self.voted_for}')
 
     def role_change_candidate_to_follower(self, server):
-        assert isinstance(runtime, RaftRunTime)
+        assert isinstance(self, RaftRunTime)
         assert isinstance(server, RaftServer)
-        server.role = RaftServerRole.FOLLOWER  # go back to becoming a follower
+        self.set_role(server, RaftServerRole.FOLLOWER)  # go back to becoming a follower
         # TODO - should I decrement the term and remove the self vote
-        del runtime.voted_for[server.current_term]
+        del self.voted_for[server.current_term]
         server.current_term -= 1  # go back to original term
+        self.persist_state(server)
         # print(f'{server.id} transitioned from candidate to follower')
 
+    def persist_state(self, server):
+        # current term and votes survive a restart when the server's log is on disk
+        server.log.save_state(server.current_term, self.voted_for)
+
+    def restore_state(self, server):
+        # votes and state machine of a server restarted from disk
+        if server.log.wal is not None and server.log.wal.vote_term != server.log.INIT_INDEX:
+            self.voted_for[server.log.wal.vote_term] = _id_to_servers[server.log.wal.voted_for]
+        if self.application and server.log.last_included_index != server.log.INIT_INDEX:
+            self.application.restore_snapshot(server.log.snapshot_chunks())
+
     def gen_uuid(self):
-        return uuid.uuid4().int
+        # next() on an itertools.count is atomic, no lock needed between the threads making requests
+        return next(self.request_ids)
 
     def object_to_string(self, o):
-        return pickle.dumps(o)
+        if self.WIRE_FORMAT == WIRE_FORMAT_PICKLE:
+            return pickle.dumps(o)
+        return wire_codec.encode(o)
 
     def string_to_object(self, s):
-        return pickle.loads(s)
+        if self.WIRE_FORMAT == WIRE_FORMAT_PICKLE:
+            return pickle.loads(s)
+        return wire_codec.decode(s)
 
     def send(self, request, server_id, timeout):
-        if request is not None and self.remote_server_conns[server_id] is not None:
+        return request is not None and self.send_many([request], server_id, timeout, message_lane(request)) == 1
+
+    def send_many(self, requests, server_id, timeout, lane=LANE_CONTROL):
+        # frames are coalesced into vectored writes of at most SEND_BATCH_MAX_BYTES. Returns how many of the
+        # requests (from the front) were written - the writes before a failed one went out
+        conn = self.lane_conns(lane).get(server_id)
+        written = 0
+        if requests and conn is not None:
             try:
-                _b = self.object_to_string(request)
-                self.remote_server_conns[server_id].settimeout(timeout)
-                message.send_message(self.remote_server_conns[server_id], _b)
-
-                return True
+                conn.settimeout(timeout)
+                frames, frames_size = [], 0
+                for request in requests:
+                    _b = self.object_to_string(request)
+                    if frames and frames_size + len(_b) > self.SEND_BATCH_MAX_BYTES:
+                        message.send_messages(conn, frames)
+                        written += len(frames)
+                        frames, frames_size = [], 0
+                    frames.append(_b)
+                    frames_size += len(_b)
+                message.send_messages(conn, frames)
+                written += len(frames)
             except IOError as e:
-                pass
+                # part of a frame may have gone out, the stream to the peer cannot be used any more
+                self.drop_connection(server_id, conn, lane)
                 # print(f'Issues connecting to the remote server {server_id} / {e}')
-        return False
+        return written
+
+    def lane_conns(self, lane):
+        return self.remote_server_conns if lane == LANE_CONTROL else self.remote_server_data_conns
+
+    def register_connection(self, peer_id, conn, replace=True, lane=LANE_CONTROL):
+        # conn becomes the connection the messages of lane to peer_id are sent on (unless there is one and not replace)
+        conns = self.lane_conns(lane)
+        with self.connections_lock:
+            if replace or conns.get(peer_id) is None:
+                conns[peer_id] = conn
+
+    def drop_connection(self, peer_id, conn, lane=LANE_CONTROL):
+        conns = self.lane_conns(lane)
+        with self.connections_lock:
+            if peer_id is not None and conns.get(peer_id) is conn:
+                conns[peer_id] = None
+        try:
+            conn.close()
+        except IOError:
+            pass
 
     def recv_from_socket(self, client_socket, timeout):
         try:
@@ -1030,34 +2621,85 @@ class RaftRunTime:
             # print(f'Issues receiving objects from the local server {self.local_server_conn} / {e}')
         return None
 
-    # TODO Optimize this function
-    def return_message_from_incoming_queue_with_ref_uuid(self, message_type, uuid_to_check):
-        start = time.time()
-        msg = None
-        while True:
+    def recv_from_reader(self, reader):
+        # returns the messages of every complete frame buffered by the reader, raises IOError once the
+        # connection is gone. Frames are decoded straight from the reader's buffer (no copy)
+        assert isinstance(reader, message.FrameReader)
+        objs = []
+        for frame in reader.read_frames():
             try:
-                if time.time() - start > 2:
-                    break
-                msg = self.incoming_queue.get_nowait()
-                if type(msg) == message_type and msg.ref_msg_uuid == uuid_to_check:
-                    break
-                else:
-                    if type(msg) != HeartBeatTick:
-                        self.incoming_queue.put_nowait(msg)
-            except Empty:
-                break
-        if type(msg) == message_type:
-            return msg
-        else:
+                objs.append(self.string_to_object(frame))
+            except IOError as e:
+                print(f'Dropping a malformed frame from the network / {e}')
+        return objs
+
+    def send_request(self, request):
+        # queue a request for the network and return the future its response will be delivered to
+        response_future = futures.Future()
+        with self.pending_requests_lock:
+            self.pending_requests[request.uuid] = response_future
+        self.outgoing_queue.put_nowait(request)
+        return response_future
+
+    def propose(self, server, command):
+        # submit a client command to this server, the future gets the ClientAppendResponse once the command
+        # is committed (wait on it with wait_for_response)
+        request = ClientAppendRequest(command=command, uuid=self.gen_uuid(), source=server.id,
+                                      destination=server.id, ref_msg_uuid=None)
+        response_future = futures.Future()
+        with self.pending_requests_lock:
+            self.pending_requests[request.uuid] = response_future
+        self.incoming_queue.put_nowait(request)
+        return request, response_future
+
+    def wait_for_response(self, request, response_future, timeout):
+        # returns None if no response came back within timeout
+        try:
+            return response_future.result(timeout)
+        except futures.TimeoutError:
             return None
+        finally:
+            self.cancel_request(request)
+
+    def abandoned(self, msg):
+        # True for a request nobody waits for the response of any more
+        if msg.ref_msg_uuid is not None:
+            return False
+        with self.pending_requests_lock:
+            return msg.uuid not in self.pending_requests
+
+    def cancel_request(self, request):
+        # stop waiting for the response of request, it will be dropped if it still comes in
+        with self.pending_requests_lock:
+            self.pending_requests.pop(request.uuid, None)
+
+    def fail_request(self, request):
+        # a request that will never be sent - whoever waits for its response gets None right away, as for a lost one
+        if request.ref_msg_uuid is not None:
+            return
+        with self.pending_requests_lock:
+            response_future = self.pending_requests.pop(request.uuid, None)
+        if response_future is not None:
+            response_future.set_result(None)
+
+    def complete_request(self, msg):
+        # returns True if msg was the response to a pending request and got delivered to it
+        if msg.ref_msg_uuid is None:
+            return False
+        with self.pending_requests_lock:
+            response_future = self.pending_requests.pop(msg.ref_msg_uuid, None)
+        if response_future is None:
+            return False
+        response_future.set_result(msg)
+        return True
 
     def setup_network_mesh(self, local_server):
-
-        # TODO : put the ability to auto reconnect to restarted servers
+        # peers are dialed when there is something to send them (see connect_to_peer), and dialed again after a
+        # connection dropped - a node starts without waiting for the others to be up
 
         try:
             # bind the server to its listening port
-            address_tuple = SERVER_ADDRESSES[server.id]
+            address_tuple = SERVER_ADDRESSES[local_server.id]
             server_socket = socket(AF_INET, SOCK_STREAM)
             server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, True)
             server_socket.bind(address_tuple)
@@ -1066,32 +2708,150 @@ class RaftRunTime:
 
             print(f'Server listening @ {address_tuple}')
         except Exception:
-            raise RuntimeError(f'Server unable to bind locally at {SERVER_ADDRESSES[server.id]}')
+            raise RuntimeError(f'Server unable to bind locally at {SERVER_ADDRESSES[local_server.id]}')
 
-        time.sleep(10)
 
-        # setup connections to peers
-        for k1 in _id_to_servers:
-            k2 = _id_to_servers[k1]
-            if k2 == local_server.id:
-                continue
-            address_tuple = SERVER_ADDRESSES[k2]
-            client_socket = socket(AF_INET, SOCK_STREAM)
-            try:
-                client_socket.connect(address_tuple)
-                print(f'Remote connection established to {k2} {address_tuple}')
-                self.remote_server_conns[k2] = client_socket
-            except Exception as e:
-                print(f'Connection could not be made to {k2} {address_tuple} / {e}')
-                self.remote_server_conns[k2] = None
+'''
+kv clients
+'''
+
+
+def kv_response_without_log(runtime, server, request):
+    # the response to a kv request that is answered right away - requests that cannot be executed here.
+    # None for a read (answered once a majority confirmed the leader, see start_read_index) or a request whose
+    # command has to be committed first
+    instruction = request.split() if request else []
+    if not instruction:
+        return message.UNRECOGNIZED_REQUEST
+    if runtime.application is None or server.role != RaftServerRole.LEADER:
+        return message.REQUEST_COULD_NOT_BE_EXECUTED
+    return None
+
+
+def is_kv_read(request):
+    return request.split()[0].upper() == instructions.GET_COMMAND
+
+
+def start_read_index(runtime, server):
+    # ReadIndex - a read is answered from the leader's state machine once a majority has acknowledged a heartbeat
+    # sent after the read came in, so a deposed leader (its heartbeats are refused in a later term, and it steps
+    # down on seeing that term) never answers one. Returns {response future: heartbeat} of the heartbeats, None while the leader cannot answer reads yet
+    # (nothing of its own term is committed, its commit index may be behind the one of its predecessor)
+    last_committed_index = server.log.last_committed_index
+    if last_committed_index == server.log.INIT_INDEX or server.log.term_at(last_committed_index) != server.current_term:
+        return None
+    pending = {}
+    for peer_id in server.fetch_peer_ids():
+        request_msg = AppendEntriesRequest(server.current_term, server.id, server.log.INIT_INDEX, 0, [],
+                                           last_committed_index, uuid=runtime.gen_uuid(), source=server.id,
+                                           destination=peer_id, ref_msg_uuid=None)
+        pending[runtime.send_request(request_msg)] = request_msg
+    return pending
+
+
+def tally_read_index(confirmations, pending, done):
+    # records the responses of the done futures (taken out of pending) and returns True once the leadership is
+    # settled - a majority acknowledged the heartbeats or too few peers are left to make one
+    for response_future in done:
+        request_msg = pending.pop(response_future)
+        response_msg = response_future.result()
+        confirmations[request_msg.destination] = response_msg is not None and response_msg.success
+    confirmed = list(confirmations.values()).count(True)
+    return confirmed > NUM_OF_SERVERS // 2 or confirmed + len(pending) <= NUM_OF_SERVERS // 2
+
+
+def cancel_read_index(runtime, pending):
+    for request_msg in pending.values():
+        runtime.cancel_request(request_msg)
+
+
+def read_confirmed(runtime, server, request, confirmations):
+    # the read, if a majority confirmed this server as the leader (server -> acknowledged)
+    if not won_votes(confirmations) or server.role != RaftServerRole.LEADER:
+        return message.REQUEST_COULD_NOT_BE_EXECUTED
+    # every entry committed by the time the heartbeats went out is applied under the commit lock
+    with runtime.commit_lock:
+        return runtime.application.read(request.split())
+
+
+def read_with_read_index(runtime, server, request):
+    pending = start_read_index(runtime, server)
+    if pending is None:
+        return message.REQUEST_COULD_NOT_BE_EXECUTED
+    confirmations = {server.id: True}
+    deadline = time.monotonic() + runtime.READ_INDEX_TIMEOUT
+    try:
+        while pending:
+            done, _ = futures.wait(pending, max(0, deadline - time.monotonic()), futures.FIRST_COMPLETED)
+            if not done or tally_read_index(confirmations, pending, done):
+                break
+    finally:
+        cancel_read_index(runtime, pending)
+    return read_confirmed(runtime, server, request, confirmations)
+
+
+def kickoff_kv_listener(runtime, server):
+    assert isinstance(runtime, RaftRunTime)
+    assert isinstance(server, RaftServer)
+
+    server_socket = socket(AF_INET, SOCK_STREAM)
+    server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, True)
+    server_socket.bind(KV_ADDRESSES[server.id])
+    server_socket.listen()
+    t = threading.Thread(target=kv_listener_loop, args=(runtime, server, server_socket,))
+    t.start()
+    print(f'{server.id} -> KV listener @ {KV_ADDRESSES[server.id]}')
+
+
+def kv_listener_loop(runtime, server, server_socket):
+    while True:
+        client_socket, client_address = server_socket.accept()
+        t = threading.Thread(target=serve_kv_client, args=(runtime, server, client_socket,))
+        t.start()
+
+
+def serve_kv_client(runtime, server, client_socket):
+    # the requests of a client are answered in order until it closes the connection
+    reader = message.FrameReader(client_socket, message.KV_RECV_BUFFER_SIZE)
+    try:
+        while True:
+            for frame in reader.read_frames():
+                request = message.decode_message_from_network(frame)
+                response = kv_response_without_log(runtime, server, request)
+                if response is None and is_kv_read(request):
+                    response = read_with_read_index(runtime, server, request)
+                if response is None:
+                    # answered once the leader committed and applied the command
+                    request_msg, response_future = runtime.propose(server, request)
+                    committed = runtime.wait_for_response(request_msg, response_future, runtime.KV_REQUEST_TIMEOUT)
+                    response = message.OK if committed else message.REQUEST_COULD_NOT_BE_EXECUTED
+                message.send_message(client_socket, message.encode_message_for_network_transfer(response))
+    except IOError:
+        pass
+    finally:
+        client_socket.close()
 
 
 def process_command_line_args(args):
+    args = [arg for arg in args if not arg.startswith('--')]
     if len(args) >= 2:
         return int(args[1])
     return None
 
 
+def process_log_dir_arg(args):
+    # optional directory of the server's write-ahead log, without it the log is kept in memory only
+    args = [arg for arg in args if not arg.startswith('--')]
+    if len(args) >= 3:
+        return args[2]
+    return None
+
+
+def process_runtime_arg(args):
+    # --asyncio runs the node on a single asyncio event loop instead of threads
+    return RUNTIME_ASYNCIO if '--asyncio' in args else RUNTIME_THREADS
+
+
 def test_append_entries(runtime, server):
     assert isinstance(runtime, RaftRunTime)
     assert isinstance(server, RaftServer)
@@ -1111,7 +2871,7 @@ def test_append_entries(runtime, server):
     print(f"1 - scenario: remote leader append")
     server.log.dump()
     log_entries = [LogEntry(command='set y 100', term=2, inserted_by=Servers.Server_1)]
-    _s, _t, _i = append_entries(runtime, server, leader_prev_index=len(server.log.log_entries) - 1, leader_prev_term=1,
+    _s, _t, _i = append_entries(runtime, server, leader_prev_index=server.log.length() - 1, leader_prev_term=1,
                                 entries_to_be_appended=log_entries)
     server.log.dump()
 
@@ -1120,7 +2880,7 @@ def test_append_entries(runtime, server):
     print(f"2 - scenario: remote leader append")
     server.log.dump()
     log_entries = [LogEntry(command='set z 100', term=2, inserted_by=Servers.Server_1)]
-    _s, _t, _i = append_entries(runtime, server, leader_prev_index=len(server.log.log_entries) - 1, leader_prev_term=2,
+    _s, _t, _i = append_entries(runtime, server, leader_prev_index=server.log.length() - 1, leader_prev_term=2,
                                 entries_to_be_appended=log_entries)
     server.log.dump()
 
@@ -1129,7 +2889,7 @@ def test_append_entries(runtime, server):
     print(f"3 - scenario: remote leader append")
     server.log.dump()
     log_entries = [LogEntry(command='set m 45', term=2, inserted_by=Servers.Server_3)]
-    _s, _t, _i = append_entries(runtime, server, leader_prev_index=len(server.log.log_entries) - 1, leader_prev_term=2,
+    _s, _t, _i = append_entries(runtime, server, leader_prev_index=server.log.length() - 1, leader_prev_term=2,
                                 entries_to_be_appended=log_entries)
     server.log.dump()
 
@@ -1203,6 +2963,8 @@ def test_handle_heartbeat_ticks_leader(runtime, server):
     server.current_term=1
     kickoff_heart_beat_timer(runtime, server)
     kickoff_incoming_messages_event_loop(runtime, server)
+    kickoff_follower_replication(runtime, server)
+    kickoff_client_request_ingestion(runtime, server)
 
     print('*** Request - 1 ***')
     r1 = ClientAppendRequest(command='set x 100', uuid=runtime.gen_uuid(), source=server.id, destination=server.id, ref_msg_uuid=None)
@@ -1239,6 +3001,8 @@ def test_network_transport(runtime, server):
         kickoff_network_to_incoming_queue_hydrator(runtime, server)
         kickoff_incoming_messages_event_loop(runtime, server)
         kickoff_heart_beat_timer(runtime, server)
+        kickoff_follower_replication(runtime, server)
+        kickoff_client_request_ingestion(runtime, server)
 
         print(f'{server.id} becoming the leader')
 
@@ -1253,7 +3017,7 @@ def test_network_transport(runtime, server):
         runtime.incoming_queue.put_nowait(r4)
         runtime.incoming_queue.put_nowait(r5)
 
-        print('After putting 5 messages ->', runtime.incoming_queue.qsize(), runtime.incoming_queue.queue)
+        print('After putting 5 messages ->', runtime.incoming_queue.qsize(), runtime.incoming_queue.lanes)
 
         # wait for follower to setup
         # time.sleep(10)
@@ -1286,6 +3050,8 @@ def test_network_transport(runtime, server):
         kickoff_network_to_incoming_queue_hydrator(runtime, server)
         kickoff_outgoing_queue_to_network(runtime, server)
         kickoff_heart_beat_timer(runtime, server)
+        kickoff_follower_replication(runtime, server)
+        kickoff_client_request_ingestion(runtime, server)
 
 
 def test_leader_election(runtime, server):
@@ -1295,19 +3061,28 @@ def test_leader_election(runtime, server):
     kickoff_network_to_incoming_queue_hydrator(runtime, server)
     kickoff_election_timeout_checker(runtime, server)
     kickoff_heart_beat_timer(runtime, server)
+    kickoff_follower_replication(runtime, server)
+    kickoff_client_request_ingestion(runtime, server)
 
 
 if __name__ == '__main__':
     _id = process_command_line_args(sys.argv)
     server_id = _id_to_servers[_id]
-    if server_id:
-        server = RaftServer(server_id)
-        log = RaftPersistentLog(server)
-        runtime = RaftRunTime()
+    if server_id and process_runtime_arg(sys.argv) == RUNTIME_ASYNCIO:
+        # raft_asyncio works with this module imported as raft, not with the classes of __main__
+        import raft_asyncio
+        raft_asyncio.main(_id, process_log_dir_arg(sys.argv))
+
+    elif server_id:
+        import kvserverThreaded
+        server = RaftServer(server_id, log_dir=process_log_dir_arg(sys.argv))
+        runtime = RaftRunTime(RaftApplication(kvserverThreaded), server_id=server_id)
+        runtime.restore_state(server)
         runtime.setup_network_mesh(server)
         test_leader_election(runtime, server)
+        kickoff_kv_listener(runtime, server)
         # test_network_transport(runtime, server)
         # test_handle_heartbeat_ticks_leader(runtime, server)
 
     else:
-        print(f'Provide number of the server to start. Example: $ python raft 0')
+        print(f'Provide number of the server to start. Example: $ python raft 0 [log directory] [--asyncio]')
@@ -0,0 +1,439 @@
+'''
+asyncio runtime for a raft node
+
+AsyncRaftRunTime runs a node on a single asyncio event loop instead of the threads of RaftRunTime. The election
+and heartbeat timers, the connections to and from the peers, the replication to each follower, the group commit
+of client requests and the kv listener are tasks of that loop, and requests wait for their response on asyncio
+futures. The consensus functions of raft.py (append_entries, grant_vote, handle_append_entries, the commit logic,
+the handling of replication responses) are used as they are, on the loop.
+
+Usage: $ python raft.py 0 [log directory] --asyncio
+'''
+import asyncio
+import functools
+import threading
+import time
+from collections import deque
+
+import kvserverThreaded
+import message
+
+import raft
+from raft import Servers, RaftServer, RaftServerRole, RaftRunTime, RaftApplication, AppendEntriesRequest, \
+    InstallSnapshotRequest, ClientAppendRequest, HeartBeatTick
+
+
+class _LoopQueue:
+    # stands in for the incoming queue of RaftRunTime - a message put on it is handled on the event loop
+    # (make_leader queues its no-op and the client requests it parked, any thread may propose)
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def put_nowait(self, msg):
+        runtime = self.runtime
+        if threading.get_ident() == runtime.loop_thread:
+            runtime.loop.call_soon(raft.handle_incoming_message, runtime, runtime.server, msg)
+        else:
+            runtime.loop.call_soon_threadsafe(raft.handle_incoming_message, runtime, runtime.server, msg)
+
+
+class _PeerWriter:
+    # stands in for the outgoing queue of RaftRunTime - a message goes to the connection of its destination
+    # right away, the transport buffers it until the socket takes it
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def put_nowait(self, msg):
+        self.runtime.send_to_peer(msg)
+
+
+class AsyncRaftRunTime(RaftRunTime):
+
+    # bytes buffered for a peer that stopped reading before messages to it are dropped. Requests to it time out
+    # like lost ones
+    PEER_WRITE_BUFFER_LIMIT = 8 * 1024 * 1024
+
+    def __init__(self, application=None, wire_format=None, server_id=None):
+        super().__init__(application, wire_format, server_id)
+        self.loop = None
+        self.loop_thread = None
+        self.server = None
+        self.incoming_queue = _LoopQueue(self)
+        self.outgoing_queue = _PeerWriter(self)
+        self.client_requests = asyncio.Queue()
+        self.replication_triggers = {server_id: asyncio.Event() for server_id in Servers}
+        # set and replaced by a new one on every role change
+        self.role_event = asyncio.Event()
+        # peer -> asyncio.StreamWriter of the connection this node sends to it on
+        self.peer_writers = {}
+
+    def set_role(self, server, role):
+        super().set_role(server, role)
+        self.role_event.set()
+        self.role_event = asyncio.Event()
+
+    async def wait_until_role(self, server, roles):
+        while server.role not in roles:
+            await self.role_event.wait()
+
+    def send_to_peer(self, msg):
+        writer = self.peer_writers.get(msg.destination)
+        if writer is None or writer.transport.get_write_buffer_size() > self.PEER_WRITE_BUFFER_LIMIT:
+            return False
+        _b = self.object_to_string(msg)
+        writer.writelines([message.frame_header(_b), _b])
+        return True
+
+    def send_request(self, request):
+        # the response is delivered to an asyncio future (by complete_request, on the loop)
+        response_future = self.loop.create_future()
+        with self.pending_requests_lock:
+            self.pending_requests[request.uuid] = response_future
+        self.send_to_peer(request)
+        return response_future
+
+    async def request(self, request, timeout):
+        # sends a request to a peer and returns its response, None if none came back within timeout
+        return await self._response(request, self.send_request(request), timeout)
+
+    async def submit(self, server, command, timeout):
+        # proposes a command on this node, returns the ClientAppendResponse once it is committed (None on timeout)
+        request = ClientAppendRequest(command=command, uuid=self.gen_uuid(), source=server.id,
+                                      destination=server.id, ref_msg_uuid=None)
+        response_future = self.loop.create_future()
+        with self.pending_requests_lock:
+            self.pending_requests[request.uuid] = response_future
+        raft.handle_incoming_message(self, server, request)
+        return await self._response(request, response_future, timeout)
+
+    async def _response(self, request, response_future, timeout):
+        try:
+            return await asyncio.wait_for(response_future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.cancel_request(request)
+
+
+async def read_frame(reader):
+    size = int(await reader.readexactly(message.HEADER_SIZE))
+    return await reader.readexactly(size)
+
+
+async def wait_for_trigger(trigger, timeout):
+    # threading.Event.wait(timeout) of an asyncio.Event
+    try:
+        await asyncio.wait_for(trigger.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+'''
+node
+'''
+
+
+async def run_node(runtime, server, kv_listener=True):
+    assert isinstance(runtime, AsyncRaftRunTime)
+    assert isinstance(server, RaftServer)
+
+    runtime.loop = asyncio.get_running_loop()
+    runtime.loop_thread = threading.get_ident()
+    runtime.server = server
+    runtime.make_follower(server)
+
+    # peers connect to this node to send their messages, nothing is sent back on those connections
+    await asyncio.start_server(functools.partial(serve_peer, runtime, server), *raft.SERVER_ADDRESSES[server.id])
+    print(f'Server listening @ {raft.SERVER_ADDRESSES[server.id]}')
+    if kv_listener:
+        await asyncio.start_server(functools.partial(serve_kv_client, runtime, server), *raft.KV_ADDRESSES[server.id])
+        print(f'{server.id} -> KV listener @ {raft.KV_ADDRESSES[server.id]}')
+
+    tasks = [election_timeout_checker(runtime, server),
+             heart_beat_timer_loop(runtime, server),
+             client_request_ingestion_loop(runtime, server)]
+    for peer_id in server.fetch_peer_ids():
+        tasks.append(keep_connected(runtime, server, peer_id))
+        tasks.append(follower_replication_loop(runtime, server, peer_id))
+    await asyncio.gather(*tasks)
+
+
+async def keep_connected(runtime, server, peer_id):
+    # the connection this node sends to peer_id on, opened again whenever it drops (backing off like the senders
+    # of the threaded runtime)
+    retry_interval = 0
+    while True:
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*runtime.peer_addresses[peer_id]),
+                                                    runtime.CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            retry_interval = raft.next_retry_interval(runtime, retry_interval)
+            await asyncio.sleep(raft.jittered(retry_interval))
+            continue
+        retry_interval = 0
+        raft.configure_peer_socket(runtime, writer.get_extra_info('socket'))
+        print(f'Remote connection established to {peer_id} {runtime.peer_addresses[peer_id]}')
+        runtime.peer_writers[peer_id] = writer
+        try:
+            # nothing comes back on this connection, reading only tells when it is gone
+            await reader.read()
+        except OSError:
+            pass
+        runtime.peer_writers.pop(peer_id, None)
+        writer.close()
+
+
+async def serve_peer(runtime, server, reader, writer):
+    try:
+        while True:
+            # a connection that is gone ends the loop (the reader raises its error again on every read), only a
+            # frame that does not decode is skipped
+            frame = await read_frame(reader)
+            try:
+                obj = runtime.string_to_object(frame)
+            except IOError as e:
+                print(f'Dropping a malformed frame from the network / {e}')
+                continue
+            raft.step_down_for_later_term(runtime, server, obj)
+            # responses go straight to the request waiting for them
+            if runtime.complete_request(obj):
+                continue
+            if type(obj) == AppendEntriesRequest or type(obj) == InstallSnapshotRequest:
+                raft.register_leader_last_contact(runtime, server, obj)
+            raft.handle_incoming_message(runtime, server, obj)
+    except (EOFError, OSError, ValueError) as e:
+        print(f'{e} while reading from the network')
+    finally:
+        writer.close()
+
+
+'''
+timers
+'''
+
+
+async def election_timeout_checker(runtime, server):
+    if raft.fast_track_to_leader(runtime, server):
+        return
+
+    while True:
+        # a leader waits here until it steps down
+        await runtime.wait_until_role(server, {RaftServerRole.FOLLOWER, RaftServerRole.CANDIDATE})
+        # sleep until the election timeout, and on for as long as the leader pushed it back meanwhile
+        wait_period = raft.election_wait_period(runtime)
+        while wait_period > 0:
+            await asyncio.sleep(wait_period)
+            wait_period = raft.election_wait_period(runtime)
+
+        raft.reset_election_timer(runtime)
+        # with PreVote the server first asks if it could win, and stays a follower in its term if not
+        if runtime.PRE_VOTE and not raft.won_votes(await collect_votes(runtime, server, pre_vote=True)):
+            continue
+
+        runtime.role_change_follower_to_candidate(server)
+        raft.conclude_election(runtime, server, await collect_votes(runtime, server))
+
+
+async def collect_votes(runtime, server, pre_vote=False):
+    # votes are requested from every peer at once and counted as they come in
+    pending = raft.send_vote_requests(runtime, server, pre_vote)
+    peer_responses = {server.id: True}
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=max(0, raft.election_wait_period(runtime)),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done or raft.tally_votes(server, peer_responses, pending, done):
+                break
+    finally:
+        raft.cancel_vote_requests(runtime, peer_responses, pending)
+    return peer_responses
+
+
+async def heart_beat_timer_loop(runtime, server):
+    msg = HeartBeatTick(runtime.gen_uuid(), server.id, server.id)
+    while True:
+        await runtime.wait_until_role(server, {RaftServerRole.LEADER})
+        await asyncio.sleep(runtime.HEARTBEAT_TIMER)
+        raft.handle_incoming_message(runtime, server, msg)
+
+
+'''
+group commit of client requests on the leader
+'''
+
+
+async def client_request_ingestion_loop(runtime, server):
+    while True:
+        received_at, msg = await runtime.client_requests.get()
+        batch = [msg]
+
+        # take everything already queued, then linger up to the batching window for more
+        lingered = 0
+        deadline = time.monotonic() + runtime.ingest_window
+        while len(batch) < runtime.INGEST_MAX_BATCH:
+            try:
+                batch.append(runtime.client_requests.get_nowait()[1])
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append((await asyncio.wait_for(runtime.client_requests.get(), remaining))[1])
+                lingered += 1
+            except asyncio.TimeoutError:
+                break
+
+        raft.append_client_requests(runtime, server, batch, lingered, received_at)
+
+
+'''
+replication to the followers - the same rounds as the replication workers of raft.py
+'''
+
+
+async def follower_replication_loop(runtime, server, follower_id):
+    trigger = runtime.replication_triggers[follower_id]
+    while True:
+        await runtime.wait_until_role(server, {RaftServerRole.LEADER})
+
+        # wait for a heartbeat tick or for new entries in the leader's log
+        await trigger.wait()
+        trigger.clear()
+
+        if server.role == RaftServerRole.LEADER:
+            await replicate_to_follower(runtime, server, follower_id)
+
+
+async def replicate_to_follower(runtime, server, follower_id):
+    i = follower_id.value
+
+    if server.next_index[i] <= server.log.base_index:
+        if not await install_snapshot_on_follower(runtime, server, follower_id):
+            return
+
+    if not server.follower_matched[i]:
+        if not await probe_follower(runtime, server, follower_id):
+            return
+    elif server.next_index[i] >= server.log.length():
+        await send_heartbeat(runtime, server, follower_id)
+        return
+
+    await pipeline_to_follower(runtime, server, follower_id)
+
+
+async def send_heartbeat(runtime, server, follower_id):
+    request_msg = raft.make_append_entries_request(runtime, server, follower_id, server.next_index[follower_id.value])
+    if request_msg is None:
+        runtime.replication_triggers[follower_id].set()
+        return
+    response_msg = await runtime.request(request_msg, runtime.APPEND_ENTRIES_RESPONSE_TIMEOUT)
+    raft.handle_heartbeat_response(runtime, server, follower_id, response_msg)
+
+
+async def probe_follower(runtime, server, follower_id):
+    i = follower_id.value
+    while True:
+        if server.role != RaftServerRole.LEADER:
+            return False
+
+        # the log may have been compacted past next_index since the last round
+        server.next_index[i] = max(server.next_index[i], server.log.base_index + 1)
+
+        request_msg = raft.make_append_entries_request(runtime, server, follower_id, server.next_index[i])
+        if request_msg is None:
+            runtime.replication_triggers[follower_id].set()
+            return False
+        response_msg = await runtime.request(request_msg, runtime.APPEND_ENTRIES_RESPONSE_TIMEOUT)
+        matched = raft.handle_probe_response(runtime, server, follower_id, response_msg)
+        if matched is not None:
+            return matched
+
+
+async def install_snapshot_on_follower(runtime, server, follower_id):
+    trigger = runtime.replication_triggers[follower_id]
+    transfer = raft.SnapshotTransfer(runtime, server, follower_id)
+    try:
+        while server.role == RaftServerRole.LEADER:
+            transfer.send_chunks(runtime, server)
+
+            await wait_for_trigger(trigger, runtime.INSTALL_SNAPSHOT_RESPONSE_TIMEOUT)
+            trigger.clear()
+
+            installed = transfer.handle_responses(runtime, server)
+            if installed is not None:
+                return installed
+    finally:
+        transfer.close()
+    return False
+
+
+async def pipeline_to_follower(runtime, server, follower_id):
+    trigger = runtime.replication_triggers[follower_id]
+    in_flight = deque()     # (request_msg, response_future, sent_at) in the order requests were sent
+    last_heartbeat = 0
+
+    while server.role == RaftServerRole.LEADER:
+
+        raft.fill_replication_window(runtime, server, follower_id, in_flight)
+        if not in_flight:
+            return
+        last_heartbeat = raft.heartbeat_while_pipelining(runtime, server, follower_id, in_flight, last_heartbeat)
+
+        await wait_for_trigger(trigger, runtime.APPEND_ENTRIES_RESPONSE_TIMEOUT)
+        trigger.clear()
+
+        if not raft.handle_replication_responses(runtime, server, follower_id, in_flight):
+            return
+
+
+'''
+kv clients
+'''
+
+
+async def read_with_read_index(runtime, server, request):
+    # raft.read_with_read_index on the loop
+    pending = raft.start_read_index(runtime, server)
+    if pending is None:
+        return message.REQUEST_COULD_NOT_BE_EXECUTED
+    confirmations = {server.id: True}
+    deadline = time.monotonic() + runtime.READ_INDEX_TIMEOUT
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=max(0, deadline - time.monotonic()),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done or raft.tally_read_index(confirmations, pending, done):
+                break
+    finally:
+        raft.cancel_read_index(runtime, pending)
+    return raft.read_confirmed(runtime, server, request, confirmations)
+
+
+async def serve_kv_client(runtime, server, reader, writer):
+    # the requests of a client are answered in order until it closes the connection
+    try:
+        while True:
+            request = message.decode_message_from_network(await read_frame(reader))
+            response = raft.kv_response_without_log(runtime, server, request)
+            if response is None and raft.is_kv_read(request):
+                response = await read_with_read_index(runtime, server, request)
+            if response is None:
+                committed = await runtime.submit(server, request, runtime.KV_REQUEST_TIMEOUT)
+                response = message.OK if committed else message.REQUEST_COULD_NOT_BE_EXECUTED
+            _b = message.encode_message_for_network_transfer(response)
+            writer.writelines([message.frame_header(_b), _b])
+    except (EOFError, OSError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+def main(server_number, log_dir=None):
+    server = RaftServer(raft._id_to_servers[server_number], log_dir=log_dir)
+    runtime = AsyncRaftRunTime(RaftApplication(kvserverThreaded), server_id=server.id)
+    runtime.restore_state(server)
+    asyncio.run(run_node(runtime, server))
@@ -0,0 +1,676 @@
+'''
+Durable segmented write-ahead log
+
+The log is a directory of append-only segment files, each named after the index of its first record, plus a small
+metadata file holding the current term and the last vote and the latest snapshot of the state machine. Segments are preallocated so an append does not change
+the file size (fdatasync does not have to flush file metadata) and every record carries a CRC32 so a torn write at
+the tail is detected and cut off on recovery.
+
+    segment = header (magic, version, first index) + records, zero filled up to the preallocated size
+    record  = payload length (u32) + crc32 of the payload (u32) + payload
+
+Records are opaque bytes, encoding them is up to the caller (see RecordList for a decoded, list-like view).
+Reads go through read-only memory maps of the segments. A sealed segment also gets an index file with the offset
+of each of its records, so a restart loads that index instead of scanning the segment.
+
+    snapshot = header (magic, version, last included index / term, base index / term) + state machine + crc32
+
+A snapshot is written chunk by chunk to a partial file (SnapshotWriter) which only replaces the current snapshot
+once complete, and read back in chunks (SnapshotReader) so neither side needs the whole of it in memory.
+'''
+import mmap
+import os
+import struct
+import threading
+import zlib
+from array import array
+
+SEGMENT_MAGIC = b'RWAL'
+META_MAGIC = b'RMTA'
+SNAPSHOT_MAGIC = b'RSNP'
+VERSION = 1
+
+# fsync policies
+FSYNC_ENTRY = 'entry'          # fsync after every record
+FSYNC_BATCH = 'batch'          # one fsync per append() call, however many records it carries
+FSYNC_INTERVAL = 'interval'    # fsync in the background every interval, a crash may lose the last interval of appends
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+META_FILE = 'meta'
+SNAPSHOT_FILE = 'snapshot'
+
+_SEGMENT_HEADER = struct.Struct('>4sBq')
+_RECORD_HEADER = struct.Struct('>II')
+_META = struct.Struct('>4sBqqq')     # magic, version, current term, term of the last vote, voted for
+_SNAPSHOT_HEADER = struct.Struct('>4sBqqqq')     # magic, version, last included index / term, base index / term
+_CRC = struct.Struct('>I')
+_ZEROS = bytes(64 * 1024)
+# bytes of state machine per chunk when a snapshot is read back to restore it
+SNAPSHOT_READ_SIZE = 1024 * 1024
+
+
+def _open(path):
+    return os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+
+
+def _write_at(fd, offset, data):
+    os.lseek(fd, offset, os.SEEK_SET)
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _read_at(fd, offset, size):
+    # a single pread returns at most about 2GB on linux
+    chunks = []
+    while size > 0:
+        chunk = os.pread(fd, size, offset)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        offset += len(chunk)
+        size -= len(chunk)
+    return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+
+def _zero_range(fd, start, end):
+    while start < end:
+        size = min(end - start, len(_ZEROS))
+        _write_at(fd, start, _ZEROS[:size])
+        start += size
+
+
+def _sync(fd):
+    # data only where possible, the size of a preallocated segment does not change on append
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def _sync_directory(directory):
+    # makes creating, renaming and removing files durable (directories cannot be opened on windows)
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _write_file_atomically(path, data):
+    # written to a temporary file and renamed over the old one, a crash leaves either the old or the new file
+    fd = _open(path + '.tmp')
+    try:
+        os.ftruncate(fd, 0)
+        _write_at(fd, 0, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(path + '.tmp', path)
+    _sync_directory(os.path.dirname(path))
+
+
+def _preallocate(fd, size):
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+
+class _Segment:
+
+    def __init__(self, path, first_index):
+        self.path = path
+        self.index_path = path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        self.first_index = first_index
+        # file offset of every record in the segment
+        self.offsets = array('I')
+        # file offset right after the last record
+        self.end = _SEGMENT_HEADER.size
+        # only the active (last) segment is kept open for writing
+        self.fd = None
+        # read only memory map, opened on the first read
+        self.map = None
+
+    def next_index(self):
+        return self.first_index + len(self.offsets)
+
+
+class SegmentedLog:
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, fsync_policy=FSYNC_BATCH, fsync_interval=0.01):
+        assert fsync_policy in {FSYNC_ENTRY, FSYNC_BATCH, FSYNC_INTERVAL}
+        # record offsets are 32 bit
+        assert segment_size < 1 << 32
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.segments = []
+        # appended but not yet synced (interval policy)
+        self.dirty = False
+        self.current_term, self.vote_term, self.voted_for = 0, -1, -1
+        # (last included index, last included term, base index, base term) of the saved snapshot
+        self.snapshot_info = (-1, 0, -1, 0)
+        self.closed = threading.Event()
+        self._recover()
+        if fsync_policy == FSYNC_INTERVAL:
+            t = threading.Thread(target=self._sync_loop, daemon=True)
+            t.start()
+
+    def __len__(self):
+        return self.segments[-1].next_index()
+
+    '''
+    recovery
+    '''
+
+    def _recover(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        torn = False
+        for n, name in enumerate(names):
+            segment = _Segment(os.path.join(self.directory, name), int(name[:-len(SEGMENT_SUFFIX)]))
+            # compaction removes whole segments from the start, the log does not have to start at 0
+            next_index = self.segments[-1].next_index() if self.segments else segment.first_index
+            if segment.first_index != next_index or not self._valid_header(segment):
+                # a missing or unreadable segment ends the log
+                self._remove([], names[n:])
+                break
+            # sealed segments come with the offsets of their records, the others are scanned
+            torn = not (self._load_index(segment) or self._scan(segment))
+            self.segments.append(segment)
+            if torn:
+                # so does a torn or corrupt record, whatever comes after it was never acknowledged
+                self._remove([], names[n + 1:])
+                break
+
+        if self.segments:
+            self._open_active(self.segments[-1], zero_tail=torn)
+        else:
+            self.segments.append(self._create_segment(0))
+        self._load_metadata()
+        self._load_snapshot_info()
+
+    def _remove(self, segments, names=()):
+        # last segment first, so a crash half way leaves a prefix of the log
+        paths = [segment.path for segment in segments] + [os.path.join(self.directory, name) for name in names]
+        for path in reversed(paths):
+            index_path = path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            os.remove(path)
+        if paths:
+            _sync_directory(self.directory)
+
+    def _valid_header(self, segment):
+        with open(segment.path, 'rb') as f:
+            data = f.read(_SEGMENT_HEADER.size)
+        if len(data) < _SEGMENT_HEADER.size:
+            return False
+        magic, version, first_index = _SEGMENT_HEADER.unpack(data)
+        return magic == SEGMENT_MAGIC and version == VERSION and first_index == segment.first_index
+
+    def _load_index(self, segment):
+        # offsets of a sealed segment from its index file, False if there is no usable index
+        try:
+            with open(segment.index_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        if len(data) < _CRC.size or zlib.crc32(data[:-_CRC.size]) != _CRC.unpack_from(data, len(data) - _CRC.size)[0]:
+            return False
+        segment.offsets.frombytes(data[:-_CRC.size])
+        segment.end = os.path.getsize(segment.path)
+        if segment.offsets:
+            # the last record has to end where the sealed segment ends
+            size, _ = _RECORD_HEADER.unpack(self._mapping(segment)[segment.offsets[-1]:segment.offsets[-1] + _RECORD_HEADER.size])
+            if segment.offsets[-1] + _RECORD_HEADER.size + size != segment.end:
+                del segment.offsets[:]
+                segment.end = _SEGMENT_HEADER.size
+                return False
+        return True
+
+    def _scan(self, segment):
+        # rebuilds the offsets of a segment, returns False if it ends with a torn or corrupt record
+        data = self._mapping(segment)
+        pos = _SEGMENT_HEADER.size
+        while pos + _RECORD_HEADER.size <= len(data):
+            size, crc = _RECORD_HEADER.unpack_from(data, pos)
+            if size == 0 and crc == 0:
+                # preallocated space, end of the segment
+                return True
+            start = pos + _RECORD_HEADER.size
+            if start + size > len(data) or zlib.crc32(data[start:start + size]) != crc:
+                return False
+            segment.offsets.append(pos)
+            pos = start + size
+            segment.end = pos
+        return True
+
+    def _load_metadata(self):
+        try:
+            with open(os.path.join(self.directory, META_FILE), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if len(data) != _META.size + _CRC.size or zlib.crc32(data[:_META.size]) != _CRC.unpack_from(data, _META.size)[0]:
+            raise IOError(f'Corrupt metadata file in {self.directory}')
+        magic, version, self.current_term, self.vote_term, self.voted_for = _META.unpack_from(data, 0)
+        if magic != META_MAGIC or version != VERSION:
+            raise IOError(f'Unsupported metadata file in {self.directory}')
+
+    def _load_snapshot_info(self):
+        # only the header, the snapshot itself is checked when it is loaded
+        try:
+            with open(os.path.join(self.directory, SNAPSHOT_FILE), 'rb') as f:
+                data = f.read(_SNAPSHOT_HEADER.size)
+        except FileNotFoundError:
+            return
+        if len(data) < _SNAPSHOT_HEADER.size:
+            raise IOError(f'Corrupt snapshot file in {self.directory}')
+        magic, version, *info = _SNAPSHOT_HEADER.unpack(data)
+        if magic != SNAPSHOT_MAGIC or version != VERSION:
+            raise IOError(f'Unsupported snapshot file in {self.directory}')
+        self.snapshot_info = tuple(info)
+
+    '''
+    segments
+    '''
+
+    def _create_segment(self, first_index):
+        segment = _Segment(os.path.join(self.directory, f'{first_index:020d}{SEGMENT_SUFFIX}'), first_index)
+        segment.fd = _open(segment.path)
+        _preallocate(segment.fd, self.segment_size)
+        _write_at(segment.fd, 0, _SEGMENT_HEADER.pack(SEGMENT_MAGIC, VERSION, first_index))
+        _sync(segment.fd)
+        _sync_directory(self.directory)
+        return segment
+
+    def _open_active(self, segment, zero_tail=False):
+        # the segment is written again, its index (if sealed) no longer holds
+        if os.path.exists(segment.index_path):
+            os.remove(segment.index_path)
+            _sync_directory(self.directory)
+        self._unmap(segment)
+        segment.fd = _open(segment.path)
+        size = os.fstat(segment.fd).st_size
+        if zero_tail:
+            # clears what is left of a torn record so it can never be read back after newer appends
+            _zero_range(segment.fd, segment.end, size)
+        if size < self.segment_size:
+            _preallocate(segment.fd, self.segment_size)
+        _sync(segment.fd)
+
+    def _seal(self, segment):
+        # a sealed segment is trimmed to its records and never written again, the index of its records is saved
+        self._unmap(segment)
+        _sync(segment.fd)
+        os.ftruncate(segment.fd, segment.end)
+        os.fsync(segment.fd)
+        os.close(segment.fd)
+        segment.fd = None
+        data = segment.offsets.tobytes()
+        _write_file_atomically(segment.index_path, data + _CRC.pack(zlib.crc32(data)))
+
+    def _mapping(self, segment, end=0):
+        # read only map of the segment covering at least its first end bytes
+        if segment.map is None or len(segment.map) < end:
+            self._unmap(segment)
+            if segment.fd is not None:
+                segment.map = mmap.mmap(segment.fd, 0, access=mmap.ACCESS_READ)
+            else:
+                with open(segment.path, 'rb') as f:
+                    segment.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return segment.map
+
+    def _unmap(self, segment):
+        if segment.map is not None:
+            segment.map.close()
+            segment.map = None
+
+    def _roll(self):
+        segment = self.segments[-1]
+        self._seal(segment)
+        self.segments.append(self._create_segment(segment.next_index()))
+        return self.segments[-1]
+
+    '''
+    writes
+    '''
+
+    def append(self, records):
+        with self.lock:
+            segment = self.segments[-1]
+            buf = bytearray()
+            for record in records:
+                size = _RECORD_HEADER.size + len(record)
+                # roll over when the segment is full (a record bigger than a whole segment gets one to itself)
+                if segment.end + len(buf) + size > self.segment_size and (segment.offsets or buf):
+                    self._write(segment, buf)
+                    segment = self._roll()
+                    buf = bytearray()
+                segment.offsets.append(segment.end + len(buf))
+                buf += _RECORD_HEADER.pack(len(record), zlib.crc32(record))
+                buf += record
+                if self.fsync_policy == FSYNC_ENTRY:
+                    self._write(segment, buf)
+                    _sync(segment.fd)
+                    buf = bytearray()
+            self._write(segment, buf)
+            if self.fsync_policy == FSYNC_BATCH:
+                _sync(segment.fd)
+            elif self.fsync_policy == FSYNC_INTERVAL:
+                self.dirty = True
+
+    def _write(self, segment, buf):
+        if buf:
+            _write_at(segment.fd, segment.end, buf)
+            segment.end += len(buf)
+
+    def truncate(self, index):
+        # removes the records from index onwards
+        with self.lock:
+            if index >= len(self):
+                return
+            # later segments go first, so a crash half way leaves a prefix of the old log
+            while len(self.segments) > 1 and self.segments[-1].first_index >= index:
+                segment = self.segments.pop()
+                self._unmap(segment)
+                os.close(segment.fd)
+                self._remove([segment])
+                if self.segments[-1].fd is None:
+                    self._open_active(self.segments[-1])
+            segment = self.segments[-1]
+            if index < segment.next_index():
+                cut = segment.offsets[index - segment.first_index]
+                _zero_range(segment.fd, cut, segment.end)
+                del segment.offsets[index - segment.first_index:]
+                segment.end = cut
+            _sync(segment.fd)
+
+    def discard_before(self, index):
+        # removes the sealed segments holding nothing but records before index (log compaction).
+        # Oldest first, so a crash half way still leaves a contiguous log
+        with self.lock:
+            while len(self.segments) > 1 and self.segments[0].next_index() <= index:
+                segment = self.segments.pop(0)
+                self._unmap(segment)
+                self._remove([segment])
+
+    def sync(self):
+        with self.lock:
+            _sync(self.segments[-1].fd)
+            self.dirty = False
+
+    def _sync_loop(self):
+        while not self.closed.wait(self.fsync_interval):
+            if self.dirty:
+                self.sync()
+
+    def save_metadata(self, current_term, vote_term, voted_for):
+        data = _META.pack(META_MAGIC, VERSION, current_term, vote_term, voted_for)
+        _write_file_atomically(os.path.join(self.directory, META_FILE), data + _CRC.pack(zlib.crc32(data)))
+        self.current_term, self.vote_term, self.voted_for = current_term, vote_term, voted_for
+
+    def reset(self, next_index):
+        # drops every record, the log continues at next_index (a snapshot received from the leader replaces it)
+        with self.lock:
+            segments, self.segments = self.segments, []
+            for segment in segments:
+                self._unmap(segment)
+                if segment.fd is not None:
+                    os.close(segment.fd)
+            self._remove(segments)
+            self.segments.append(self._create_segment(next_index))
+            self.dirty = False
+
+    def save_snapshot(self, last_included_index, last_included_term, base_index, base_term, snapshot):
+        writer = self.snapshot_writer(last_included_index, last_included_term, base_index, base_term)
+        writer.write(snapshot)
+        writer.finish()
+        self.install_snapshot(writer)
+
+    def snapshot_writer(self, last_included_index, last_included_term, base_index, base_term, suffix='.partial'):
+        # snapshots written at the same time (one received from the leader, one taken locally) need their own suffix
+        return SnapshotWriter(os.path.join(self.directory, SNAPSHOT_FILE),
+                              last_included_index, last_included_term, base_index, base_term, suffix)
+
+    def install_snapshot(self, writer):
+        # a finished snapshot from snapshot_writer() becomes the saved snapshot
+        assert isinstance(writer, SnapshotWriter)
+        writer.publish()
+        self.snapshot_info = writer.info
+
+    def snapshot_reader(self):
+        # reader of the saved snapshot, None if there is none
+        try:
+            return SnapshotReader(os.path.join(self.directory, SNAPSHOT_FILE))
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            for segment in self.segments:
+                self._unmap(segment)
+                if segment.fd is not None:
+                    _sync(segment.fd)
+                    os.close(segment.fd)
+                    segment.fd = None
+
+    '''
+    reads
+    '''
+
+    def first_index(self):
+        return self.segments[0].first_index
+
+    def active_first_index(self):
+        return self.segments[-1].first_index
+
+    def record(self, index):
+        # payload of one record, read from the memory map of its segment
+        with self.lock:
+            if not self.segments[0].first_index <= index < len(self):
+                raise IndexError(f'record {index} is not in the log')
+            for segment in reversed(self.segments):
+                if segment.first_index <= index:
+                    break
+            pos = segment.offsets[index - segment.first_index]
+            start = pos + _RECORD_HEADER.size
+            size, crc = _RECORD_HEADER.unpack_from(self._mapping(segment, start), pos)
+            payload = self._mapping(segment, start + size)[start:start + size]
+        if zlib.crc32(payload) != crc:
+            raise IOError(f'Corrupt record {index} in {segment.path}')
+        return payload
+
+    def bytes_between(self, start, stop):
+        # on-disk size of the records from index start up to stop
+        with self.lock:
+            total = 0
+            for segment in self.segments:
+                a, b = max(start, segment.first_index), min(stop, segment.next_index())
+                if a < b:
+                    end = segment.offsets[b - segment.first_index] if b < segment.next_index() else segment.end
+                    total += end - segment.offsets[a - segment.first_index]
+            return total
+
+    def records(self, start=0, stop=None):
+        # payloads of the records from index start up to stop (the end of the log by default)
+        stop = len(self) if stop is None else min(stop, len(self))
+        for index in range(start, stop):
+            yield self.record(index)
+
+
+class RecordList:
+    '''
+    List-like view of a SegmentedLog, items are encoded on the way in and decoded on access.
+    The items of the active segment (the part of the log read the most) are also kept decoded in memory,
+    older ones are decoded from the memory-mapped segments when read.
+
+    Item 0 is the record at index start of the log (the records before it have been compacted away).
+    Supports len(), [i], [start:stop], iteration, extend(), del [i:] (truncation) and del [:i] (compaction).
+    The cached items are kept in a tail_factory() container, which has to support the same (a list by default)
+    '''
+
+    def __init__(self, log, encode, decode, start=0, tail_factory=list):
+        assert isinstance(log, SegmentedLog)
+        if not log.first_index() <= start <= len(log):
+            raise IOError(f'Log records start at {log.first_index()}, {start} is out of the log')
+        self.log = log
+        self.encode = encode
+        self.decode = decode
+        self.start = start
+        self.tail_factory = tail_factory
+        # (log index of the first cached item, cached items). Replaced as a whole, so a reader always sees a
+        # consistent pair
+        self.tail = (len(log), tail_factory())
+
+    def __len__(self):
+        return len(self.log) - self.start
+
+    def __getitem__(self, key):
+        tail_start, tail = self.tail
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            assert step == 1
+            start, stop = start + self.start, stop + self.start
+            items = [self.decode(record) for record in self.log.records(start, min(stop, tail_start))]
+            if stop > tail_start:
+                items.extend(tail[max(start, tail_start) - tail_start:stop - tail_start])
+            return items
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(f'item {key} is not in the list')
+        index = key + self.start
+        if index >= tail_start and index - tail_start < len(tail):
+            return tail[index - tail_start]
+        return self.decode(self.log.record(index))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def extend(self, items):
+        items = list(items)
+        self.log.append([self.encode(item) for item in items])
+        tail_start, tail = self.tail
+        tail.extend(items)
+        # only the items of the active segment stay cached
+        first = self.log.active_first_index()
+        if first > tail_start:
+            self.tail = (first, tail[first - tail_start:])
+
+    def __delitem__(self, key):
+        assert isinstance(key, slice) and key.step is None and (key.start is None or key.stop is None)
+        tail_start, tail = self.tail
+        if key.stop is None:
+            # truncation of the end of the log
+            index = self.start + (key.start or 0)
+            self.log.truncate(index)
+            self.tail = (tail_start, tail[:index - tail_start]) if index >= tail_start else (index, self.tail_factory())
+        else:
+            # compaction of the start of the log, whole segments go once nothing in them is needed any more
+            self.start += min(key.stop, len(self))
+            self.log.discard_before(self.start)
+            if tail_start < self.start:
+                self.tail = (self.start, tail[self.start - tail_start:])
+
+
+class SnapshotWriter:
+    '''
+    Writes a snapshot file chunk by chunk. The chunks go to a partial file next to it, finish() completes it and
+    publish() renames it over the snapshot file, so a crash half way leaves the previous snapshot in place.
+    finish() and publish() may run in different processes (a snapshot written by a forked child)
+    '''
+
+    def __init__(self, path, last_included_index, last_included_term, base_index, base_term, suffix='.partial'):
+        self.path = path
+        self.partial_path = path + suffix
+        self.info = (last_included_index, last_included_term, base_index, base_term)
+        self.fd = os.open(self.partial_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+        header = _SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, VERSION, *self.info)
+        _write_at(self.fd, 0, header)
+        self.crc = zlib.crc32(header)
+        # bytes of state machine written so far
+        self.size = 0
+
+    def write(self, data):
+        _write_at(self.fd, _SNAPSHOT_HEADER.size + self.size, data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+
+    def finish(self):
+        _write_at(self.fd, _SNAPSHOT_HEADER.size + self.size, _CRC.pack(self.crc))
+        os.fsync(self.fd)
+        self.close()
+
+    def publish(self):
+        os.replace(self.partial_path, self.path)
+        _sync_directory(os.path.dirname(self.path))
+
+    def commit(self):
+        self.finish()
+        self.publish()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def abort(self):
+        self.close()
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+
+class SnapshotReader:
+    '''
+    Reads the state machine part of a snapshot file. The file stays open, so a reader keeps reading the same
+    snapshot even after a newer one replaced it
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        header = os.pread(self.fd, _SNAPSHOT_HEADER.size, 0)
+        if len(header) < _SNAPSHOT_HEADER.size:
+            os.close(self.fd)
+            raise IOError(f'Corrupt snapshot file {path}')
+        _, _, *info = _SNAPSHOT_HEADER.unpack(header)
+        self.info = tuple(info)
+        self.size = os.fstat(self.fd).st_size - _SNAPSHOT_HEADER.size - _CRC.size
+
+    def read(self, offset, size):
+        # up to size bytes of state machine from offset
+        return _read_at(self.fd, _SNAPSHOT_HEADER.size + offset, min(size, self.size - offset))
+
+    def chunks(self, chunk_size=SNAPSHOT_READ_SIZE):
+        # the state machine chunk_size bytes at a time, checked against the crc of the file once it is all read
+        crc = zlib.crc32(os.pread(self.fd, _SNAPSHOT_HEADER.size, 0))
+        offset = 0
+        while offset < self.size:
+            data = self.read(offset, chunk_size)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            offset += len(data)
+            yield data
+        expected = os.pread(self.fd, _CRC.size, _SNAPSHOT_HEADER.size + self.size)
+        if offset != self.size or len(expected) != _CRC.size or crc != _CRC.unpack(expected)[0]:
+            raise IOError(f'Corrupt snapshot file {self.path}')
+
+    def close(self):
+        os.close(self.fd)